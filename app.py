@@ -1,34 +1,230 @@
 import os
 import json
+import time
+# 模块开始加载的时间，用来统计导入耗时（见文件末尾）
+_module_started = time.perf_counter()
+import hashlib
+import re
+import random
+import asyncio
+import logging
+import threading
+import sqlite3
+import uuid
+from queue import Empty, Queue
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
 import streamlit as st
-from datetime import datetime, date
-from openai import OpenAI
-from typing import Dict, List, Optional
+from datetime import datetime, date, timedelta
+from abc import ABC, abstractmethod
+from collections import Counter, OrderedDict, deque
+from difflib import SequenceMatcher
+from typing import Callable, Dict, List, Optional
 from dotenv import load_dotenv
-from supabase import create_client, Client
+from prompts import (
+    CHAT_SYSTEM_PROMPT, EVALUATION_INSTRUCTIONS, EVALUATION_PROMPTS, QUESTION_PROMPT_PREFIX, QUESTION_PROMPTS,
+    PromptRegistry, estimate_tokens, prompt_fields
+)
+import weakness_classifier
+from weakness_classifier import COMMENT_CLASSIFIER
 
-# 加载 .env 文件（仅用于本地开发）
-load_dotenv()
+logger = logging.getLogger("cet4_writing_tutor")
 
-# 初始化 OpenAI 客户端（使用阿里云 Qwen-Max）
-# 优先使用 st.secrets，其次使用环境变量
-api_key = st.secrets.get("DASHSCOPE_API_KEY") or os.getenv("DASHSCOPE_API_KEY") or st.secrets.get("OPENAI_API_KEY") or os.getenv("OPENAI_API_KEY")
-if not api_key:
-    raise ValueError("请设置环境变量 DASHSCOPE_API_KEY 或 OPENAI_API_KEY")
+# 加载 .env 文件（仅用于本地开发），每个进程只读一次
+@st.cache_resource
+def load_environment() -> bool:
+    return load_dotenv()
 
-client = OpenAI(
-    api_key=api_key,
-    base_url="https://dashscope.aliyuncs.com/compatible-mode/v1"
-)
+load_environment()
 
-# 初始化 Supabase 客户端
-supabase_url = st.secrets.get("SUPABASE_URL") or os.getenv("SUPABASE_URL")
-supabase_key = st.secrets.get("SUPABASE_KEY") or os.getenv("SUPABASE_KEY")
+# 读取配置：优先使用 st.secrets，其次使用环境变量（没有 secrets.toml 时只看环境变量）
+def get_setting(name: str, default=None):
+    try:
+        value = st.secrets.get(name)
+    except FileNotFoundError:
+        value = None
+    return value or os.getenv(name) or default
+
+# 日志输出到标准错误，级别由 LOG_LEVEL 决定（默认 INFO），每个进程只配置一次
+@st.cache_resource
+def configure_logging() -> logging.Logger:
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    logger.addHandler(handler)
+    logger.setLevel(str(get_setting("LOG_LEVEL", "INFO")).upper())
+    # 不再交给根 logger，避免 streamlit 的日志配置把同一行再打一遍
+    logger.propagate = False
+    return logger
+
+configure_logging()
+
+# 大模型网关：后台事件循环 + AsyncOpenAI，所有页面共用一个连接池
+class LLMGateway:
+    """同步代码通过它调用模型：每次调用有截止时间（慢请求最多让脚本线程等 timeout 秒），
+    429/5xx/连接错误按指数退避加抖动重试，全进程同时在途的请求数受信号量限制。
+    流式调用在拿到第一段内容前共用一个 timeout（含重试），之后每两段之间最多等 timeout 秒；
+    脚本线程这边的等待也有上限，事件循环线程出了问题会报超时，而不是一直卡住"""
+
+    # 脚本线程在事件循环的超时之外多等的秒数
+    QUEUE_GRACE = 1.0
+
+    def __init__(self, api_key: str, base_url: str, timeout: float, max_retries: int, max_concurrency: int):
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self._loop = asyncio.new_event_loop()
+        threading.Thread(target=self._loop.run_forever, name="llm-gateway", daemon=True).start()
+        asyncio.run_coroutine_threadsafe(
+            self._setup(api_key, base_url, max_concurrency), self._loop
+        ).result()
+
+    async def _setup(self, api_key: str, base_url: str, max_concurrency: int):
+        # openai / httpx 导入较慢，第一次调用模型时才导入
+        import httpx
+        from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+
+        # 信号量和 HTTP 连接池都要在网关自己的事件循环里创建
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._client = AsyncOpenAI(
+            api_key=api_key,
+            base_url=base_url,
+            max_retries=0,
+            http_client=DefaultAsyncHttpxClient(
+                limits=httpx.Limits(max_connections=max_concurrency * 2, max_keepalive_connections=max_concurrency)
+            )
+        )
 
-if not supabase_url or not supabase_key:
-    raise ValueError("请设置环境变量 SUPABASE_URL 和 SUPABASE_KEY")
+    @staticmethod
+    def _is_retryable(error: Exception) -> bool:
+        import openai
+
+        if isinstance(error, (openai.RateLimitError, openai.APIConnectionError)):
+            return True
+        return isinstance(error, openai.APIStatusError) and error.status_code >= 500
+
+    @staticmethod
+    def _backoff(attempt: int, error: Exception) -> float:
+        retry_after = None
+        response = getattr(error, "response", None)
+        if response is not None:
+            try:
+                retry_after = float(response.headers.get("retry-after"))
+            except (TypeError, ValueError):
+                pass
+        delay = retry_after if retry_after is not None else min(8.0, 0.5 * (2 ** attempt))
+        return delay * random.uniform(0.5, 1.5)
+
+    async def _complete(self, messages: List[Dict], model: str, timeout: float, params: Dict) -> str:
+        deadline = self._loop.time() + timeout
+        attempt = 0
+        while True:
+            try:
+                async with self._semaphore:
+                    response = await asyncio.wait_for(
+                        self._client.chat.completions.create(model=model, messages=messages, **params),
+                        max(0.0, deadline - self._loop.time())
+                    )
+                return response.choices[0].message.content or ""
+            except Exception as e:
+                delay = self._backoff(attempt, e)
+                if attempt >= self.max_retries or not self._is_retryable(e) or self._loop.time() + delay >= deadline:
+                    raise
+                attempt += 1
+                await asyncio.sleep(delay)
+
+    async def _stream(self, out: Queue, messages: List[Dict], model: str, timeout: float, params: Dict):
+        deadline = self._loop.time() + timeout
+        attempt = 0
+        started = False
+        while True:
+            try:
+                async with self._semaphore:
+                    stream = await asyncio.wait_for(
+                        self._client.chat.completions.create(model=model, messages=messages, stream=True, **params),
+                        max(0.0, deadline - self._loop.time())
+                    )
+                    try:
+                        chunks = stream.__aiter__()
+                        while True:
+                            try:
+                                # 第一段内容要在截止时间前到；之后两个片段之间超过 timeout 没有新内容也算超时
+                                wait = timeout if started else max(0.0, deadline - self._loop.time())
+                                chunk = await asyncio.wait_for(chunks.__anext__(), wait)
+                            except StopAsyncIteration:
+                                break
+                            if chunk.choices and chunk.choices[0].delta.content:
+                                started = True
+                                out.put(("chunk", chunk.choices[0].delta.content))
+                    finally:
+                        await stream.close()
+                out.put(("end", None))
+                return
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # 已经输出过内容就不能重试了，否则会重复
+                delay = self._backoff(attempt, e)
+                if started or attempt >= self.max_retries or not self._is_retryable(e) or self._loop.time() + delay >= deadline:
+                    out.put(("error", e))
+                    return
+                await asyncio.sleep(delay)
+                attempt += 1
+
+    def complete(self, messages: List[Dict], model: str = "qwen-max", timeout: float = None, **params) -> str:
+        """阻塞调用，返回完整回复文本"""
+        timeout = timeout or self.timeout
+        future = asyncio.run_coroutine_threadsafe(
+            self._complete(messages, model, timeout, params), self._loop
+        )
+        try:
+            return future.result(timeout + self.QUEUE_GRACE)
+        except FuturesTimeoutError:
+            future.cancel()
+            raise TimeoutError(f"模型网关 {timeout + self.QUEUE_GRACE:.0f} 秒没有响应")
+
+    def stream(self, messages: List[Dict], model: str = "qwen-max", timeout: float = None, **params):
+        """流式调用，等到第一段内容（或出错）才返回，之后逐段产出文本"""
+        timeout = timeout or self.timeout
+        out: Queue = Queue()
+        future = asyncio.run_coroutine_threadsafe(
+            self._stream(out, messages, model, timeout, params), self._loop
+        )
 
-supabase: Client = create_client(supabase_url, supabase_key)
+        def next_event() -> tuple:
+            try:
+                return out.get(timeout=timeout + self.QUEUE_GRACE)
+            except Empty:
+                future.cancel()
+                raise TimeoutError(f"模型网关 {timeout + self.QUEUE_GRACE:.0f} 秒没有响应")
+
+        kind, value = next_event()
+        if kind == "error":
+            raise value
+
+        def chunks(kind, value):
+            try:
+                while kind == "chunk":
+                    yield value
+                    kind, value = next_event()
+                if kind == "error":
+                    raise value
+            finally:
+                # 调用方提前停止读取时取消后台请求
+                future.cancel()
+
+        return chunks(kind, value)
+
+# 模型网关在第一次用到时才创建；没有配置 key 时只有调用模型的功能报错，历史记录和薄弱点页照常可用
+@st.cache_resource
+def get_llm_gateway() -> LLMGateway:
+    api_key = get_setting("DASHSCOPE_API_KEY") or get_setting("OPENAI_API_KEY")
+    if not api_key:
+        raise ValueError("请设置环境变量 DASHSCOPE_API_KEY 或 OPENAI_API_KEY")
+    return LLMGateway(
+        api_key=api_key,
+        base_url=get_setting("LLM_BASE_URL", "https://dashscope.aliyuncs.com/compatible-mode/v1"),
+        timeout=float(get_setting("LLM_TIMEOUT", 60)),
+        max_retries=int(get_setting("LLM_MAX_RETRIES", 3)),
+        max_concurrency=int(get_setting("LLM_MAX_CONCURRENCY", 4))
+    )
 
 # 页面配置
 st.set_page_config(
@@ -240,105 +436,1511 @@ WRITING_MODES = {
     6: "Paraphrasing"          # 周日 - 改写
 }
 
+# 数据缓存：TTL 过期 + 按表精确失效
+class DataCache:
+    """进程级数据缓存，每个条目带上它依赖的表，写入某张表时只清掉相关条目"""
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._entries: Dict[tuple, tuple] = {}
+        self._generations: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def get_or_load(self, key: tuple, tables: tuple, loader):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > now:
+                return entry[2]
+            generations = {t: self._generations.get(t, 0) for t in tables}
+
+        value = loader()
+
+        with self._lock:
+            # 加载期间发生了写入，结果可能已过期，不放进缓存
+            if all(self._generations.get(t, 0) == g for t, g in generations.items()):
+                self._entries[key] = (now + self.ttl, frozenset(tables), value)
+        return value
+
+    def invalidate(self, *tables: str):
+        with self._lock:
+            for table in tables:
+                self._generations[table] = self._generations.get(table, 0) + 1
+            stale = [k for k, e in self._entries.items() if e[1].intersection(tables)]
+            for key in stale:
+                del self._entries[key]
+
+@st.cache_resource
+def get_data_cache() -> DataCache:
+    return DataCache(ttl=float(get_setting("DATA_CACHE_TTL", 300)))
+
+# 存储层：所有表的读写都经过这里，STORAGE_BACKEND 选择 Supabase（默认）或本地 SQLite
+class Storage(ABC):
+    """存储接口。行都是普通 dict，JSON 字段（question / evaluation）已经解码；
+    columns 用 PostgREST 的写法，如 "record_id,mode" 或 "summary:evaluation->>summary"。
+    出错时直接抛出异常，由调用方决定怎么提示"""
+
+    @abstractmethod
+    def insert(self, table: str, rows: List[Dict], on_conflict: Optional[str] = None) -> List[Dict]:
+        """on_conflict 指定唯一键时，键已存在的行直接跳过，重试同一批写入不会产生重复行"""
+        raise NotImplementedError
+
+    # 练习记录
+    @abstractmethod
+    def practice_between(self, start: str, end: str, columns: str) -> List[Dict]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def practice_page(self, columns: str, cursor: Optional[tuple], limit: int, mode: Optional[str]) -> List[Dict]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_practice(self, record_id: str, columns: str) -> Optional[Dict]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def update_practice(self, record_id: str, fields: Dict):
+        raise NotImplementedError
+
+    @abstractmethod
+    def practice_stats(self, today: date) -> Dict:
+        raise NotImplementedError
+
+    @abstractmethod
+    def recent_completion_tokens(self, limit: int) -> List[Dict]:
+        """最近有输出 token 数的练习记录，只含 mode 和 completion_tokens"""
+        raise NotImplementedError
+
+    # 薄弱点
+    @abstractmethod
+    def list_weakness(self, columns: str, ascending: bool = False) -> List[Dict]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def weakness_page(self, columns: str, types: Optional[List[str]], mode: Optional[str], offset: int, limit: int) -> tuple:
+        raise NotImplementedError
+
+    @abstractmethod
+    def weakness_groups(self) -> List[Dict]:
+        """按 (type, mode, signature) 聚合的薄弱点，每组一行：count、最新的 timestamp 和最新一条的 issue / correction。
+        没有 signature 的旧数据按 (issue, correction) 分组。组按最新写入时间从旧到新排列"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def weakness_for_record(self, record_id: str, columns: str) -> List[Dict]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def replace_weakness_for_record(self, record_id: str, rows: List[Dict]):
+        raise NotImplementedError
+
+    @abstractmethod
+    def scan_weakness(self, columns: str, after_id, limit: int) -> List[Dict]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def set_weakness_type(self, ids: List, type_name: str):
+        raise NotImplementedError
+
+    # 每日题目、批改缓存
+    @abstractmethod
+    def upsert_daily_question(self, row: Dict):
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_daily_question(self, date_str: str) -> Optional[Dict]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_cached_evaluation(self, cache_key: str) -> Optional[Dict]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def put_cached_evaluation(self, row: Dict):
+        raise NotImplementedError
+
+    # AI 聊天
+    @abstractmethod
+    def list_conversations(self, cursor: Optional[tuple], limit: int) -> List[Dict]:
+        """按 (created_at, id) 倒序分页，cursor 为上一页最后一个对话的这两个字段"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def conversation_messages(self, conv_id: str, before_id: Optional[int], limit: int) -> tuple:
+        raise NotImplementedError
+
+    @abstractmethod
+    def update_conversation(self, conv_id: str, fields: Dict):
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete_conversation(self, conv_id: str):
+        raise NotImplementedError
+
+# 由日期、题型、薄弱点类型的明细算出统计（数据库没有聚合函数时使用）
+def _stats_from_rows(total: int, weakness_total: int, practice_rows: List[Dict], weakness_rows: List[Dict], today: date) -> Dict:
+    days = set()
+    mode_counts = {}
+    for row in practice_rows:
+        if row.get("timestamp"):
+            days.add(date.fromisoformat(row["timestamp"][:10]))
+        mode = row.get("mode") or "其他"
+        mode_counts[mode] = mode_counts.get(mode, 0) + 1
+    weakness_by_type = {}
+    for row in weakness_rows:
+        ptype = row.get("type") or "其他"
+        weakness_by_type[ptype] = weakness_by_type.get(ptype, 0) + 1
+
+    return {
+        "total_practices": total,
+        "practice_days": len(days),
+        "streak": _compute_streak(days, today),
+        "weakness_total": weakness_total,
+        "weakness_by_type": weakness_by_type,
+        "mode_counts": mode_counts
+    }
+
+# 数据库里还没建这个函数（没执行 supabase_setup.sql）：PostgREST 返回 PGRST202 / 404
+def _is_missing_rpc(e: Exception) -> bool:
+    code = getattr(e, "code", None)
+    status = getattr(getattr(e, "response", None), "status_code", None)
+    return code in ("PGRST202", "404", 404) or status == 404
+
+# 字段不存在的报错：PostgREST 的 PGRST204（schema cache 里没有这个字段）或 Postgres 的 42703，
+# 返回报错里的字段名；其他错误（包括消息里碰巧提到字段名的约束、类型错误）返回 None
+_MISSING_COLUMN_PATTERN = re.compile(r"'(\w+)' column|column \"(\w+)\"")
+
+def _missing_column(e: Exception) -> Optional[str]:
+    if getattr(e, "code", None) not in ("PGRST204", "42703"):
+        return None
+    match = _MISSING_COLUMN_PATTERN.search(getattr(e, "message", None) or str(e))
+    return (match.group(1) or match.group(2)) if match else None
+
+class SupabaseStorage(Storage):
+    """Supabase（PostgREST）后端，需要先执行 supabase_setup.sql"""
+
+    def __init__(self, url: str, key: str):
+        if not url or not key:
+            raise ValueError("请设置环境变量 SUPABASE_URL 和 SUPABASE_KEY")
+        # supabase 导入较慢，用到这个后端时才导入
+        from supabase import create_client
+
+        self.client = create_client(url, key)
+
+    # 后来新增、旧数据库里可能还没有的字段（见 supabase_setup.sql）
+    OPTIONAL_COLUMNS = {
+        "practice_history": ("completion_tokens",),
+        "weakness_points": ("client_id", "signature")
+    }
+
+    def _insert(self, table: str, rows: List[Dict], on_conflict: Optional[str]) -> List[Dict]:
+        if on_conflict:
+            return self.client.table(table).upsert(rows, on_conflict=on_conflict, ignore_duplicates=True).execute().data or []
+        return self.client.table(table).insert(rows).execute().data or []
+
+    def insert(self, table: str, rows: List[Dict], on_conflict: Optional[str] = None) -> List[Dict]:
+        optional = set(self.OPTIONAL_COLUMNS.get(table, ()))
+        while True:
+            try:
+                return self._insert(table, rows, on_conflict)
+            except Exception as e:
+                if on_conflict and getattr(e, "code", None) == "42P10":
+                    # 没有 on_conflict 字段上的唯一索引（还没执行 supabase_setup.sql），退回到普通 insert
+                    logger.warning("%s.%s 上没有唯一索引，按普通 insert 写入: %s", table, on_conflict, e)
+                    on_conflict = None
+                    continue
+                # 数据库还没加这个字段时去掉它重试，每个字段最多一次
+                column = _missing_column(e)
+                if column not in optional:
+                    raise
+                optional.discard(column)
+                logger.warning("%s 表还没有 %s 字段，去掉后重写: %s", table, column, e)
+                rows = [{k: v for k, v in row.items() if k != column} for row in rows]
+                if on_conflict == column:
+                    on_conflict = None
+
+    def practice_between(self, start: str, end: str, columns: str) -> List[Dict]:
+        response = (
+            self.client.table("practice_history")
+            .select(columns)
+            .gte("timestamp", start)
+            .lt("timestamp", end)
+            .order("timestamp")
+            .execute()
+        )
+        return response.data or []
+
+    def practice_page(self, columns: str, cursor: Optional[tuple], limit: int, mode: Optional[str]) -> List[Dict]:
+        query = (
+            self.client.table("practice_history")
+            .select(columns)
+            .order("created_at", desc=True)
+            .order("record_id", desc=True)
+            .limit(limit)
+        )
+        if mode:
+            query = query.eq("mode", mode)
+        if cursor:
+            created_at, record_id = cursor
+            query = query.or_(
+                f'created_at.lt."{created_at}",'
+                f'and(created_at.eq."{created_at}",record_id.lt."{record_id}")'
+            )
+        return query.execute().data or []
+
+    def get_practice(self, record_id: str, columns: str) -> Optional[Dict]:
+        response = self.client.table("practice_history").select(columns).eq("record_id", record_id).limit(1).execute()
+        return response.data[0] if response.data else None
+
+    def update_practice(self, record_id: str, fields: Dict):
+        optional = set(self.OPTIONAL_COLUMNS["practice_history"])
+        while True:
+            try:
+                self.client.table("practice_history").update(fields).eq("record_id", record_id).execute()
+                return
+            except Exception as e:
+                # 同 insert：数据库还没加这个字段时去掉它重试
+                column = _missing_column(e)
+                if column not in optional or column not in fields:
+                    raise
+                optional.discard(column)
+                fields = {k: v for k, v in fields.items() if k != column}
+
+    def recent_completion_tokens(self, limit: int) -> List[Dict]:
+        response = (
+            self.client.table("practice_history")
+            .select("mode,completion_tokens")
+            .not_.is_("completion_tokens", "null")
+            .order("created_at", desc=True)
+            .limit(limit)
+            .execute()
+        )
+        return response.data or []
+
+    def practice_stats(self, today: date) -> Dict:
+        try:
+            # 数据库端聚合，只返回一行统计（见 supabase_setup.sql）
+            response = self.client.rpc("get_practice_stats", {"p_today": today.isoformat()}).execute()
+            if response.data:
+                return response.data
+            logger.warning("get_practice_stats 没有返回数据，改用计数查询")
+        except Exception as e:
+            # 只有数据库还没建这个函数时才退回，其他错误原样抛出
+            if not _is_missing_rpc(e):
+                raise
+            logger.warning("数据库里没有 get_practice_stats 函数，改用计数查询: %s", e)
+
+        # 退回到计数查询 + 单列查询
+        total = self.client.table("practice_history").select("*", count="exact", head=True).execute().count or 0
+        weakness_total = self.client.table("weakness_points").select("*", count="exact", head=True).execute().count or 0
+        rows = self.client.table("practice_history").select("timestamp,mode").execute().data or []
+        types = self.client.table("weakness_points").select("type").execute().data or []
+        return _stats_from_rows(total, weakness_total, rows, types, today)
+
+    def list_weakness(self, columns: str, ascending: bool = False) -> List[Dict]:
+        return self.client.table("weakness_points").select(columns).order("created_at", desc=not ascending).execute().data or []
+
+    def weakness_page(self, columns: str, types: Optional[List[str]], mode: Optional[str], offset: int, limit: int) -> tuple:
+        query = (
+            self.client.table("weakness_points")
+            .select(columns, count="exact")
+            .order("created_at", desc=True)
+            .range(offset, offset + limit - 1)
+        )
+        if types:
+            query = query.in_("type", list(types))
+        if mode:
+            query = query.eq("mode", mode)
+        response = query.execute()
+        return response.data or [], response.count or 0
+
+    def weakness_groups(self) -> List[Dict]:
+        try:
+            # 数据库端聚合（见 supabase_setup.sql）
+            response = self.client.rpc("get_weakness_groups", {}).execute()
+            return response.data or []
+        except Exception as e:
+            if not _is_missing_rpc(e):
+                raise
+            logger.warning("数据库里没有 get_weakness_groups 函数，改为逐行读取薄弱点: %s", e)
+        # 每行当作一组（count 缺省为 1），签名由调用方计算
+        return self.list_weakness("type,mode,issue,correction,timestamp", ascending=True)
+
+    def weakness_for_record(self, record_id: str, columns: str) -> List[Dict]:
+        return self.client.table("weakness_points").select(columns).eq("record_id", record_id).execute().data or []
+
+    def replace_weakness_for_record(self, record_id: str, rows: List[Dict]):
+        try:
+            # 数据库函数内先删后插，在同一个事务里完成（见 supabase_setup.sql）
+            self.client.rpc("replace_weakness_points", {"p_record_id": record_id, "p_points": rows}).execute()
+        except Exception as e:
+            # 只有数据库还没建这个函数时才退回到先删后插，其他错误（如事务已回滚）原样抛出交给写入队列处理
+            if not _is_missing_rpc(e):
+                raise
+            logger.warning("数据库里没有 replace_weakness_points 函数，改为先删后插: %s", e)
+            self.client.table("weakness_points").delete().eq("record_id", record_id).execute()
+            if rows:
+                self.insert("weakness_points", rows)
+
+    def scan_weakness(self, columns: str, after_id, limit: int) -> List[Dict]:
+        query = self.client.table("weakness_points").select(columns).order("id").limit(limit)
+        if after_id is not None:
+            query = query.gt("id", after_id)
+        return query.execute().data or []
+
+    def set_weakness_type(self, ids: List, type_name: str):
+        self.client.table("weakness_points").update({"type": type_name}).in_("id", ids).execute()
+
+    def upsert_daily_question(self, row: Dict):
+        self.client.table("daily_questions").upsert(row, on_conflict="date_str").execute()
+
+    def get_daily_question(self, date_str: str) -> Optional[Dict]:
+        response = self.client.table("daily_questions").select("*").eq("date_str", date_str).limit(1).execute()
+        return response.data[0] if response.data else None
+
+    def get_cached_evaluation(self, cache_key: str) -> Optional[Dict]:
+        response = self.client.table("evaluation_cache").select("evaluation").eq("cache_key", cache_key).limit(1).execute()
+        return response.data[0].get("evaluation") if response.data else None
+
+    def put_cached_evaluation(self, row: Dict):
+        self.client.table("evaluation_cache").upsert(row, on_conflict="cache_key").execute()
+
+    def list_conversations(self, cursor: Optional[tuple], limit: int) -> List[Dict]:
+        query = (
+            self.client.table("ai_conversations")
+            .select("id,title,created_at,summary,summary_upto")
+            .order("created_at", desc=True)
+            .order("id", desc=True)
+            .limit(limit)
+        )
+        if cursor:
+            created_at, conv_id = cursor
+            query = query.or_(
+                f'created_at.lt."{created_at}",'
+                f'and(created_at.eq."{created_at}",id.lt."{conv_id}")'
+            )
+        return query.execute().data or []
+
+    def conversation_messages(self, conv_id: str, before_id: Optional[int], limit: int) -> tuple:
+        query = (
+            self.client.table("ai_messages")
+            .select("id,role,content,timestamp", count="exact")
+            .eq("conversation_id", conv_id)
+            .order("id", desc=True)
+            .limit(limit)
+        )
+        if before_id is not None:
+            query = query.lt("id", before_id)
+        response = query.execute()
+        return response.data or [], response.count or 0
+
+    def update_conversation(self, conv_id: str, fields: Dict):
+        self.client.table("ai_conversations").update(fields).eq("id", conv_id).execute()
+
+    def delete_conversation(self, conv_id: str):
+        # 消息随外键级联删除
+        self.client.table("ai_conversations").delete().eq("id", conv_id).execute()
+
+SQLITE_SCHEMA = """
+create table if not exists practice_history (
+    record_id text primary key,
+    mode text,
+    question text,
+    user_answer text,
+    evaluation text,
+    "timestamp" text,
+    created_at text not null default (strftime('%Y-%m-%dT%H:%M:%f', 'now')),
+    completion_tokens integer
+);
+create index if not exists practice_history_created_at_record_id_idx on practice_history (created_at desc, record_id desc);
+create index if not exists practice_history_timestamp_idx on practice_history ("timestamp");
+create index if not exists practice_history_mode_created_at_record_id_idx on practice_history (mode, created_at desc, record_id desc);
+
+create table if not exists weakness_points (
+    id integer primary key autoincrement,
+    record_id text,
+    type text,
+    issue text,
+    correction text,
+    mode text,
+    "timestamp" text,
+    created_at text not null default (strftime('%Y-%m-%dT%H:%M:%f', 'now')),
+    client_id text,
+    signature text
+);
+create index if not exists weakness_points_record_id_idx on weakness_points (record_id);
+create index if not exists weakness_points_created_at_idx on weakness_points (created_at desc);
+create index if not exists weakness_points_type_mode_created_at_idx on weakness_points (type, mode, created_at desc);
+
+create table if not exists daily_questions (
+    date_str text primary key,
+    question text,
+    "timestamp" text
+);
+
+create table if not exists evaluation_cache (
+    cache_key text primary key,
+    mode text,
+    evaluation text not null,
+    created_at text not null default (strftime('%Y-%m-%dT%H:%M:%f', 'now'))
+);
+
+create table if not exists ai_conversations (
+    id text primary key,
+    title text not null default '新对话',
+    created_at text not null default (strftime('%Y-%m-%dT%H:%M:%f', 'now')),
+    summary text,
+    summary_upto integer not null default 0
+);
+create index if not exists ai_conversations_created_at_idx on ai_conversations (created_at desc);
+
+create table if not exists ai_messages (
+    id integer primary key autoincrement,
+    conversation_id text not null references ai_conversations (id) on delete cascade,
+    role text not null,
+    content text not null,
+    "timestamp" text
+);
+create index if not exists ai_messages_conversation_id_id_idx on ai_messages (conversation_id, id desc);
+"""
+
+class SQLiteStorage(Storage):
+    """本地 SQLite 后端（WAL 模式），单机部署或离线测试用，表结构和索引与 supabase_setup.sql 对应。
+    一个连接在所有线程间共用，用锁串行化"""
+
+    # 各表中存 JSON 文本的字段
+    JSON_COLUMNS = {
+        "practice_history": ("question", "evaluation"),
+        "daily_questions": ("question",),
+        "evaluation_cache": ("evaluation",)
+    }
+    # 建表之后新增的字段，旧数据库启动时补上
+    ADDED_COLUMNS = {
+        "practice_history": {"completion_tokens": "integer"},
+        "weakness_points": {"client_id": "text", "signature": "text"}
+    }
+    _IDENTIFIER = re.compile(r"^\w+$")
+
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._lock = threading.RLock()
+        with self._lock:
+            self._conn.execute("pragma journal_mode=wal")
+            self._conn.execute("pragma synchronous=normal")
+            self._conn.execute("pragma foreign_keys=on")
+            self._conn.executescript(SQLITE_SCHEMA)
+            # 旧数据库补上后来新增的字段
+            for table, columns in self.ADDED_COLUMNS.items():
+                existing = {row["name"] for row in self._conn.execute(f"pragma table_info({table})")}
+                for column, column_type in columns.items():
+                    if column not in existing:
+                        self._conn.execute(f"alter table {table} add column {column} {column_type}")
+            self._conn.execute("create unique index if not exists weakness_points_client_id_idx on weakness_points (client_id)")
+
+    def _columns(self, columns: str) -> str:
+        """把 PostgREST 的字段写法翻译成 SQL，支持 * 、普通字段和 别名:字段->>键"""
+        if columns.strip() == "*":
+            return "*"
+        parts = []
+        for part in columns.split(","):
+            part = part.strip()
+            alias, _, expr = part.rpartition(":")
+            if "->>" in expr:
+                column, key = expr.split("->>", 1)
+                names = [alias or key, column, key]
+                sql = f'json_extract("{column}", \'$.{key}\') as "{alias or key}"'
+            else:
+                names = [alias or expr, expr]
+                sql = f'"{expr}" as "{alias}"' if alias else f'"{expr}"'
+            if not all(self._IDENTIFIER.match(name) for name in names):
+                raise ValueError(f"不支持的字段写法: {part}")
+            parts.append(sql)
+        return ", ".join(parts)
+
+    def _decode(self, table: str, row: sqlite3.Row) -> Dict:
+        data = dict(row)
+        for column in self.JSON_COLUMNS.get(table, ()):
+            if isinstance(data.get(column), str):
+                data[column] = json.loads(data[column])
+        return data
+
+    def _encode(self, table: str, row: Dict) -> Dict:
+        data = dict(row)
+        for column in self.JSON_COLUMNS.get(table, ()):
+            if column in data and data[column] is not None and not isinstance(data[column], str):
+                data[column] = json.dumps(data[column], ensure_ascii=False)
+        return data
+
+    def _query(self, table: str, sql: str, params: tuple = ()) -> List[Dict]:
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+        return [self._decode(table, row) for row in rows]
+
+    def _execute(self, sql: str, params: tuple = ()):
+        with self._lock:
+            self._conn.execute(sql, params)
+
+    def _insert_sql(self, table: str, row: Dict, verb: str = "insert", on_conflict: Optional[str] = None) -> tuple:
+        names = list(row)
+        if not all(self._IDENTIFIER.match(name) for name in [table] + names + ([on_conflict] if on_conflict else [])):
+            raise ValueError(f"不支持的字段: {names}")
+        columns = ", ".join(f'"{name}"' for name in names)
+        placeholders = ", ".join("?" for _ in names)
+        conflict = f' on conflict ("{on_conflict}") do nothing' if on_conflict else ""
+        return f'{verb} into "{table}" ({columns}) values ({placeholders}){conflict} returning *', tuple(row.values())
+
+    def _set_sql(self, fields: Dict) -> tuple:
+        if not all(self._IDENTIFIER.match(name) for name in fields):
+            raise ValueError(f"不支持的字段: {list(fields)}")
+        return ", ".join(f'"{name}" = ?' for name in fields), tuple(fields.values())
+
+    def insert(self, table: str, rows: List[Dict], on_conflict: Optional[str] = None) -> List[Dict]:
+        inserted = []
+        with self._lock:
+            self._conn.execute("begin")
+            try:
+                for row in rows:
+                    sql, params = self._insert_sql(table, self._encode(table, row), on_conflict=on_conflict)
+                    inserted.extend(self._conn.execute(sql, params).fetchall())
+                self._conn.execute("commit")
+            except Exception:
+                self._conn.execute("rollback")
+                raise
+        return [self._decode(table, row) for row in inserted]
+
+    def practice_between(self, start: str, end: str, columns: str) -> List[Dict]:
+        return self._query(
+            "practice_history",
+            f'select {self._columns(columns)} from practice_history where "timestamp" >= ? and "timestamp" < ? order by "timestamp"',
+            (start, end)
+        )
+
+    def practice_page(self, columns: str, cursor: Optional[tuple], limit: int, mode: Optional[str]) -> List[Dict]:
+        conditions, params = [], []
+        if mode:
+            conditions.append("mode = ?")
+            params.append(mode)
+        if cursor:
+            conditions.append("(created_at < ? or (created_at = ? and record_id < ?))")
+            params.extend([cursor[0], cursor[0], cursor[1]])
+        where = f"where {' and '.join(conditions)}" if conditions else ""
+        return self._query(
+            "practice_history",
+            f"select {self._columns(columns)} from practice_history {where} order by created_at desc, record_id desc limit ?",
+            tuple(params) + (limit,)
+        )
+
+    def get_practice(self, record_id: str, columns: str) -> Optional[Dict]:
+        rows = self._query("practice_history", f"select {self._columns(columns)} from practice_history where record_id = ? limit 1", (record_id,))
+        return rows[0] if rows else None
+
+    def update_practice(self, record_id: str, fields: Dict):
+        assignments, params = self._set_sql(self._encode("practice_history", fields))
+        self._execute(f"update practice_history set {assignments} where record_id = ?", params + (record_id,))
+
+    def recent_completion_tokens(self, limit: int) -> List[Dict]:
+        return self._query(
+            "practice_history",
+            "select mode, completion_tokens from practice_history where completion_tokens is not null order by created_at desc limit ?",
+            (limit,)
+        )
+
+    def practice_stats(self, today: date) -> Dict:
+        total = self._query("practice_history", "select count(*) as n from practice_history")[0]["n"]
+        weakness_total = self._query("weakness_points", "select count(*) as n from weakness_points")[0]["n"]
+        rows = self._query("practice_history", 'select "timestamp", mode from practice_history')
+        types = self._query("weakness_points", "select type from weakness_points")
+        return _stats_from_rows(total, weakness_total, rows, types, today)
+
+    def list_weakness(self, columns: str, ascending: bool = False) -> List[Dict]:
+        order = "asc" if ascending else "desc"
+        return self._query("weakness_points", f"select {self._columns(columns)} from weakness_points order by created_at {order}, id {order}")
+
+    def weakness_page(self, columns: str, types: Optional[List[str]], mode: Optional[str], offset: int, limit: int) -> tuple:
+        conditions, params = [], []
+        if types:
+            conditions.append(f"type in ({', '.join('?' for _ in types)})")
+            params.extend(types)
+        if mode:
+            conditions.append("mode = ?")
+            params.append(mode)
+        where = f"where {' and '.join(conditions)}" if conditions else ""
+        total = self._query("weakness_points", f"select count(*) as n from weakness_points {where}", tuple(params))[0]["n"]
+        rows = self._query(
+            "weakness_points",
+            f"select {self._columns(columns)} from weakness_points {where} order by created_at desc, id desc limit ? offset ?",
+            tuple(params) + (limit, offset)
+        )
+        return rows, total
+
+    def weakness_groups(self) -> List[Dict]:
+        # 每组最新一条（id 最大）提供 issue / correction
+        return self._query(
+            "weakness_points",
+            """
+            with groups as (
+                select count(*) as count, max("timestamp") as latest, max(id) as latest_id
+                from weakness_points
+                group by type, mode, signature,
+                    case when signature is null then issue end,
+                    case when signature is null then correction end
+            )
+            select w.type, w.mode, w.signature, w.issue, w.correction, g.count, g.latest as "timestamp"
+            from groups g join weakness_points w on w.id = g.latest_id
+            order by g.latest_id
+            """
+        )
+
+    def weakness_for_record(self, record_id: str, columns: str) -> List[Dict]:
+        return self._query("weakness_points", f"select {self._columns(columns)} from weakness_points where record_id = ?", (record_id,))
+
+    def replace_weakness_for_record(self, record_id: str, rows: List[Dict]):
+        with self._lock:
+            self._conn.execute("begin")
+            try:
+                self._conn.execute("delete from weakness_points where record_id = ?", (record_id,))
+                for row in rows:
+                    sql, params = self._insert_sql("weakness_points", row)
+                    self._conn.execute(sql, params)
+                self._conn.execute("commit")
+            except Exception:
+                self._conn.execute("rollback")
+                raise
+
+    def scan_weakness(self, columns: str, after_id, limit: int) -> List[Dict]:
+        return self._query(
+            "weakness_points",
+            f"select {self._columns(columns)} from weakness_points where id > ? order by id limit ?",
+            (after_id if after_id is not None else -1, limit)
+        )
+
+    def set_weakness_type(self, ids: List, type_name: str):
+        self._execute(f"update weakness_points set type = ? where id in ({', '.join('?' for _ in ids)})", (type_name, *ids))
+
+    def upsert_daily_question(self, row: Dict):
+        sql, params = self._insert_sql("daily_questions", self._encode("daily_questions", row), verb="insert or replace")
+        self._query("daily_questions", sql, params)
+
+    def get_daily_question(self, date_str: str) -> Optional[Dict]:
+        rows = self._query("daily_questions", "select * from daily_questions where date_str = ? limit 1", (date_str,))
+        return rows[0] if rows else None
+
+    def get_cached_evaluation(self, cache_key: str) -> Optional[Dict]:
+        rows = self._query("evaluation_cache", "select evaluation from evaluation_cache where cache_key = ? limit 1", (cache_key,))
+        return rows[0]["evaluation"] if rows else None
+
+    def put_cached_evaluation(self, row: Dict):
+        sql, params = self._insert_sql("evaluation_cache", self._encode("evaluation_cache", row), verb="insert or replace")
+        self._query("evaluation_cache", sql, params)
+
+    def list_conversations(self, cursor: Optional[tuple], limit: int) -> List[Dict]:
+        where, params = "", ()
+        if cursor:
+            where, params = "where created_at < ? or (created_at = ? and id < ?)", (cursor[0], cursor[0], cursor[1])
+        return self._query(
+            "ai_conversations",
+            f"select id, title, created_at, summary, summary_upto from ai_conversations {where} order by created_at desc, id desc limit ?",
+            params + (limit,)
+        )
+
+    def conversation_messages(self, conv_id: str, before_id: Optional[int], limit: int) -> tuple:
+        # 总数和 Supabase 的 count="exact" 一样，只计 before_id 之前的消息
+        where, params = "conversation_id = ?", (conv_id,)
+        if before_id is not None:
+            where, params = where + " and id < ?", params + (before_id,)
+        total = self._query("ai_messages", f"select count(*) as n from ai_messages where {where}", params)[0]["n"]
+        rows = self._query(
+            "ai_messages",
+            f'select id, role, content, "timestamp" from ai_messages where {where} order by id desc limit ?',
+            params + (limit,)
+        )
+        return rows, total
+
+    def update_conversation(self, conv_id: str, fields: Dict):
+        assignments, params = self._set_sql(fields)
+        self._execute(f"update ai_conversations set {assignments} where id = ?", params + (conv_id,))
+
+    def delete_conversation(self, conv_id: str):
+        self._execute("delete from ai_conversations where id = ?", (conv_id,))
+
+@st.cache_resource
+def get_storage() -> Storage:
+    backend = str(get_setting("STORAGE_BACKEND", "supabase")).lower()
+    if backend == "sqlite":
+        default_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cet4_writing_tutor.db")
+        return SQLiteStorage(get_setting("SQLITE_PATH", default_path))
+    if backend != "supabase":
+        raise ValueError(f"未知的 STORAGE_BACKEND: {backend}（可选 supabase / sqlite）")
+    return SupabaseStorage(get_setting("SUPABASE_URL"), get_setting("SUPABASE_KEY"))
+
 # 初始化数据库表（兼容本地文件系统）
 def init_data_files():
-    # Supabase 数据库已在外部创建，无需本地初始化
-    pass
+    # Supabase 数据库已在外部创建；SQLite 后端在第一次取存储时建表
+    get_storage()
+
+# 练习记录的默认查询字段：不含 question / evaluation 两个大 JSON
+PRACTICE_LIGHT_COLUMNS = "record_id,mode,user_answer,timestamp,created_at"
+
+# 练习记录行模型
+class PracticeRecord:
+    """一条练习记录。question / evaluation 没查出来时，第一次访问再按 record_id 补取；
+    summary 只来自查询结果（轻量查询里的 summary 字段或已查出的 evaluation），不会为它补取整行"""
+
+    __slots__ = ("record_id", "mode", "user_answer", "timestamp", "created_at",
+                 "_summary", "_question", "_evaluation", "_heavy_loaded")
+
+    def __init__(self, row: Dict):
+        self.record_id = row.get("record_id", "")
+        self.mode = row.get("mode", "")
+        self.user_answer = row.get("user_answer", "")
+        self.timestamp = row.get("timestamp") or ""
+        self.created_at = row.get("created_at")
+        self._question = row.get("question")
+        self._evaluation = row.get("evaluation")
+        self._heavy_loaded = "question" in row and "evaluation" in row
+        summary = row.get("summary")
+        if summary is None and isinstance(self._evaluation, dict):
+            summary = self._evaluation.get("summary")
+        self._summary = summary or ""
+
+    def _load_heavy(self):
+        row = _load_practice_heavy_fields(self.record_id)
+        self._question = row.get("question")
+        self._evaluation = row.get("evaluation")
+        self._heavy_loaded = True
+
+    @property
+    def question(self) -> Dict:
+        if not self._heavy_loaded:
+            self._load_heavy()
+        return self._question or {}
+
+    @property
+    def evaluation(self) -> Dict:
+        if not self._heavy_loaded:
+            self._load_heavy()
+        return self._evaluation or {}
+
+    @property
+    def summary(self) -> str:
+        return self._summary
+
+# 薄弱点行模型
+class WeaknessPoint:
+    """一条薄弱点记录"""
+
+    __slots__ = ("record_id", "type", "issue", "correction", "mode", "timestamp")
+
+    def __init__(self, row: Dict):
+        self.record_id = row.get("record_id")
+        self.type = row.get("type") or "其他"
+        self.issue = row.get("issue") or ""
+        self.correction = row.get("correction") or ""
+        self.mode = row.get("mode") or "其他"
+        self.timestamp = row.get("timestamp") or ""
+
+WEAKNESS_PAGE_SIZE = 10
+
+# 按类型、题型在数据库端过滤并分页读取薄弱点，返回 (当前页, 过滤后的总条数)
+def load_weakness_page(types: Optional[List[str]] = None, mode: Optional[str] = None, page: int = 0, page_size: int = WEAKNESS_PAGE_SIZE) -> tuple:
+    def fetch():
+        rows, total = get_storage().weakness_page(
+            "record_id,type,issue,correction,mode,timestamp",
+            list(types) if types else None,
+            mode,
+            page * page_size,
+            page_size
+        )
+        return [WeaknessPoint(row) for row in rows], total
 
-# 读取薄弱点数据
-def load_weakness_points() -> List[Dict]:
     try:
-        response = supabase.table("weakness_points").select("*").order("created_at", desc=True).execute()
-        return response.data if response.data else []
+        key = ("weakness_page", tuple(types or ()), mode, page, page_size)
+        return get_data_cache().get_or_load(key, ("weakness_points",), fetch)
     except Exception as e:
         st.error(f"读取薄弱点失败: {str(e)}")
-        return []
+        return [], 0
+
+# 薄弱点错误类别及其关键词（在 issue / correction 文本里匹配）
+WEAKNESS_CATEGORIES = {
+    "时态": ("时态", "tense"),
+    "主谓一致": ("主谓一致", "主谓不一致", "subject-verb"),
+    "冠词": ("冠词", "article"),
+    "介词": ("介词", "preposition"),
+    "单复数": ("单复数", "复数", "单数", "plural"),
+    "拼写": ("拼写", "spelling"),
+    "词性": ("词性", "形容词", "副词", "名词"),
+    "非谓语": ("非谓语", "不定式", "动名词", "分词"),
+    "从句": ("从句", "clause"),
+    "用词搭配": ("用词", "搭配", "collocation", "词汇"),
+    "语序句式": ("语序", "句式", "句型", "倒装", "强调句", "被动"),
+    "标点大小写": ("标点", "大写", "小写", "punctuation"),
+    "表达地道": ("地道", "流畅", "自然", "口语化", "中式"),
+}
+
+# 关键词 -> 类别，以及所有关键词合成的一个正则（长的关键词优先匹配），模块加载时建一次
+WEAKNESS_KEYWORD_CATEGORY = {
+    keyword.lower(): category
+    for category, keywords in WEAKNESS_CATEGORIES.items()
+    for keyword in keywords
+}
+WEAKNESS_KEYWORD_PATTERN = re.compile(
+    "|".join(re.escape(k) for k in sorted(WEAKNESS_KEYWORD_CATEGORY, key=len, reverse=True)),
+    re.IGNORECASE
+)
+
+# 从一条薄弱点的文本中找出涉及的错误类别
+def weakness_categories(text: str) -> set:
+    return {WEAKNESS_KEYWORD_CATEGORY[m.group(0).lower()] for m in WEAKNESS_KEYWORD_PATTERN.finditer(text)}
+
+# 薄弱点的"错误签名"：新格式（英文原句 + 改正句）取两句的词级差异，如 "a→an"，
+# 这样不同句子里犯的同一个错误会得到同一个签名；差异太多或旧格式的中文批改意见取规范化后的原文
+def weakness_signature(issue: str, correction: str) -> str:
+    if issue and not CHINESE_CHAR_PATTERN.search(issue):
+        before = [w.lower() for w in ENGLISH_WORD_PATTERN.findall(issue)]
+        after = [w.lower() for w in ENGLISH_WORD_PATTERN.findall(correction or "")]
+        if before and after:
+            changes = [
+                f"{' '.join(before[i1:i2]) or '∅'}→{' '.join(after[j1:j2]) or '∅'}"
+                for tag, i1, i2, j1, j2 in SequenceMatcher(None, before, after, autojunk=False).get_opcodes()
+                if tag != "equal"
+            ]
+            if 0 < len(changes) <= 3:
+                return "; ".join(changes)
+    return " ".join(re.findall(r"\w+", (issue or "").lower()))[:80]
+
+def _signature_bigrams(signature: str) -> set:
+    text = signature.replace(" ", "")
+    return {text[i:i + 2] for i in range(len(text) - 1)} or {text}
+
+# 一组相同或相近的薄弱点
+class WeaknessCluster:
+    """同一类型下签名相同或足够相似的薄弱点，保留最近几条作为例子"""
+
+    __slots__ = ("key", "type", "signature", "bigrams", "count", "modes", "latest", "examples")
+
+    def __init__(self, key: str, type_name: str, signature: str):
+        self.key = key
+        self.type = type_name
+        self.signature = signature
+        self.bigrams = _signature_bigrams(signature)
+        self.count = 0
+        self.modes: Counter = Counter()
+        self.latest = ""
+        self.examples: deque = deque(maxlen=3)
+
+    @property
+    def issue(self) -> str:
+        return self.examples[-1]["issue"] if self.examples else ""
+
+    @property
+    def correction(self) -> str:
+        return self.examples[-1]["correction"] if self.examples else ""
+
+# 薄弱点画像：按类型、题型、错误类别计数，并把重复的薄弱点聚成簇，写入薄弱点时增量更新
+class WeaknessProfile:
+    """第一次用到时从数据库读按 (类型, 题型, 签名) 聚合的计数建立画像，之后只随增删增量更新；
+    错误类别按每组最新一条的文本计。聚类先按 (类型, 签名) 精确查找，找不到再用签名字符二元组的倒排索引找 Jaccard 相似度
+    达到 cluster_threshold 的簇，都没有才新建簇。
+    读数据库时不持有 _lock，期间的增删先记在 _backlog 里，读完后在锁内一起补上"""
+
+    def __init__(self, cluster_threshold: float = 0.75):
+        self.loaded = False
+        self.cluster_threshold = cluster_threshold
+        self.by_type: Counter = Counter()
+        self.by_mode: Counter = Counter()
+        self.categories: Counter = Counter()
+        self.mode_categories: Dict[str, Counter] = {}
+        self.clusters: Dict[str, WeaknessCluster] = {}
+        self._signature_cluster: Dict[tuple, str] = {}
+        self._bigram_index: Dict[tuple, set] = {}
+        self._backlog: Optional[List[tuple]] = None
+        self._generation = 0
+        self._lock = threading.Lock()
+        # 只让一个线程去数据库读，其余线程等它读完
+        self._load_lock = threading.Lock()
+
+    @property
+    def tracking(self) -> bool:
+        """画像已建立或正在建立，增删需要告诉它"""
+        return self.loaded or self._backlog is not None
+
+    def ensure_loaded(self):
+        if self.loaded:
+            return
+        with self._load_lock:
+            with self._lock:
+                if self.loaded:
+                    return
+                generation = self._generation
+                self._backlog = []
+            try:
+                rows = get_storage().weakness_groups()
+            except Exception:
+                with self._lock:
+                    self._backlog = None
+                raise
+            with self._lock:
+                backlog, self._backlog = self._backlog, None
+                # 读的过程中被 reset 过，这次的结果作废，下次再读
+                if generation != self._generation:
+                    return
+                self._apply(rows, 1)
+                for points, sign in backlog:
+                    self._apply(points, sign)
+                self.loaded = True
+
+    def _apply(self, points: List[Dict], sign: int):
+        # 聚合读出的行带 count，增删的单条薄弱点没有
+        for point in points:
+            mode = point.get("mode") or "其他"
+            count = point.get("count") or 1
+            self.by_type[point.get("type") or "其他"] += sign * count
+            self.by_mode[mode] += sign * count
+            text = f"{point.get('issue') or ''} {point.get('correction') or ''}"
+            mode_counter = self.mode_categories.setdefault(mode, Counter())
+            for category in weakness_categories(text):
+                self.categories[category] += sign * count
+                mode_counter[category] += sign * count
+            if sign > 0:
+                self._cluster_add(point, count)
+            else:
+                self._cluster_remove(point)
+
+    def _find_cluster(self, type_name: str, signature: str) -> Optional[WeaknessCluster]:
+        key = self._signature_cluster.get((type_name, signature))
+        if key:
+            return self.clusters[key]
+        bigrams = _signature_bigrams(signature)
+        candidates = set()
+        for bigram in bigrams:
+            candidates |= self._bigram_index.get((type_name, bigram), set())
+        best, best_score = None, 0.0
+        for key in candidates:
+            cluster = self.clusters[key]
+            score = len(bigrams & cluster.bigrams) / len(bigrams | cluster.bigrams)
+            if score > best_score:
+                best, best_score = cluster, score
+        return best if best_score >= self.cluster_threshold else None
+
+    def _cluster_add(self, point: Dict, count: int = 1):
+        type_name = point.get("type") or "其他"
+        signature = point.get("signature") or weakness_signature(point.get("issue") or "", point.get("correction") or "")
+        cluster = self._find_cluster(type_name, signature)
+        if cluster is None:
+            key = hashlib.sha1(f"{type_name}|{signature}".encode("utf-8")).hexdigest()[:12]
+            cluster = WeaknessCluster(key, type_name, signature)
+            self.clusters[key] = cluster
+            for bigram in cluster.bigrams:
+                self._bigram_index.setdefault((type_name, bigram), set()).add(key)
+        self._signature_cluster[(type_name, signature)] = cluster.key
+        cluster.count += count
+        cluster.modes[point.get("mode") or "其他"] += count
+        timestamp = point.get("timestamp") or ""
+        cluster.latest = max(cluster.latest, timestamp)
+        cluster.examples.append({
+            "issue": point.get("issue") or "",
+            "correction": point.get("correction") or "",
+            "timestamp": timestamp
+        })
+
+    def _cluster_remove(self, point: Dict):
+        type_name = point.get("type") or "其他"
+        signature = weakness_signature(point.get("issue") or "", point.get("correction") or "")
+        key = self._signature_cluster.get((type_name, signature))
+        if not key or key not in self.clusters:
+            return
+        cluster = self.clusters[key]
+        cluster.count -= 1
+        cluster.modes[point.get("mode") or "其他"] -= 1
+        for example in list(cluster.examples):
+            if example["issue"] == (point.get("issue") or ""):
+                cluster.examples.remove(example)
+                break
+        if cluster.count <= 0:
+            del self.clusters[key]
+            for bigram in cluster.bigrams:
+                self._bigram_index.get((type_name, bigram), set()).discard(key)
+            self._signature_cluster = {k: v for k, v in self._signature_cluster.items() if v != key}
+
+    def top_clusters(self, types: Optional[List[str]] = None, mode: Optional[str] = None, limit: Optional[int] = None) -> List[WeaknessCluster]:
+        """按出现次数从多到少返回簇，可按类型、题型过滤"""
+        self.ensure_loaded()
+        with self._lock:
+            clusters = [
+                c for c in self.clusters.values()
+                if (types is None or c.type in types) and (mode is None or c.modes.get(mode, 0) > 0)
+            ]
+        clusters.sort(key=lambda c: (c.count, c.latest), reverse=True)
+        return clusters[:limit] if limit else clusters
+
+    def reset(self):
+        """批量改动薄弱点后调用，下次用到时重新从数据库统计"""
+        with self._lock:
+            self.loaded = False
+            self._generation += 1
+            self.by_type.clear()
+            self.by_mode.clear()
+            self.categories.clear()
+            self.mode_categories.clear()
+            self.clusters.clear()
+            self._signature_cluster.clear()
+            self._bigram_index.clear()
+
+    def _record(self, points: List[Dict], sign: int):
+        with self._lock:
+            if self.loaded:
+                self._apply(points, sign)
+            elif self._backlog is not None:
+                self._backlog.append((list(points), sign))
+
+    def add(self, points: List[Dict]):
+        self._record(points, 1)
+
+    def remove(self, points: List[Dict]):
+        self._record(points, -1)
+
+    def prompt_hint(self, mode: str, top_n: int = 3) -> str:
+        """给出题提示词用的一句话，长度固定，不随薄弱点数量增长"""
+        self.ensure_loaded()
+        with self._lock:
+            overall = [c for c, n in self.categories.most_common(top_n) if n > 0]
+            in_mode = [c for c, n in self.mode_categories.get(mode, Counter()).most_common(top_n) if n > 0]
+        # 反复出现（至少两次）的具体改错，优先取本题型的
+        repeated = [
+            f"{c.signature}（{c.count}次）"
+            for c in self.top_clusters(mode=mode, limit=top_n) + self.top_clusters(limit=top_n)
+            if c.count >= 2 and "→" in c.signature
+        ]
+        repeated = list(dict.fromkeys(repeated))[:2]
+        if not overall and not in_mode and not repeated:
+            return ""
+        focus = in_mode + [c for c in overall if c not in in_mode]
+        hint = f"学生近期常犯的错误：{'、'.join(focus[:top_n + 1])}。" if focus else ""
+        if repeated:
+            hint += f"反复出现的具体改错：{'；'.join(repeated)}。"
+        return hint + "出题时让题目自然地涉及其中一两点，但不要在题目或提示里直接点明。"
+
+@st.cache_resource
+def get_weakness_profile() -> WeaknessProfile:
+    return WeaknessProfile()
+
+# 判断写入错误是否是数据库明确拒绝（重试也不会成功）；判断不了的都当作暂时性错误
+def is_permanent_write_error(e: Exception) -> bool:
+    if isinstance(e, (sqlite3.IntegrityError, sqlite3.ProgrammingError)):
+        return True
+    if isinstance(e, sqlite3.OperationalError):
+        # 数据库被锁、磁盘忙可以重试，表或字段不存在不行
+        return "no such" in str(e) or "has no column" in str(e)
+    # httpx.HTTPStatusError 带 response；postgrest 的 APIError 带 code，
+    # 可能是 HTTP 状态码、SQLSTATE（如 23505）或 PGRST 开头的错误码
+    status = getattr(getattr(e, "response", None), "status_code", None)
+    code = getattr(e, "code", None)
+    if status is None and (isinstance(code, int) or (isinstance(code, str) and code.isdigit() and len(code) == 3)):
+        status = int(code)
+    if status is not None:
+        return 400 <= status < 500 and status not in (408, 429)
+    if isinstance(code, str) and code:
+        if code.startswith("PGRST"):
+            # PGRST0xx 是连不上数据库，其余是请求、表结构或鉴权错误
+            return not code.startswith("PGRST0")
+        # SQLSTATE：08 连接异常、40 事务回滚（死锁等）、53 资源不足、57 被取消或超时，都可以重试
+        return code[:2] not in ("08", "40", "53", "57")
+    return False
+
+# 写后队列：练习记录和薄弱点的写入先进本地队列立即返回，后台线程再按顺序写入数据库
+class WriteBehindQueue:
+    """队列里每一项是 {"table": 表名, "row": 行}（新增），或带 op 的修改：
+    {"op": "update", "key": record_id, "row": 字段}、{"op": "replace", "key": record_id, "rows": 新薄弱点}。
+    所有写入按入队顺序执行，相邻同表的新增合并成一次 insert，
+    修改不会跑到还没写入的新增前面。薄弱点的新增和替换都在写成功后再更新画像。
+    没写进数据库的项同时追加在 spool 文件里，进程重启后继续写；写入失败按指数退避重试。
+    网络错误、超时、5xx 之类的暂时性错误一直重试；数据库明确拒绝（4xx、约束或字段错误）超过 max_attempts 次的批次
+    移到 .failed 文件，不再挡住后面的写入。新增按 CONFLICT_KEYS 里的唯一键写入，失败后重试不会重复插入。
+    写成功后清掉 DataCache 里对应表的缓存"""
+
+    # 各表新增时用来去重的唯一键
+    CONFLICT_KEYS = {
+        "practice_history": "record_id",
+        "weakness_points": "client_id"
+    }
 
-# 保存薄弱点数据
-def save_weakness_point(point: Dict, record_id: str = None):
+    def __init__(self, path: str, data_cache: "DataCache", profile: "WeaknessProfile", batch_size: int = 50, flush_interval: float = 1.0, max_backoff: float = 60.0, max_attempts: int = 5):
+        self.path = path
+        self.max_attempts = max_attempts
+        self.data_cache = data_cache
+        self.profile = profile
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_backoff = max_backoff
+        self.last_error: Optional[str] = None
+        self._pending: deque = deque()
+        self._cond = threading.Condition()
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        self._pending.append(json.loads(line))
+        except (OSError, ValueError):
+            pass
+        self.failed_count = len(self._read_failed())
+        threading.Thread(target=self._run, name="write-behind", daemon=True).start()
+
+    def _append_spool(self, items: List[Dict]):
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path, "a", encoding="utf-8") as f:
+                for item in items:
+                    f.write(json.dumps(item, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+        except OSError as e:
+            logger.warning("写入本地队列文件失败: %s", e)
+
+    def _rewrite_spool(self):
+        try:
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                for item in self._pending:
+                    f.write(json.dumps(item, ensure_ascii=False) + "\n")
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.warning("写入本地队列文件失败: %s", e)
+
+    def _push(self, items: List[Dict]):
+        with self._cond:
+            self._append_spool(items)
+            self._pending.extend(items)
+            self._cond.notify_all()
+
+    def _read_failed(self) -> List[Dict]:
+        items = []
+        try:
+            with open(self.path + ".failed", "r", encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        items.append(json.loads(line))
+        except (OSError, ValueError):
+            pass
+        return items
+
+    def retry_failed(self) -> int:
+        """把 .failed 里的项放回队列末尾重新写入（比如补执行 supabase_setup.sql 之后），返回条数"""
+        with self._cond:
+            items = [{k: v for k, v in item.items() if k != "error"} for item in self._read_failed()]
+            if items:
+                self._append_spool(items)
+                self._pending.extend(items)
+                try:
+                    os.remove(self.path + ".failed")
+                except OSError:
+                    pass
+                self.failed_count = 0
+                self._cond.notify_all()
+        return len(items)
+
+    def enqueue(self, table: str, rows: List[Dict]):
+        if rows:
+            self._push([{"table": table, "row": row} for row in rows])
+
+    def enqueue_update(self, table: str, key: str, fields: Dict):
+        self._push([{"op": "update", "table": table, "key": key, "row": fields}])
+
+    def enqueue_replace(self, table: str, key: str, rows: List[Dict]):
+        self._push([{"op": "replace", "table": table, "key": key, "rows": rows}])
+
+    def pending_rows(self, table: str) -> List[Dict]:
+        """还没写入的新增行"""
+        with self._cond:
+            return [item["row"] for item in self._pending if item["table"] == table and "op" not in item]
+
+    def flush(self, timeout: float = 10.0) -> bool:
+        """等到队列写空（需要读到刚写入的数据或要改已写入的行之前调用），超时返回 False"""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            self._cond.notify_all()
+            while self._pending:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def _next_batch(self) -> List[Dict]:
+        first = self._pending[0]
+        if "op" in first:
+            return [first]
+        batch = []
+        for item in self._pending:
+            if "op" in item or item["table"] != first["table"] or len(batch) >= self.batch_size:
+                break
+            batch.append(item)
+        return batch
+
+    def _write(self, batch: List[Dict]):
+        storage = get_storage()
+        item = batch[0]
+        op = item.get("op")
+        if op is None:
+            rows = [i["row"] for i in batch]
+            storage.insert(item["table"], rows, on_conflict=self.CONFLICT_KEYS.get(item["table"]))
+            if item["table"] == "weakness_points":
+                self.profile.add(rows)
+        elif op == "update":
+            storage.update_practice(item["key"], item["row"])
+        elif op == "replace":
+            # 画像已建立（或正在建立）时先取出旧薄弱点，替换成功后增量更新
+            old_rows = storage.weakness_for_record(item["key"], "type,mode,issue,correction") if self.profile.tracking else []
+            storage.replace_weakness_for_record(item["key"], item["rows"])
+            self.profile.remove(old_rows)
+            self.profile.add(item["rows"])
+        else:
+            raise ValueError(f"未知的写入操作: {op}")
+
+    def _pop(self, count: int):
+        with self._cond:
+            for _ in range(count):
+                self._pending.popleft()
+            self._rewrite_spool()
+            self._cond.notify_all()
+
+    def _run(self):
+        backoff = 1.0
+        attempts = 0
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                # 稍等一会儿，让同一次提交的几行合并成一批
+                self._cond.wait(self.flush_interval)
+                batch = self._next_batch()
+            table = batch[0]["table"]
+            try:
+                self._write(batch)
+            except Exception as e:
+                self.last_error = str(e)
+                attempts += 1
+                if is_permanent_write_error(e) and attempts >= self.max_attempts:
+                    logger.error("后台写入 %s 连续失败 %d 次，移到 %s.failed: %s", table, attempts, self.path, e)
+                    try:
+                        with open(self.path + ".failed", "a", encoding="utf-8") as f:
+                            for item in batch:
+                                f.write(json.dumps(dict(item, error=str(e)), ensure_ascii=False) + "\n")
+                    except OSError:
+                        pass
+                    self.failed_count += len(batch)
+                    self._pop(len(batch))
+                    attempts = 0
+                    backoff = 1.0
+                    continue
+                logger.warning("后台写入 %s 失败，%.0f 秒后重试: %s", table, backoff, e)
+                time.sleep(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+                continue
+            backoff = 1.0
+            attempts = 0
+            self.last_error = None
+            self._pop(len(batch))
+            self.data_cache.invalidate(table)
+
+@st.cache_resource
+def get_write_queue() -> WriteBehindQueue:
+    return WriteBehindQueue(
+        path=os.path.join(CACHE_DIR, "write_queue.jsonl"),
+        data_cache=get_data_cache(),
+        profile=get_weakness_profile(),
+        batch_size=int(get_setting("WRITE_BATCH_SIZE", 50)),
+        flush_interval=float(get_setting("WRITE_FLUSH_INTERVAL", 1.0))
+    )
+
+# 新练习记录的 record_id 在本地生成，提交时就能拿到；写后队列按它去重，必须全局唯一
+def new_record_id() -> str:
+    return uuid.uuid4().hex
+
+# 薄弱点写入的行格式
+def _weakness_row(point: Dict, record_id: str = None, timestamp: str = None) -> Dict:
+    return {
+        # 本地生成的唯一键，写后队列重试时用来去重
+        "client_id": uuid.uuid4().hex,
+        "record_id": record_id,
+        "type": point.get("type"),
+        "issue": point.get("issue"),
+        "correction": point.get("correction"),
+        "mode": point.get("mode"),
+        "timestamp": timestamp or datetime.now().isoformat(),
+        # 画像按签名在数据库端聚合
+        "signature": weakness_signature(point.get("issue") or "", point.get("correction") or "")
+    }
+
+# 批量保存薄弱点（一次 insert）
+def save_weakness_points(points: List[Dict], record_id: str = None):
+    if not points:
+        return
     try:
-        supabase.table("weakness_points").insert({
-            "record_id": record_id,
-            "type": point.get("type"),
-            "issue": point.get("issue"),
-            "correction": point.get("correction"),
-            "mode": point.get("mode"),
-            "timestamp": datetime.now().isoformat()
-        }).execute()
+        timestamp = datetime.now().isoformat()
+        rows = [_weakness_row(point, record_id, timestamp) for point in points]
+        # 交给写后队列，写入成功后再计入画像
+        get_write_queue().enqueue("weakness_points", rows)
     except Exception as e:
         st.error(f"保存薄弱点失败: {str(e)}")
 
-# 删除同一题目的薄弱点
-def delete_weakness_points_by_record(record_id: str):
+# 等修改写进数据库再返回，方便页面立刻读到新数据；超时说明数据库暂时连不上，修改留在队列里按顺序补写
+def _wait_for_write_queue():
+    if not get_write_queue().flush():
+        st.warning("数据库暂时连不上，修改已保存在本地队列，恢复后会自动写入")
+
+# 用新薄弱点整体替换同一题目的旧薄弱点（重新批改时使用），先删后插在一个事务里完成
+def replace_weakness_points(record_id: str, points: List[Dict]):
+    timestamp = datetime.now().isoformat()
+    rows = [_weakness_row(point, record_id, timestamp) for point in points]
     try:
-        supabase.table("weakness_points").delete().eq("record_id", record_id).execute()
+        get_write_queue().enqueue_replace("weakness_points", record_id, rows)
+        _wait_for_write_queue()
     except Exception as e:
-        st.error(f"删除薄弱点失败: {str(e)}")
+        st.error(f"更新薄弱点失败: {str(e)}")
+
+# 读取某一天的练习记录，日期范围在数据库端过滤（timestamp 上有索引）
+def load_history_for_date(day: date, columns: str = PRACTICE_LIGHT_COLUMNS) -> List[PracticeRecord]:
+    start = day.isoformat()
+    end = (day + timedelta(days=1)).isoformat()
+
+    def fetch():
+        return [PracticeRecord(row) for row in get_storage().practice_between(start, end, columns)]
 
-# 读取历史记录
-def load_history() -> List[Dict]:
     try:
-        response = supabase.table("practice_history").select("*").order("created_at", desc=True).execute()
-        return response.data if response.data else []
+        records = get_data_cache().get_or_load(("history_for_date", start, columns), ("practice_history",), fetch)
     except Exception as e:
         st.error(f"读取历史记录失败: {str(e)}")
         return []
+    # 补上还在写后队列里的当天记录
+    known = {record.record_id for record in records}
+    pending = [
+        PracticeRecord(row) for row in get_write_queue().pending_rows("practice_history")
+        if start <= row["timestamp"] < end and row["record_id"] not in known
+    ]
+    return records + pending if pending else records
+
+# 历史记录列表页只取轻量字段，题目和批改详情按需再取
+HISTORY_PAGE_SIZE = 20
+HISTORY_SUMMARY_COLUMNS = "record_id,mode,timestamp,created_at,summary:evaluation->>summary"
+
+# 按 (created_at, record_id) 键集分页读取历史记录，cursor 为上一页最后一条的这两个字段
+def load_history_page(cursor: Optional[tuple] = None, limit: int = HISTORY_PAGE_SIZE, mode: Optional[str] = None) -> List[PracticeRecord]:
+    def fetch():
+        return [PracticeRecord(row) for row in get_storage().practice_page(HISTORY_SUMMARY_COLUMNS, cursor, limit, mode)]
+
+    try:
+        return get_data_cache().get_or_load(("history_page", cursor, limit, mode), ("practice_history",), fetch)
+    except Exception as e:
+        st.error(f"读取历史记录失败: {str(e)}")
+        return []
+
+# 读取单条完整的练习记录
+def load_practice_record(record_id: str) -> Optional[PracticeRecord]:
+    def fetch():
+        row = get_storage().get_practice(record_id, "*")
+        return PracticeRecord(row) if row else None
+
+    try:
+        return get_data_cache().get_or_load(("practice_record", record_id), ("practice_history",), fetch)
+    except Exception as e:
+        st.error(f"读取练习记录失败: {str(e)}")
+        return None
+
+# 只读取某条记录的 question / evaluation（PracticeRecord 懒加载用）
+def _load_practice_heavy_fields(record_id: str) -> Dict:
+    def fetch():
+        return get_storage().get_practice(record_id, "question,evaluation") or {}
+
+    try:
+        return get_data_cache().get_or_load(("practice_heavy", record_id), ("practice_history",), fetch)
+    except Exception as e:
+        st.error(f"读取练习记录失败: {str(e)}")
+        return {}
 
 # 保存练习记录
-def save_practice(record: Dict, update_record_id: str = None):
+def save_practice(record: Dict, update_record_id: str = None) -> Optional[str]:
+    """新记录和更新都进写后队列；新记录立即返回 record_id，更新会等一会儿让页面读到新结果"""
     try:
         if update_record_id:
-            # 更新已有记录
-            supabase.table("practice_history").update({
-                "mode": record.get("mode"),
-                "question": record.get("question"),
-                "user_answer": record.get("user_answer"),
-                "evaluation": record.get("evaluation"),
-                "timestamp": record.get("timestamp", datetime.now().isoformat())
-            }).eq("record_id", update_record_id).execute()
-        else:
-            # 创建新记录
-            record["record_id"] = f"{datetime.now().timestamp()}"
-            record["timestamp"] = datetime.now().isoformat()
-            supabase.table("practice_history").insert({
-                "record_id": record["record_id"],
+            # 更新排在这条记录的新增后面，记录还在队列里也不会丢
+            get_write_queue().enqueue_update("practice_history", update_record_id, {
                 "mode": record.get("mode"),
                 "question": record.get("question"),
                 "user_answer": record.get("user_answer"),
                 "evaluation": record.get("evaluation"),
-                "timestamp": record["timestamp"]
-            }).execute()
+                "timestamp": record.get("timestamp", datetime.now().isoformat()),
+                # 命中缓存时为 None，清掉旧批改的长度，避免用过期数据估算 max_tokens
+                "completion_tokens": record.get("completion_tokens")
+            })
+            _wait_for_write_queue()
+            return update_record_id
+        # 创建新记录
+        record["record_id"] = record.get("record_id") or new_record_id()
+        record["timestamp"] = datetime.now().isoformat()
+        get_write_queue().enqueue("practice_history", [{
+            "record_id": record["record_id"],
+            "mode": record.get("mode"),
+            "question": record.get("question"),
+            "user_answer": record.get("user_answer"),
+            "evaluation": record.get("evaluation"),
+            "timestamp": record["timestamp"],
+            "completion_tokens": record.get("completion_tokens")
+        }])
+        return record["record_id"]
     except Exception as e:
         st.error(f"保存练习记录失败: {str(e)}")
+        return None
+
+# 从日期集合计算连续练习天数（今天还没练习时从昨天算起）
+def _compute_streak(days: set, today: date) -> int:
+    current = today if today in days else today - timedelta(days=1)
+    streak = 0
+    while current in days:
+        streak += 1
+        current -= timedelta(days=1)
+    return streak
+
+# 读取练习统计：总练习数、练习天数、连续天数、各类薄弱点数量
+def load_practice_stats() -> Dict:
+    today = date.today()
+
+    def fetch():
+        return get_storage().practice_stats(today)
 
-# 保存每日题目
-def save_daily_question(date_str: str, question: Dict):
     try:
-        # 检查是否已存在
-        response = supabase.table("daily_questions").select("*").eq("date_str", date_str).execute()
-        if response.data:
-            # 更新
-            supabase.table("daily_questions").update({
-                "question": question,
-                "timestamp": datetime.now().isoformat()
-            }).eq("date_str", date_str).execute()
-        else:
-            # 插入
-            supabase.table("daily_questions").insert({
-                "date_str": date_str,
-                "question": question,
-                "timestamp": datetime.now().isoformat()
-            }).execute()
+        return get_data_cache().get_or_load(("stats", today.isoformat()), ("practice_history", "weakness_points"), fetch)
     except Exception as e:
-        st.error(f"保存每日题目失败: {str(e)}")
+        st.error(f"读取练习统计失败: {str(e)}")
+        return {
+            "total_practices": 0,
+            "practice_days": 0,
+            "streak": 0,
+            "weakness_total": 0,
+            "weakness_by_type": {},
+            "mode_counts": {}
+        }
+
+# 写入每日题目：按 date_str 一次 upsert（出错时抛出异常，后台线程也可以调用）
+def upsert_daily_question(date_str: str, question: Dict):
+    try:
+        get_storage().upsert_daily_question({
+            "date_str": date_str,
+            "question": question,
+            "timestamp": datetime.now().isoformat()
+        })
+    finally:
+        get_data_cache().invalidate("daily_questions")
 
 # 加载每日题目
 def load_daily_question(date_str: str) -> Optional[Dict]:
+    def fetch():
+        row = get_storage().get_daily_question(date_str)
+        return row.get("question") if row else None
+
     try:
-        response = supabase.table("daily_questions").select("*").eq("date_str", date_str).execute()
-        if response.data and len(response.data) > 0:
-            return response.data[0].get("question")
-        return None
+        return get_data_cache().get_or_load(("daily_questions", date_str), ("daily_questions",), fetch)
     except Exception as e:
         st.error(f"加载每日题目失败: {str(e)}")
         return None
@@ -348,466 +1950,904 @@ def get_today_mode() -> str:
     today = date.today().weekday()
     return WRITING_MODES[today]
 
-# 生成题目
-def generate_question(mode: str, weakness_points: List[Dict] = None) -> Dict:
-    mode_prompts = {
-        "Phrase Practice": f"""请生成一个CET4水平的短语造句题目。每次生成必须完全不同，不要重复之前的题目。
-要求：
-1. 给出1-2个CET4写作常用短语或搭配（如：in addition、as a result、pay attention to等）
-2. 要求学生用给定的短语造句
-3. 短语场景要多样化，涵盖学习、生活、工作、环境等不同主题
-4. 每次选择不同的短语
-5. 建议作答时间：3-5分钟
-6. 造句约10-20词
-
-返回JSON格式：
-{{
-    "phrases": ["短语1", "短语2（可选）"],
-    "hint": "提示信息（可以给一个造句场景或主题建议）"
-}}""",
-
-        "Translation": f"""请生成一个CET4水平的英译中题目。每次生成必须完全不同，不要重复之前的题目。
-要求：
-1. 中文句子表达常见场景（学习、生活、工作）
-2. 包含2-3个重点词汇或短语
-3. 适合CET4词汇水平
-4. 场景要多样化，不要重复
-5. 建议作答时间：5-8分钟
-6. 翻译后英文约15-25词
-
-返回JSON格式：
-{{
-    "chinese_sentence": "中文句子",
-    "key_words": ["重点词1", "重点词2"],
-    "hint": "提示信息"
-}}""",
-
-        "Transition Practice": f"""请生成一个CET4水平的过渡练习题目。每次生成必须完全不同，不要重复之前的题目。
-要求：
-1. 给出两个独立的句子片段或观点
-2. 要求学生用合适的过渡词/过渡句连接起来
-3. 过渡词要多样化（如：however、therefore、in addition、on the other hand等）
-4. 场景要多样化，不要重复
-5. 建议作答时间：3-5分钟
-6. 连接后约20-30词
-
-返回JSON格式：
-{{
-    "part1": "第一部分句子",
-    "part2": "第二部分句子",
-    "hint": "提示可能的过渡词类型"
-}}""",
-
-        "Sentence Structure": f"""请生成一个CET4水平的句式练习题目。每次生成必须完全不同，不要重复之前的题目。
-要求：
-1. 给出一个常用句型结构（如：It is...that...、There is no doubt that...、Not only...but also...、It is universally acknowledged that...等）
-2. 要求学生用这个句型造句
-3. 句型要多样化，每次选择不同的句型
-4. 建议作答时间：3-5分钟
-5. 造句约15-25词
-
-返回JSON格式：
-{{
-    "structure": "句型结构",
-    "structure_example": "句型示例（可选）",
-    "hint": "提示信息（可以给一个造句主题）"
-}}""",
-
-        "Sentence Variety": f"""请生成一个CET4水平的句式多样性题目。每次生成必须完全不同，不要重复之前的题目。
-要求：
-1. 给出一个普通句型
-2. 要求学生改写成特定句型（如：倒装句、强调句、被动语态、虚拟语气等）
-3. 句型转换类型要多样化
-4. 内容场景要多样化
-5. 建议作答时间：5-7分钟
-6. 改写后句子约15-25词
-
-返回JSON格式：
-{{
-    "original_sentence": "原句",
-    "target_type": "目标句型（如倒装句/强调句/被动语态等）",
-    "hint": "提示信息"
-}}""",
-
-        "Sentence Correction": f"""请生成一个CET4水平的病句题目。每次生成必须完全不同，不要重复之前的题目。
-要求：
-1. 句子长度15-25词
-2. 包含常见的语法错误（如时态、主谓一致、冠词、介词等）
-3. 错误要隐蔽但有迹可循
-4. 内容要多样化，涵盖学习、生活、工作等不同场景
-5. 建议作答时间：3-5分钟
-
-返回JSON格式：
-{{
-    "question": "包含错误的句子",
-    "error_type": "错误类型",
-    "hint": "提示信息（不直接给出答案）"
-}}""",
-
-        "Paraphrasing": f"""请生成一个CET4水平的改写题目。每次生成必须完全不同，不要重复之前的题目。
-要求：
-1. 给出一个表达清晰的句子
-2. 要求学生换一种方式表达相同意思
-3. 使用不同的词汇或句式
-4. 句子内容要多样化，不要重复
-5. 建议作答时间：5-8分钟
-6. 改写后句子约15-25词
-
-返回JSON格式：
-{{
-    "original_sentence": "原句",
-    "hint": "提示信息（如可以使用的同义词或句型）"
-}}"""
-    }    
-    prompt = mode_prompts.get(mode, mode_prompts["Sentence Correction"])
-    
+# 去掉模型输出外层的 markdown 代码块标记
+def strip_code_fence(content: str) -> str:
+    content = content.strip()
+    if content.startswith("```json"):
+        content = content[7:]
+    if content.startswith("```"):
+        content = content[3:]
+    if content.endswith("```"):
+        content = content[:-3]
+    return content
+
+# 取出第一个完整的 JSON 对象；输出被截断时返回从第一个 { 开始的全部内容
+def extract_json_object(text: str) -> str:
+    start = text.find("{")
+    if start == -1:
+        return text
+    depth = 0
+    in_string = False
+    escape = False
+    for i in range(start, len(text)):
+        ch = text[i]
+        if in_string:
+            if escape:
+                escape = False
+            elif ch == "\\":
+                escape = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch in "{[":
+            depth += 1
+        elif ch in "}]":
+            depth -= 1
+            if depth == 0:
+                return text[start:i + 1]
+    return text[start:]
+
+# 修复常见的 JSON 问题：中文引号当分隔符、末尾多余逗号、输出被截断
+def repair_json(text: str) -> str:
+    out = []
+    stack = []
+    in_string = False
+    curly_string = False   # 当前字符串是用中文引号开头的
+    escape = False
+    want_key = False       # 当前对象里下一个字符串是键
+    string_is_key = False
+    dangling_key = False   # 键已经写完，但后面还没有冒号
+    for i, ch in enumerate(text):
+        if in_string:
+            # 中文引号开头的字符串，遇到后面紧跟 : , } ] 的中文引号才算结束；
+            # 普通引号开头的字符串里的中文引号是内容，原样保留
+            if curly_string and ch in "“”" and text[i + 1:].lstrip()[:1] in ("", ":", ",", "}", "]"):
+                ch = '"'
+            out.append(ch)
+            if escape:
+                escape = False
+            elif ch == "\\":
+                escape = True
+            elif ch == '"':
+                in_string = False
+                dangling_key = string_is_key
+            continue
+        if ch in "“”":
+            # 字符串外的中文引号只可能是被当成了 JSON 引号
+            ch = '"'
+            curly_string = True
+        elif ch == '"':
+            curly_string = False
+        if ch == '"':
+            in_string = True
+            string_is_key = want_key
+            want_key = False
+        elif ch == ",":
+            # 后面紧跟 } 或 ] 的逗号是多余的
+            rest = text[i + 1:].lstrip()
+            if rest[:1] in ("}", "]"):
+                continue
+            want_key = bool(stack) and stack[-1] == "{"
+        elif ch == ":":
+            dangling_key = False
+        elif ch in "{[":
+            stack.append(ch)
+            want_key = ch == "{"
+        elif ch in "}]":
+            if stack:
+                stack.pop()
+            want_key = False
+        out.append(ch)
+
+    # 被截断：补全未结束的字符串、悬空的键和未闭合的括号
+    if in_string:
+        if escape:
+            out.pop()
+        out.append('"')
+        dangling_key = string_is_key
+    repaired = "".join(out).rstrip()
+    if dangling_key:
+        repaired += ": null"
+    elif repaired.endswith(":"):
+        repaired += " null"
+    elif repaired.endswith(","):
+        repaired = repaired[:-1]
+    for opener in reversed(stack):
+        repaired += "}" if opener == "{" else "]"
+    return repaired
+
+# 批改结果的校验规则 {字段: (类型, 是否必填)}：只校验代码真正读取的字段，其余字段原样保留、展示时再兼容
+EVALUATION_SCHEMA = {
+    "summary": (str, True),
+    "details": (list, False)
+}
+
+# 题目的校验规则：各题型必须有 QUESTION_REQUIRED_FIELDS 里的字段，类型不限
+def question_schema(mode: str) -> Dict:
+    return {field: (object, True) for field in QUESTION_REQUIRED_FIELDS.get(mode, ())}
+
+# 按校验规则检查解析结果，返回问题描述，没问题时返回空列表
+def validate_json(data, schema: Optional[Dict]) -> List[str]:
+    if not isinstance(data, dict):
+        return ["返回的不是 JSON 对象"]
+    problems = []
+    for key, (value_type, required) in (schema or {}).items():
+        if key not in data or data[key] in (None, "", [], {}):
+            if required:
+                problems.append(f"缺少字段 {key}")
+        elif not isinstance(data[key], value_type):
+            problems.append(f"字段 {key} 类型应为 {value_type.__name__}")
+    return problems
+
+# 本地解析：提取、直接解析，不行再修复后解析
+def _parse_json_locally(content: str, schema: Optional[Dict]) -> Dict:
+    text = extract_json_object(strip_code_fence(content))
     try:
-        response = client.chat.completions.create(
-            model="qwen-max",
-            messages=[
-                {"role": "system", "content": "你是一个专业的英语教学助手，专门帮助CET4学生提升写作能力。请严格按照JSON格式返回。每次生成题目时都要确保内容完全不同，不要重复。"},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.9,
-            max_tokens=500
-        )
-        
-        content = response.choices[0].message.content.strip()
-        # 清理可能的 markdown 代码块标记
-        if content.startswith("```json"):
-            content = content[7:]
-        if content.startswith("```"):
-            content = content[3:]
-        if content.endswith("```"):
-            content = content[:-3]
-        
-        return json.loads(content)
+        data = json.loads(text)
+    except ValueError:
+        data = json.loads(repair_json(text))
+    problems = validate_json(data, schema)
+    if problems:
+        raise ValueError("；".join(problems))
+    return data
+
+# 解析模型返回的 JSON；本地修复不了时，只发一个便宜的"修复 JSON"请求，不重新生成
+def parse_llm_json(content: str, schema: Optional[Dict] = None, allow_llm_fix: bool = True) -> Dict:
+    try:
+        return _parse_json_locally(content, schema)
+    except ValueError as e:
+        if not allow_llm_fix:
+            raise
+        error = str(e)
+
+    fields = ", ".join(
+        f"{key}{'' if required else '（可选）'}{'' if value_type is object else f': {value_type.__name__}'}"
+        for key, (value_type, required) in (schema or {}).items()
+    )
+    fixed = get_llm_gateway().complete(
+        model=get_setting("LLM_REPAIR_MODEL", "qwen-turbo"),
+        messages=[
+            {"role": "system", "content": "你是 JSON 修复工具。只输出修复后的 JSON 对象，不要任何解释，不要改动内容含义。"},
+            {"role": "user", "content": f"下面的 JSON 有问题（{error}）。需要的字段：{fields or '保持原有字段'}。\n\n{content}"}
+        ],
+        temperature=0,
+        max_tokens=1200
+    )
+    return _parse_json_locally(fixed, schema)
+
+# 模板只在进程里编译一次，不随每次 rerun 重建
+@st.cache_resource
+def get_prompt_registry() -> PromptRegistry:
+    registry = PromptRegistry()
+    for mode, text in QUESTION_PROMPTS.items():
+        registry.register("question", mode, f"{QUESTION_PROMPT_PREFIX}\n{text}", question_schema(mode))
+    for mode, text in EVALUATION_PROMPTS.items():
+        registry.register("evaluation", mode, text, EVALUATION_SCHEMA, EVALUATION_INSTRUCTIONS[mode])
+    return registry
+
+# 输出长度预算：按 (用途, 题型) 从实际输出长度学习 max_tokens
+class GenerationBudget:
+    """每个 (用途, 题型) 保留最近 window 次输出的 token 数，max_tokens 取 p95 × margin，限制在 [下限, 上限]；
+    样本不足 min_samples 时用默认值（有更长的样本时取最长的）。输出被截断（JSON 没闭合且接近上限）时按上限的 1.5 倍记，下次自动放宽"""
+
+    # 用途 -> (默认值, 下限, 上限)
+    LIMITS = {
+        "question": (500, 200, 1000),
+        "evaluation": (800, 300, 2000)
+    }
+
+    def __init__(self, path: str, window: int = 50, min_samples: int = 5, margin: float = 1.3):
+        self.path = path
+        self.window = window
+        self.min_samples = min_samples
+        self.margin = margin
+        self._lock = threading.Lock()
+        self._samples: Dict[str, List[int]] = {}
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                self._samples.update(json.load(f))
+        except (OSError, ValueError):
+            pass
+
+    def _save(self):
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self._samples, f)
+            os.replace(tmp_path, self.path)
+        except OSError:
+            pass
+
+    def sample_count(self, kind: str, mode: str) -> int:
+        with self._lock:
+            return len(self._samples.get(f"{kind}|{mode}", []))
+
+    def seed(self, kind: str, mode: str, values: List[int]):
+        """用历史记录里的输出长度补样本（values 从旧到新），不写文件"""
+        key = f"{kind}|{mode}"
+        with self._lock:
+            samples = [int(v) for v in values if v] + self._samples.get(key, [])
+            self._samples[key] = samples[-self.window:]
+
+    def max_tokens(self, kind: str, mode: str) -> int:
+        default, floor, ceiling = self.LIMITS[kind]
+        with self._lock:
+            samples = sorted(self._samples.get(f"{kind}|{mode}", []))
+        if len(samples) < self.min_samples:
+            # 样本少时只放宽不收紧，刚被截断过就马上生效
+            return min(ceiling, max([default] + samples))
+        p95 = samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+        return max(floor, min(ceiling, int(p95 * self.margin) + 50))
+
+    def observe(self, kind: str, mode: str, text: str, max_tokens: int, closed: bool) -> int:
+        """记下一次输出，返回记入的 token 数（本地估算）"""
+        tokens = estimate_tokens(text)
+        if not closed and tokens >= max_tokens * 0.8:
+            tokens = int(max_tokens * 1.5)
+        key = f"{kind}|{mode}"
+        with self._lock:
+            samples = self._samples.setdefault(key, [])
+            samples.append(tokens)
+            del samples[:-self.window]
+            self._save()
+        return tokens
+
+@st.cache_resource
+def get_generation_budget() -> GenerationBudget:
+    budget = GenerationBudget(
+        path=os.path.join(CACHE_DIR, "generation_budget.json"),
+        window=int(get_setting("BUDGET_WINDOW", 50))
+    )
+    # 本地样本不够时，用练习记录里存的批改输出长度补上
+    try:
+        seeds: Dict[str, List[int]] = {}
+        for row in get_storage().recent_completion_tokens(budget.window * len(WRITING_MODES)):
+            seeds.setdefault(row.get("mode"), []).insert(0, row.get("completion_tokens"))
+        for mode, values in seeds.items():
+            if mode and budget.sample_count("evaluation", mode) < budget.min_samples:
+                budget.seed("evaluation", mode, values)
+    except Exception as e:
+        logger.warning("读取历史输出长度失败，使用默认 max_tokens: %s", e)
+    return budget
+
+# 增量 JSON 解析：边接收模型输出边取出已经完整的字段，顶层对象闭合时 closed 变为 True
+class JsonStreamParser:
+    """逐段喂入模型输出，出题和批改共用。顶层字符串字段（如 summary）一结束就产出 ("field", (key, value))，
+    details 数组里每个对象一闭合就产出 ("detail", obj)"""
+
+    def __init__(self):
+        self.text = ""
+        self.closed = False
+        self._pos = 0
+        self._stack: List[str] = []
+        self._in_string = False
+        self._escape = False
+        self._string_start = 0
+        self._expect_key = False
+        self._key = None
+        self._item_start = None
+
+    def feed(self, chunk: str) -> List[tuple]:
+        self.text += chunk
+        events = []
+        text = self.text
+        while self._pos < len(text) and not self.closed:
+            ch = text[self._pos]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                    if len(self._stack) == 1:
+                        value = json.loads(text[self._string_start:self._pos + 1])
+                        if self._expect_key:
+                            self._key = value
+                        elif self._key is not None:
+                            events.append(("field", (self._key, value)))
+            elif ch == '"':
+                if self._stack:
+                    self._in_string = True
+                    self._string_start = self._pos
+            elif ch in "{[":
+                if ch == "{" and self._stack == ["{", "["] and self._key == "details":
+                    self._item_start = self._pos
+                self._stack.append(ch)
+                self._expect_key = ch == "{" and len(self._stack) == 1
+            elif ch in "}]":
+                if self._stack:
+                    self._stack.pop()
+                if ch == "}" and self._item_start is not None and self._stack == ["{", "["]:
+                    try:
+                        events.append(("detail", json.loads(text[self._item_start:self._pos + 1])))
+                    except ValueError:
+                        pass
+                    self._item_start = None
+                if not self._stack:
+                    self.closed = True
+            elif len(self._stack) == 1:
+                if ch == ",":
+                    self._expect_key = True
+                elif ch == ":":
+                    self._expect_key = False
+            self._pos += 1
+        return events
+
+# 流式调用模型并在顶层 JSON 对象闭合时立即停止，返回 (输出文本, 记入预算的 token 数)；出错时直接抛出异常。
+# on_chunk 每收到一段输出调用一次，参数是这段输出里解析出的 ("field"/"detail", 数据) 列表（可能为空）
+def complete_json(kind: str, mode: str, messages: List[Dict], temperature: float, on_chunk: Optional[Callable[[List[tuple]], None]] = None) -> tuple:
+    budget = get_generation_budget()
+    max_tokens = budget.max_tokens(kind, mode)
+    response = get_llm_gateway().stream(
+        model="qwen-max",
+        messages=messages,
+        temperature=temperature,
+        max_tokens=max_tokens
+    )
+
+    parser = JsonStreamParser()
+    try:
+        for delta in response:
+            events = parser.feed(delta)
+            if on_chunk:
+                on_chunk(events)
+            if parser.closed:
+                break
+    finally:
+        # 提前关闭会取消还在进行的请求
+        response.close()
+
+    return parser.text, budget.observe(kind, mode, parser.text, max_tokens, parser.closed)
+
+# 调用模型生成题目，weakness_hint 是薄弱点画像给出的一句提示（出错时直接抛出异常，后台线程也可以调用）
+def request_question(mode: str, weakness_hint: str = "") -> Dict:
+    template = get_prompt_registry().get("question", mode)
+
+    content, _ = complete_json("question", mode, template.messages(suffix=weakness_hint), temperature=0.9)
+
+    return parse_llm_json(content, template.schema)
+
+# 各题型题目必须包含的字段
+QUESTION_REQUIRED_FIELDS = {
+    "Phrase Practice": ("phrases",),
+    "Translation": ("chinese_sentence",),
+    "Transition Practice": ("part1", "part2"),
+    "Sentence Structure": ("structure",),
+    "Sentence Variety": ("original_sentence", "target_type"),
+    "Sentence Correction": ("question",),
+    "Paraphrasing": ("original_sentence",)
+}
+
+# 检查题目字段是否齐全
+def is_valid_question(mode: str, question) -> bool:
+    return not validate_json(question, question_schema(mode))
+
+# 题目指纹：只看这种题型的关键字段（不含 hint 等说明文字），忽略大小写和空白，用来去重
+def question_fingerprint(mode: str, question: Dict) -> str:
+    key = [mode] + [question.get(field) for field in QUESTION_REQUIRED_FIELDS.get(mode, ())]
+    text = json.dumps(key, ensure_ascii=False).lower()
+    return hashlib.sha1("".join(text.split()).encode("utf-8")).hexdigest()
+
+# 本地缓存目录（题库等）
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache")
+
+# 预生成题库：后台线程为每种题型备好题目，点"新题目"时直接取
+class QuestionPool:
+    """题型的题目低于 refill_at 道时由后台线程补到 size 道，题目和最近出过的题目指纹存在本地文件。
+    只有今天的题型会主动补（启动时和换天后），其他题型要等有人从题库取过才开始补，
+    不会为一周里其他几天的题型提前调用模型"""
+
+    def __init__(self, size: int, refill_at: int, path: str, profile: WeaknessProfile, recent_limit: int = 200):
+        self.size = size
+        self.refill_at = refill_at
+        self.path = path
+        self.profile = profile
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._queues: Dict[str, List[Dict]] = {mode: [] for mode in WRITING_MODES.values()}
+        self._recent: deque = deque(maxlen=recent_limit)
+        # 取过题的题型，之后也保持补满
+        self._demanded: set = set()
+        self._load()
+        self._wakeup.set()
+        threading.Thread(target=self._run, name="question-pool", daemon=True).start()
+
+    def _load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        for mode, questions in data.get("queues", {}).items():
+            if mode in self._queues:
+                self._queues[mode] = [q for q in questions if is_valid_question(mode, q)][:self.size]
+        self._recent.extend(data.get("recent", []))
+
+    def _save(self):
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"queues": self._queues, "recent": list(self._recent)}, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+        except OSError:
+            # 本地文件只是为了重启后少生成几道题，写不了也不影响使用
+            pass
+
+    def pop(self, mode: str) -> Optional[Dict]:
+        with self._lock:
+            self._demanded.add(mode)
+            queue = self._queues.get(mode)
+            if not queue:
+                question = None
+            else:
+                question = queue.pop(0)
+                self._recent.append(question_fingerprint(mode, question))
+                self._save()
+            if len(queue or []) < self.refill_at:
+                self._wakeup.set()
+        return question
+
+    def remember(self, mode: str, question: Dict):
+        """记下不是从题库取出的题目，之后补题时避开它"""
+        with self._lock:
+            self._recent.append(question_fingerprint(mode, question))
+            self._save()
+
+    def _modes_to_fill(self) -> List[str]:
+        # 今天的题型优先补，其他题型只补取过题的
+        today = get_today_mode()
+        with self._lock:
+            modes = [today] + [m for m in WRITING_MODES.values() if m != today and m in self._demanded]
+            return [mode for mode in modes if len(self._queues[mode]) < self.refill_at]
+
+    def _fill(self, mode: str):
+        attempts = 0
+        while attempts < self.size * 2:
+            with self._lock:
+                if len(self._queues[mode]) >= self.size:
+                    return
+            attempts += 1
+            try:
+                hint = self.profile.prompt_hint(mode)
+            except Exception:
+                hint = ""
+            question = request_question(mode, hint)
+            if not is_valid_question(mode, question):
+                continue
+            fingerprint = question_fingerprint(mode, question)
+            with self._lock:
+                pooled = {question_fingerprint(mode, q) for q in self._queues[mode]}
+                if fingerprint in pooled or fingerprint in self._recent:
+                    continue
+                self._queues[mode].append(question)
+                self._save()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(timeout=300)
+            self._wakeup.clear()
+            for mode in self._modes_to_fill():
+                try:
+                    self._fill(mode)
+                except Exception:
+                    # 网络或模型出错时稍后再试；密钥、模型或提示词有问题时题库一直是空的，日志里要能看到原因
+                    logger.warning("预生成 %s 题目失败，30 秒后重试", mode, exc_info=True)
+                    time.sleep(30)
+                    break
+
+@st.cache_resource
+def get_question_pool() -> Optional[QuestionPool]:
+    size = int(get_setting("QUESTION_POOL_SIZE", 2))
+    if size <= 0:
+        return None
+    refill_at = min(int(get_setting("QUESTION_POOL_REFILL_AT", 1)), size)
+    return QuestionPool(size, refill_at, os.path.join(CACHE_DIR, "question_pool.json"), get_weakness_profile())
+
+# 取一道新题目：优先从题库取，题库空了再现场生成（出错时抛出异常）。
+# 薄弱点画像还没建立时不等它，这一题先不带薄弱点提示
+def take_question(mode: str) -> Dict:
+    pool = get_question_pool()
+    if pool:
+        question = pool.pop(mode)
+        if question:
+            return question
+    profile = get_weakness_profile()
+    question = request_question(mode, profile.prompt_hint(mode) if profile.loaded else "")
+    if pool:
+        pool.remember(mode, question)
+    return question
+
+# 后台线程池：并行取题和不阻塞页面的写入
+@st.cache_resource
+def get_background_executor() -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(max_workers=4, thread_name_prefix="cet4-background")
+
+# 后台任务出错时记日志（后台线程里不能用 st.error）
+def _log_background_error(future: Future):
+    error = future.exception()
+    if error:
+        logger.error("后台任务失败: %s", error)
+
+# 出新题：取题和建立薄弱点画像同时进行，拿到题目立刻返回，每日题目在后台保存
+def prepare_new_question(mode: str, date_str: Optional[str] = None) -> Optional[Dict]:
+    question_future = get_background_executor().submit(take_question, mode)
+    # 取题期间顺便建立薄弱点画像，之后出题就能带上薄弱点提示
+    try:
+        get_weakness_profile().ensure_loaded()
+    except Exception as e:
+        logger.warning("建立薄弱点画像失败: %s", e)
+    try:
+        question = question_future.result()
     except Exception as e:
         st.error(f"生成题目失败: {str(e)}")
         return None
+    if date_str:
+        get_background_executor().submit(upsert_daily_question, date_str, question).add_done_callback(_log_background_error)
+    return question
+
+# 提交前的本地预检：不调模型，几微秒内拦下空答案、原句照抄等明显问题
+ENGLISH_WORD_PATTERN = re.compile(r"[a-zA-Z]+(?:['-]?[a-zA-Z]+)*")
+CHINESE_CHAR_PATTERN = re.compile(r"[\u4e00-\u9fff]")
+WORD_RANGE_PATTERN = re.compile(r"约(\d+)-(\d+)词|长度(\d+)-(\d+)词")
+# 短语/句型里的占位词，匹配时当作任意词
+PHRASE_PLACEHOLDERS = {"sb", "sth", "somebody", "something", "one's", "oneself", "doing", "do", "adj", "n", "v"}
+# 和原句比对，判断有没有真正改写的题型及原句字段
+ORIGINAL_SENTENCE_FIELDS = {
+    "Paraphrasing": "original_sentence",
+    "Sentence Variety": "original_sentence",
+    "Sentence Correction": "question"
+}
 
-# 批改用户答案
-def evaluate_answer(mode: str, question: Dict, user_answer: str, record_id: str = None, auto_save_weakness: bool = True) -> Dict:
-    mode_prompts = {
-        "Phrase Practice": f"""请批改以下短语造句题目。
-
-短语：{', '.join(question.get('phrases', []))}
-用户造句：{user_answer}
-
-你是我同桌，用轻松亲切的中文口吻批改，多鼓励。给出参考造句和更多示例。
-如果用户造句中有错误或可以改进的地方，请在 details 中列出，包含：
-- type: 错误类型标签，严格按照以下规则分类：
-  * "注意"：语法错误（时态、主谓一致、冠词、介词等）或单词错误（拼写错误、用词错误、词汇选择不当等）
-  * "建议"：语法和单词都正确，仅仅是表达不够流畅、不够优美或可以更地道
-  * "其他"：不属于以上两种情况的问题
-- original_sentence: 用户句子中可以改进的部分（保持原样）
-- correction: 更好的表达建议，英文部分必须用英文表达
-
-返回JSON格式：
-{{
-    "summary": "整体评价（中文）",
-    "reference_sentence": "参考造句（英文）",
-    "high_score_expression": "更多示例（英文）",
-    "details": [
-        {{
-            "type": "注意/建议/其他",
-            "original_sentence": "用户句子中可以改进的部分",
-            "correction": "更好的表达建议（英文部分用英文）"
-        }}
-    ]
-}}""",
-
-        "Translation": f"""请批改以下翻译题目。
-
-中文句子：{question.get('chinese_sentence', '')}
-重点词汇：{', '.join(question.get('key_words', []))}
-用户答案：{user_answer}
-
-你是我同桌，用轻松亲切的中文口吻批改，多鼓励。给出参考译文和高分表达。
-如果用户答案中有错误或可以改进的地方，请在 details 中列出，包含：
-- type: 错误类型标签，严格按照以下规则分类：
-  * "注意"：语法错误（时态、主谓一致、冠词、介词等）或单词错误（拼写错误、用词错误、词汇选择不当等）
-  * "建议"：语法和单词都正确，仅仅是表达不够流畅、不够优美或可以更地道
-  * "其他"：不属于以上两种情况的问题
-- original_sentence: 用户有问题的原句片段（保持原样）
-- correction: 修改建议，英文部分必须用英文表达，中文部分用中文表达
-
-返回JSON格式：
-{{
-    "summary": "整体评价（中文）",
-    "reference_translation": "参考译文（英文）",
-    "high_score_expression": "高分表达（英文）",
-    "details": [
-        {{
-            "type": "注意/建议/其他",
-            "original_sentence": "用户有问题的原句片段",
-            "correction": "修改建议（英文部分用英文，中文部分用中文）"
-        }}
-    ]
-}}""",
-
-        "Transition Practice": f"""请批改以下过渡练习题目。
-
-第一部分：{question.get('part1', '')}
-第二部分：{question.get('part2', '')}
-用户答案：{user_answer}
-
-你是我同桌，用轻松亲切的中文口吻批改，多鼓励。给出参考答案和更多过渡词选择。
-如果用户答案中的过渡词使用可以改进，请在 details 中列出，包含：
-- type: 错误类型标签，严格按照以下规则分类：
-  * "注意"：语法错误（时态、主谓一致、冠词、介词等）或单词错误（拼写错误、用词错误、词汇选择不当等）
-  * "建议"：语法和单词都正确，仅仅是表达不够流畅、不够优美或可以更地道
-  * "其他"：不属于以上两种情况的问题
-- original_sentence: 用户的原句（保持原样）
-- correction: 更好的过渡词选择和解释，英文部分必须用英文表达
-
-返回JSON格式：
-{{
-    "summary": "整体评价（中文）",
-    "reference_answer": "参考答案（英文）",
-    "high_score_expression": "更多过渡词（英文）",
-    "details": [
-        {{
-            "type": "注意/建议/其他",
-            "original_sentence": "用户的原句",
-            "correction": "更好的过渡词选择和解释（英文部分用英文）"
-        }}
-    ]
-}}""",
-
-        "Sentence Structure": f"""请批改以下句式练习题目。
-
-句型结构：{question.get('structure', '')}
-用户造句：{user_answer}
-
-你是我同桌，用轻松亲切的中文口吻批改，多鼓励。给出参考造句和更多示例。
-如果用户造句中有错误或可以改进的地方，请在 details 中列出，包含：
-- type: 错误类型标签，严格按照以下规则分类：
-  * "注意"：语法错误（时态、主谓一致、冠词、介词等）或单词错误（拼写错误、用词错误、词汇选择不当等）
-  * "建议"：语法和单词都正确，仅仅是表达不够流畅、不够优美或可以更地道
-  * "其他"：不属于以上两种情况的问题
-- original_sentence: 用户句子中可以改进的部分（保持原样）
-- correction: 更好的表达建议，英文部分必须用英文表达
-
-返回JSON格式：
-{{
-    "summary": "整体评价（中文）",
-    "reference_sentence": "参考造句（英文）",
-    "high_score_expression": "更多示例（英文）",
-    "details": [
-        {{
-            "type": "注意/建议/其他",
-            "original_sentence": "用户句子中可以改进的部分",
-            "correction": "更好的表达建议（英文部分用英文）"
-        }}
-    ]
-}}""",
-
-        "Sentence Variety": f"""请批改以下句式多样性题目。
-
-原句：{question.get('original_sentence', '')}
-目标句型：{question.get('target_type', '')}
-用户答案：{user_answer}
-
-你是我同桌，用轻松亲切的中文口吻批改，多鼓励。给出参考答案和其他转换方式。
-如果用户答案中的句式转换可以改进，请在 details 中列出，包含：
-- type: 错误类型标签，严格按照以下规则分类：
-  * "注意"：语法错误（时态、主谓一致、冠词、介词等）或单词错误（拼写错误、用词错误、词汇选择不当等）
-  * "建议"：语法和单词都正确，仅仅是表达不够流畅、不够优美或可以更地道
-  * "其他"：不属于以上两种情况的问题
-- original_sentence: 用户的原句（保持原样）
-- correction: 更好的转换方式和解释，英文部分必须用英文表达
-
-返回JSON格式：
-{{
-    "summary": "整体评价（中文）",
-    "reference_answer": "参考答案（英文）",
-    "high_score_expression": "其他方式（英文）",
-    "details": [
-        {{
-            "type": "注意/建议/其他",
-            "original_sentence": "用户的原句",
-            "correction": "更好的转换方式和解释（英文部分用英文）"
-        }}
-    ]
-}}""",
-
-        "Sentence Correction": f"""请批改以下句子改错题目。
-
-原句（包含错误）：{question.get('question', '')}
-错误类型：{question.get('error_type', '')}
-用户改写后的答案：{user_answer}
-
-你是我同桌，用轻松亲切的中文口吻批改，多鼓励。请判断用户是否正确改出了原句中的错误。给出正确答案和高分表达。
-
-重要提示：你需要对比用户改写后的答案和正确的改写答案，判断用户的改写是否完全正确。
-
-如果用户改写后仍然有错误（没有完全改对，或者改写时引入了新的错误），请在 details 中列出每个问题，包含：
-- type: 错误类型标签，严格按照以下规则分类：
-  * "注意"：语法错误（时态、主谓一致、冠词、介词等）或单词错误（拼写错误、用词错误、词汇选择不当等）。这是四级作文一定会扣分的错误，必须改。
-  * "建议"：语法和单词都正确，仅仅是表达不够流畅、不够优美或可以更地道。不改也没问题，但改了会更好。
-  * "其他"：不属于以上两种情况的问题
-- original_sentence: 用户改写后仍然错误或可以改进的部分（保持原样）
-- correction: 正确的改法或更好的表达，英文部分必须用英文表达，中文部分用中文表达
-
-如果用户完全改对了，details 可以为空列表。
-
-返回JSON格式：
-{{
-    "summary": "整体评价（中文），说明用户是否正确改出了错误",
-    "correct_answer": "正确答案（英文）",
-    "high_score_expression": "高分表达（英文）",
-    "details": [
-        {{
-            "type": "注意/建议/其他",
-            "original_sentence": "用户改写后仍然错误或可以改进的部分",
-            "correction": "正确的改法或更好的表达（英文部分用英文，中文部分用中文）"
-        }}
-    ]
-}}""",
-
-        "Paraphrasing": f"""请批改以下改写题目。
-
-原句：{question.get('original_sentence', '')}
-用户答案：{user_answer}
-
-你是我同桌，用轻松亲切的中文口吻批改，多鼓励。给出参考改写和更好的改写方式。
-如果用户答案中的改写可以改进，请在 details 中列出，包含：
-- type: 错误类型标签，严格按照以下规则分类：
-  * "注意"：语法错误（时态、主谓一致、冠词、介词等）或单词错误（拼写错误、用词错误、词汇选择不当等）
-  * "建议"：语法和单词都正确，仅仅是表达不够流畅、不够优美或可以更地道
-  * "其他"：不属于以上两种情况的问题
-- original_sentence: 用户的改写（保持原样）
-- correction: 更好的改写方式和解释，英文部分必须用英文表达
-
-返回JSON格式：
-{{
-    "summary": "整体评价（中文）",
-    "reference_paraphrase": "参考改写（英文）",
-    "high_score_expression": "更好的方式（英文）",
-    "details": [
-        {{
-            "type": "注意/建议/其他",
-            "original_sentence": "用户的改写",
-            "correction": "更好的改写方式和解释（英文部分用英文）"
-        }}
-    ]
-}}"""
-    }
-    
-    prompt = mode_prompts.get(mode, mode_prompts["Sentence Correction"])
-    
-    try:
-        response = client.chat.completions.create(
-            model="qwen-max",
-            messages=[
-                {"role": "system", "content": "你是一个专业的英语教学助手，专门帮助CET4学生提升写作能力。请严格按照JSON格式返回。"},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.7,
-            max_tokens=800
-        )
-        
-        content = response.choices[0].message.content.strip()
-        if content.startswith("```json"):
-            content = content[7:]
-        if content.startswith("```"):
-            content = content[3:]
-        if content.endswith("```"):
-            content = content[:-3]
-        
-        result = json.loads(content)
-
-        # 保存薄弱点 - 从 details 中提取信息
-        if auto_save_weakness and result.get("details"):
-            for detail in result["details"]:
-                original = detail.get("original_sentence", "")
-                correction = detail.get("correction", "")
-                type_tag = detail.get("type", "其他")
-
-                # 如果新格式有数据，使用新格式
-                if original and correction:
-                    # 使用AI生成的type标签
-                    save_weakness_point({
-                        "type": type_tag,
-                        "issue": original,
-                        "correction": correction,
-                        "mode": mode
-                    }, record_id=record_id)
-                # 兼容旧格式（comment 字段）
-                elif detail.get("comment"):
-                    comment = detail.get("comment", "")
-                    # 旧格式需要自己分类
-                    type_str = "其他"
-
-                    # 语法错误相关关键词 -> 归类到"注意"
-                    grammar_keywords = [
-                        "语法", "拼写", "时态", "主谓一致", "冠词", "介词", "动词", "名词",
-                        "形容词", "副词", "错误", "应为", "应该是", "注意", "拼写错误",
-                        "语法错误", "时态错误", "主谓不一致"
-                    ]
-                    for keyword in grammar_keywords:
-                        if keyword in comment:
-                            type_str = "注意"
-                            break
-
-                    # 表达相关关键词 -> 归类到"建议"
-                    if type_str == "其他":
-                        expression_keywords = [
-                            "建议", "更好的表达", "可以改为", "表达", "流畅", "优美",
-                            "更符合", "习惯", "地道", "高级", "改写"
-                        ]
-                        for keyword in expression_keywords:
-                            if keyword in comment:
-                                type_str = "建议"
-                                break
+def count_english_words(text: str) -> int:
+    return len(ENGLISH_WORD_PATTERN.findall(text))
+
+# 从出题提示词里读出作答字数范围，如"造句约10-20词"
+def _answer_length_bounds() -> Dict[str, tuple]:
+    bounds = {}
+    for mode, prompt in QUESTION_PROMPTS.items():
+        match = WORD_RANGE_PATTERN.search(prompt)
+        if match:
+            low, high = [int(g) for g in match.groups() if g]
+            bounds[mode] = (low, high)
+    return bounds
+
+ANSWER_LENGTH_BOUNDS = _answer_length_bounds()
+
+# 短语里常见的不规则动词
+IRREGULAR_FORMS = {
+    "be": ["be", "is", "am", "are", "was", "were", "been", "being"],
+    "have": ["have", "has", "had", "having"],
+    "do": ["do", "does", "did", "done", "doing"],
+    "take": ["take", "takes", "took", "taken", "taking"],
+    "make": ["make", "makes", "made", "making"],
+    "get": ["get", "gets", "got", "gotten", "getting"],
+    "give": ["give", "gives", "gave", "given", "giving"],
+    "come": ["come", "comes", "came", "coming"],
+    "go": ["go", "goes", "went", "gone", "going"],
+    "keep": ["keep", "keeps", "kept", "keeping"],
+    "bring": ["bring", "brings", "brought", "bringing"],
+    "think": ["think", "thinks", "thought", "thinking"],
+    "find": ["find", "finds", "found", "finding"],
+    "put": ["put", "puts", "putting"],
+    "set": ["set", "sets", "setting"]
+}
+IRREGULAR_LOOKUP = {form: forms for forms in IRREGULAR_FORMS.values() for form in forms}
+
+# 单词的宽松匹配：允许 -s/-ed/-ing 等词尾，pay 也能匹配 paid、make 也能匹配 making
+def _word_pattern(word: str) -> str:
+    if word in IRREGULAR_LOOKUP:
+        return r"\b(?:" + "|".join(IRREGULAR_LOOKUP[word]) + r")\b"
+    if word == "it":
+        return r"\bit\b"
+    if len(word) > 3 and word.endswith("e"):
+        stem = re.escape(word[:-1]) + "e?"
+    elif len(word) > 2 and word.endswith("y"):
+        stem = re.escape(word[:-1]) + "[yi]"
+    else:
+        stem = re.escape(word)
+    return r"\b" + stem + r"(?:s|es|d|ed|ing|ied)?\b"
+
+# 把短语或句型（如 "pay attention to sth."、"Not only...but also..."）编译成正则：
+# "..." 分开的片段按顺序出现，片段里的词允许屈折词尾，词之间最多插入两个词
+def _compile_phrase(phrase: str) -> Optional[re.Pattern]:
+    fragments = []
+    for fragment in re.split(r"\.{2,}|…+", phrase):
+        words = [
+            w for w in re.findall(r"[a-zA-Z']+", fragment.lower())
+            if w not in PHRASE_PLACEHOLDERS
+        ]
+        if words:
+            fragments.append(r"\W+(?:\w+\W+){0,2}?".join(_word_pattern(w) for w in words))
+    if not fragments:
+        return None
+    return re.compile(".*?".join(fragments), re.IGNORECASE | re.DOTALL)
+
+def _required_phrases(mode: str, question: Dict) -> List[str]:
+    if mode == "Phrase Practice":
+        return [p for p in question.get("phrases", []) if isinstance(p, str) and p.strip()]
+    if mode == "Sentence Structure" and question.get("structure"):
+        return [question["structure"]]
+    return []
+
+# 预检答案，返回 [{"level": "error"|"warning", "message": ...}]，有 error 时不送去批改
+def precheck_answer(mode: str, question: Dict, user_answer: str) -> List[Dict]:
+    issues = []
+    answer = user_answer.strip()
+    if not answer:
+        return [{"level": "error", "message": "请先输入你的答案！"}]
+
+    words = ENGLISH_WORD_PATTERN.findall(answer)
+    if not words:
+        return [{"level": "error", "message": "答案里没有英文单词，请用英文作答"}]
+
+    # 批改请求的输入 token（模板固定部分 + 题目和答案）超过上限时不发请求，避免粘贴长文浪费 qwen-max 的额度
+    prompt_tokens = get_prompt_registry().tokens("evaluation", mode) + sum(
+        estimate_tokens(str(value)) for value in prompt_fields(question, answer).values()
+    )
+    token_limit = int(get_setting("EVAL_PROMPT_TOKEN_LIMIT", 1500))
+    if prompt_tokens > token_limit:
+        issues.append({"level": "error", "message": f"答案太长（批改输入约 {prompt_tokens} tokens，上限 {token_limit}），请精简后再提交"})
+
+    chinese_chars = CHINESE_CHAR_PATTERN.findall(answer)
+    if chinese_chars:
+        if mode == "Translation":
+            issues.append({"level": "warning", "message": f"译文里还有 {len(chinese_chars)} 个汉字没有翻译：{''.join(chinese_chars[:10])}"})
+        else:
+            issues.append({"level": "warning", "message": "答案里夹杂了中文，批改时会按英文部分评分"})
+
+    field = ORIGINAL_SENTENCE_FIELDS.get(mode)
+    if field and question.get(field):
+        original_words = [w.lower() for w in ENGLISH_WORD_PATTERN.findall(question[field])]
+        if [w.lower() for w in words] == original_words:
+            if mode == "Sentence Correction":
+                issues.append({"level": "error", "message": "答案和病句完全一样，请先改正句子中的错误"})
+            else:
+                issues.append({"level": "error", "message": "答案和原句完全一样，请换一种方式表达"})
+
+    for phrase in _required_phrases(mode, question):
+        pattern = _compile_phrase(phrase)
+        if pattern and not pattern.search(answer):
+            label = "句型" if mode == "Sentence Structure" else "短语"
+            issues.append({"level": "warning", "message": f"没有找到要求的{label}「{phrase}」（如果用了不规则变形可以忽略）"})
+
+    bounds = ANSWER_LENGTH_BOUNDS.get(mode)
+    if bounds:
+        low, high = bounds
+        if len(words) < low:
+            issues.append({"level": "warning", "message": f"只有 {len(words)} 个单词，建议 {low}-{high} 词"})
+        elif len(words) > high * 2:
+            issues.append({"level": "warning", "message": f"有 {len(words)} 个单词，明显超出建议的 {low}-{high} 词"})
+
+    return issues
+
+# 重新归类旧格式薄弱点（薄弱点页的数据维护按钮），有改动时让缓存和画像重新统计
+def backfill_weakness_types(batch_size: int = 500) -> int:
+    changed = weakness_classifier.backfill_weakness_types(get_storage(), batch_size)
+    if changed:
+        get_data_cache().invalidate("weakness_points")
+        get_weakness_profile().reset()
+    return changed
+
+# 从批改结果的 details 中提取薄弱点
+def build_weakness_points(details: List[Dict], mode: str) -> List[Dict]:
+    points = []
+    for detail in details or []:
+        original = detail.get("original_sentence", "")
+        correction = detail.get("correction", "")
+        type_tag = detail.get("type", "其他")
+
+        # 如果新格式有数据，使用新格式
+        if original and correction:
+            # 使用AI生成的type标签
+            points.append({
+                "type": type_tag,
+                "issue": original,
+                "correction": correction,
+                "mode": mode
+            })
+        # 兼容旧格式（comment 字段），由关键词分类器归类并提取修改建议
+        elif detail.get("comment"):
+            comment = detail.get("comment", "")
+            result = COMMENT_CLASSIFIER.classify(comment)
+            points.append({
+                "type": result["type"],
+                "issue": comment,
+                "correction": result["correction"],
+                "mode": mode
+            })
+
+    return points
+
+# 构造批改请求的消息
+def build_evaluation_messages(mode: str, question: Dict, user_answer: str) -> List[Dict]:
+    return get_prompt_registry().get("evaluation", mode).messages(prompt_fields(question, user_answer))
+
+# 批改缓存键：题型 + 题目 JSON + 规范化后的答案（忽略大小写和多余空白）+ 批改模板版本号（改了提示词旧缓存自动失效）
+def evaluation_cache_key(mode: str, question: Dict, user_answer: str) -> str:
+    normalized_answer = " ".join(user_answer.split()).lower()
+    payload = json.dumps(
+        [get_prompt_registry().get("evaluation", mode).version, mode, question, normalized_answer],
+        ensure_ascii=False,
+        sort_keys=True
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+# 批改结果缓存：本地 LRU（存文件），可选 Supabase 表作为第二层
+class EvaluationCache:
+    """本地最多保留 capacity 条，按最近使用淘汰；use_storage 时本地未命中再查存储层的 evaluation_cache 表"""
+
+    def __init__(self, capacity: int, path: str, use_storage: bool):
+        self.capacity = capacity
+        self.path = path
+        self.use_storage = use_storage
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, Dict]" = OrderedDict()
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                self._entries.update(json.load(f))
+        except (OSError, ValueError):
+            pass
+
+    def _save(self):
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self._entries, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+        except OSError:
+            pass
+
+    def _put_local(self, key: str, evaluation: Dict):
+        with self._lock:
+            self._entries[key] = evaluation
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+            self._save()
+
+    def get(self, key: str) -> Optional[Dict]:
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+        if not self.use_storage:
+            return None
+        try:
+            evaluation = get_storage().get_cached_evaluation(key)
+        except Exception:
+            return None
+        if evaluation is None:
+            return None
+        self._put_local(key, evaluation)
+        return evaluation
+
+    def put(self, key: str, mode: str, evaluation: Dict):
+        self._put_local(key, evaluation)
+        if self.use_storage:
+            try:
+                get_storage().put_cached_evaluation({
+                    "cache_key": key,
+                    "mode": mode,
+                    "evaluation": evaluation
+                })
+            except Exception:
+                # 远端缓存写失败不影响批改结果
+                pass
+
+@st.cache_resource
+def get_evaluation_cache() -> EvaluationCache:
+    return EvaluationCache(
+        capacity=int(get_setting("EVAL_CACHE_SIZE", 500)),
+        path=os.path.join(CACHE_DIR, "evaluation_cache.json"),
+        use_storage=str(get_setting("EVAL_CACHE_SUPABASE", "")).lower() in ("1", "true", "yes")
+    )
 
-                    # 提取修改建议
-                    correction = ""
-                    suggestion_patterns = [
-                        "建议", "改为", "应该是", "可以改为", "更好的表达", "注意", "应为"
-                    ]
-
-                    for pattern in suggestion_patterns:
-                        idx = comment.find(pattern)
-                        if idx != -1:
-                            correction = comment[idx:].strip()
-                            break
-
-                    # 如果没有找到明显的建议关键词，尝试其他模式
-                    if not correction:
-                        # 尝试提取引号中的内容作为修改建议
-                        import re
-                        quoted_content = re.findall(r"'([^']+)'", comment)
-                        if len(quoted_content) >= 2:
-                            correction = f"改为 '{quoted_content[1]}'"
-                        elif len(quoted_content) == 1:
-                            correction = f"参考：'{quoted_content[0]}'"
-
-                    save_weakness_point({
-                        "type": type_str,
-                        "issue": comment,
-                        "correction": correction,
-                        "mode": mode
-                    }, record_id=record_id)
-
-        return result
+# 批改用户答案，use_cache=False 时强制重新批改（结果仍会写入缓存）。
+# 返回 (批改结果, 输出 token 数)，命中缓存时 token 数为 None，失败时返回 (None, None)
+def evaluate_answer(mode: str, question: Dict, user_answer: str, use_cache: bool = True) -> tuple:
+    try:
+        return evaluate_answer_stream(mode, question, user_answer, use_cache=use_cache)
     except Exception as e:
         st.error(f"批改失败: {str(e)}")
+        return None, None
+
+# 提交答案后保存薄弱点和练习记录，记下提交的答案和 record_id，刷新批改时用同一份答案
+def finish_submission(mode: str, record_id: str, user_answer: str, completion_tokens: Optional[int] = None):
+    st.session_state.submitted = True
+    st.session_state.user_answer = user_answer
+    evaluation = st.session_state.evaluation
+    if evaluation and evaluation.get("details"):
+        save_weakness_points(build_weakness_points(evaluation["details"], mode), record_id=record_id)
+    # 保存练习记录（新建记录，后台写入）
+    st.session_state.current_record_id = save_practice({
+        "record_id": record_id,
+        "mode": mode,
+        "question": st.session_state.question,
+        "user_answer": user_answer,
+        "evaluation": st.session_state.evaluation,
+        "completion_tokens": completion_tokens
+    })
+
+# 重新批改已提交的答案：成功时用新薄弱点替换旧的并覆盖练习记录里的批改结果，失败返回 None
+def refresh_evaluation(mode: str, question: Dict, user_answer: str, record_id: str = None, use_cache: bool = True) -> Optional[Dict]:
+    # 先获取新批改结果（不自动保存薄弱点）
+    new_evaluation, completion_tokens = evaluate_answer(mode, question, user_answer, use_cache=use_cache)
+    if not new_evaluation:
         return None
 
+    new_points = build_weakness_points(new_evaluation.get("details"), mode)
+    if not record_id:
+        save_weakness_points(new_points)
+        return new_evaluation
+    # 用新薄弱点替换旧薄弱点（一次事务）
+    replace_weakness_points(record_id, new_points)
+    # 更新历史记录，覆盖同一题目的批改结果
+    save_practice({
+        "mode": mode,
+        "question": question,
+        "user_answer": user_answer,
+        "evaluation": new_evaluation,
+        "completion_tokens": completion_tokens
+    }, update_record_id=record_id)
+    return new_evaluation
+
+# 流式批改：解析到的 ("field"/"detail", 数据) 逐个交给 on_event，JSON 闭合即停止接收；
+# 返回 (完整结果, 输出 token 数)，命中缓存时按同样的事件回放、token 数为 None；出错时直接抛出异常
+def evaluate_answer_stream(mode: str, question: Dict, user_answer: str, on_event: Optional[Callable[[str, object], None]] = None, use_cache: bool = True) -> tuple:
+    cache = get_evaluation_cache()
+    cache_key = evaluation_cache_key(mode, question, user_answer)
+    result = cache.get(cache_key) if use_cache else None
+
+    if result is not None:
+        if on_event:
+            for key, value in result.items():
+                if isinstance(value, str):
+                    on_event("field", (key, value))
+            for detail in result.get("details") or []:
+                on_event("detail", detail)
+        return result, None
+
+    def on_chunk(events: List[tuple]):
+        for event, payload in events:
+            on_event(event, payload)
+
+    messages = build_evaluation_messages(mode, question, user_answer)
+    content, completion_tokens = complete_json("evaluation", mode, messages, temperature=0.7, on_chunk=on_chunk if on_event else None)
+    result = parse_llm_json(content, get_prompt_registry().get("evaluation", mode).schema)
+    cache.put(cache_key, mode, result)
+    return result, completion_tokens
+
+# 单条详细反馈
+def render_evaluation_detail(detail: Dict):
+    original = detail.get("original_sentence", "")
+    correction = detail.get("correction", "")
+
+    # 兼容旧格式
+    if not original and not correction:
+        original = detail.get("comment", "")
+
+    if original:
+        with st.expander(f"❌ {original[:50]}..."):
+            st.error(f"**问题：** {original}")
+            if correction:
+                st.success(f"**建议：** {correction}")
+
 # AI 助手对话
 def ask_ai_assistant(question: str):
     try:
-        response = client.chat.completions.create(
+        response = get_llm_gateway().stream(
             model="qwen-max",
             messages=[
-                {"role": "system", "content": "你是我的英语学习搭子！我们都是四级备考的战友。请用轻松、口语化的中文跟我交流，就像朋友聊天一样。回答问题时：1）不要追求简洁，可以详细展开讲；2）结合四级备考的背景，补充相关的考点、高频词汇、易错点等；3）多用例子和场景帮助理解；4）鼓励我，给我实用的学习建议。记住：我们是朋友，不是师生！"},
+                {"role": "system", "content": CHAT_SYSTEM_PROMPT},
                 {"role": "user", "content": question}
             ],
             temperature=0.8,
-            max_tokens=2000,
-            stream=True
+            max_tokens=2000
         )
         return response
     except Exception as e:
@@ -816,13 +2856,9 @@ def ask_ai_assistant(question: str):
 # 侧边栏
 def sidebar():
     with st.sidebar:
-        # 计算坚持天数
-        history = load_history()
-        persistence_days = 0
-        if history:
-            dates = [h.get("timestamp", "").split("T")[0] for h in history if h.get("timestamp")]
-            unique_dates = set(dates)
-            persistence_days = len(unique_dates)
+        # 统计数据（数据库端聚合）
+        stats = load_practice_stats()
+        persistence_days = stats["practice_days"]
         
         # 标题
         st.markdown(
@@ -832,13 +2868,24 @@ def sidebar():
                 <h2 style='margin: 8px 0 12px 0; font-size: 22px; color: #2e5a3a; font-weight: 600; font-family: Georgia, "Times New Roman", serif;'>CET4 微写作</h2>
                 <div style='border-top: 1px solid rgba(102, 187, 106, 0.3); padding-top: 12px;'>
                     <div style='font-family: Georgia, "Times New Roman", serif; font-size: 18px; color: #66bb6a; font-weight: normal; line-height: 1; margin-bottom: 4px;'>坚持 {persistence_days} 天</div>
-                    <div style='font-size: 10px; color: #2e5a3a; letter-spacing: 1px;'>KEEP LEARNING</div>
+                    <div style='font-size: 10px; color: #2e5a3a; letter-spacing: 1px;'>KEEP LEARNING · 连续 {stats["streak"]} 天</div>
                 </div>
             </div>
             """,
             unsafe_allow_html=True
         )
         
+        # 后台写入出错时提示（数据库连不上、被拒绝的批次）
+        queue = get_write_queue()
+        if queue.last_error or queue.failed_count:
+            if queue.last_error:
+                st.warning(f"后台写入出错，正在重试：{queue.last_error}")
+            if queue.failed_count:
+                st.error(f"有 {queue.failed_count} 条数据写入被数据库拒绝，已保存在 {queue.path}.failed")
+                if st.button("重新写入", icon=":material/sync:", key="retry_failed_writes", use_container_width=True):
+                    queue.retry_failed()
+                    st.rerun()
+
         st.markdown("---")
         
         # 页面导航 - 使用自定义样式
@@ -878,13 +2925,11 @@ def sidebar():
         st.markdown("---")
         st.markdown("<h3 style='font-size: 14px; margin-bottom: 10px;'><span class='material-icon'>bar_chart</span>练习统计</h3>", unsafe_allow_html=True)
         
-        weakness_points = load_weakness_points()
-        
         col1, col2 = st.columns(2)
         with col1:
-            st.metric("总练习", len(history))
+            st.metric("总练习", stats["total_practices"])
         with col2:
-            st.metric("薄弱点", len(weakness_points))
+            st.metric("薄弱点", stats["weakness_total"])
     
     return page
 
@@ -906,9 +2951,8 @@ def practice_page():
     # 获取今天的日期
     today = date.today().isoformat()
 
-    # 检查今日是否已完成练习
-    history = load_history()
-    today_records = [h for h in history if h.get("timestamp", "").startswith(today)]
+    # 检查今日是否已完成练习；下面要显示题目和批改详情，一次查出整行，避免每条记录再补取一次
+    today_records = load_history_for_date(date.today(), columns="*")
 
     # 如果今日已完成练习，显示历史记录
     if today_records and not st.session_state.question:
@@ -917,11 +2961,11 @@ def practice_page():
 
         # 显示今日所有练习记录
         for i, record in enumerate(today_records, 1):
-            mode = record.get("mode", "")
-            question = record.get("question", {})
-            user_answer = record.get("user_answer", "")
-            evaluation = record.get("evaluation", {})
-            record_id = record.get("record_id", "")
+            mode = record.mode
+            question = record.question
+            user_answer = record.user_answer
+            evaluation = record.evaluation
+            record_id = record.record_id
 
             st.markdown(f"**练习 {i}：{mode}**")
 
@@ -997,71 +3041,31 @@ def practice_page():
                     st.markdown("---")
                     st.subheader("🔍 详细反馈")
                     for detail in evaluation["details"]:
-                        original = detail.get("original_sentence", "")
-                        correction = detail.get("correction", "")
-                        # 兼容旧格式
-                        if not original and not correction:
-                            original = detail.get("comment", "")
-
-                        if original:
-                            with st.expander(f"❌ {original[:50]}..."):
-                                st.error(f"**问题：** {original}")
-                                if correction:
-                                    st.success(f"**建议：** {correction}")
+                        render_evaluation_detail(detail)
 
             # 刷新批改按钮
             st.markdown("---")
+            force_fresh = st.checkbox("忽略缓存，重新让 AI 批改", key=f"refresh_fresh_{i}")
             if st.button(f"刷新批改结果 (练习 {i})", icon=":material/refresh:", key=f"refresh_history_{i}", use_container_width=True):
                 with st.spinner("正在重新批改..."):
-                    # 先获取新批改结果（不自动保存薄弱点）
-                    new_evaluation = evaluate_answer(mode, question, user_answer, record_id=record_id, auto_save_weakness=False)
-
-                    # 只有批改成功才更新数据
-                    if new_evaluation:
-                        # 删除旧薄弱点
-                        delete_weakness_points_by_record(record_id)
-
-                        # 手动保存新薄弱点
-                        if new_evaluation.get("details"):
-                            for detail in new_evaluation["details"]:
-                                original = detail.get("original_sentence", "")
-                                correction = detail.get("correction", "")
-                                type_tag = detail.get("type", "其他")
-
-                                if original and correction:
-                                    save_weakness_point({
-                                        "type": type_tag,
-                                        "issue": original,
-                                        "correction": correction,
-                                        "mode": mode
-                                    }, record_id=record_id)
-
-                        # 更新历史记录，覆盖同一题目的批改结果
-                        save_practice({
-                            "mode": mode,
-                            "question": question,
-                            "user_answer": user_answer,
-                            "evaluation": new_evaluation
-                        }, update_record_id=record_id)
+                    if refresh_evaluation(mode, question, user_answer, record_id=record_id, use_cache=not force_fresh):
                         st.rerun()
                     else:
                         st.error("批改失败，请重试")
 
-            st.caption(f"🕐 时间：{record.get('timestamp', '')}")
+            st.caption(f"🕐 时间：{record.timestamp}")
             st.markdown("---")
 
         # 继续练习按钮
         if st.button("继续练习", icon=":material/refresh:", type="primary", use_container_width=True):
             with st.spinner("正在生成题目..."):
-                weakness_points = load_weakness_points()
-                question = generate_question(get_today_mode(), weakness_points)
+                # 每日题目在后台保存
+                question = prepare_new_question(get_today_mode(), today)
                 if question:
                     st.session_state.question = question
                     st.session_state.user_answer = ""
                     st.session_state.evaluation = None
                     st.session_state.submitted = False
-                    # 保存到本地
-                    save_daily_question(today, question)
                     st.rerun()
 
         return
@@ -1076,11 +3080,10 @@ def practice_page():
     if not st.session_state.question:
         if st.button("生成今日题目", icon=":material/auto_awesome:", type="primary", use_container_width=True):
             with st.spinner("正在生成题目..."):
-                question = generate_question(get_today_mode())
+                # 每日题目在后台保存
+                question = prepare_new_question(get_today_mode(), today)
                 if question:
                     st.session_state.question = question
-                    # 保存到本地
-                    save_daily_question(today, question)
     
     # 显示题目
     if st.session_state.question:
@@ -1152,47 +3155,65 @@ def practice_page():
             )
 
             # 统计英语单词数
-            import re
-            # 匹配英语单词（只包含字母，可能包含连字符或撇号）
-            english_words = re.findall(r"[a-zA-Z]+(?:['-]?[a-zA-Z]+)*", user_answer)
-            word_count = len(english_words)
+            word_count = count_english_words(user_answer)
             st.caption(f"📊 单词数：{word_count}")
 
+            # 本地预检，只提示已经输入内容后的问题
+            issues = precheck_answer(mode, q, user_answer) if user_answer.strip() else []
+            for issue in issues:
+                st.caption(f"⚠️ {issue['message']}")
+            blocking = [issue for issue in issues if issue["level"] == "error"]
+
             # 提交按钮
             col1, col2, col3 = st.columns([1, 1, 1])
+            # 流式批改的实时结果显示在按钮下方
+            stream_area = st.empty()
             with col1:
                 if st.button("提交答案", type="primary", use_container_width=True):
-                    if user_answer.strip():
+                    if user_answer.strip() and not blocking:
                         with st.spinner("正在批改..."):
-                            # 先生成 record_id，确保薄弱点能正确关联
-                            temp_record_id = f"{datetime.now().timestamp()}"
-
-                            st.session_state.evaluation = evaluate_answer(
-                                mode,
-                                st.session_state.question,
-                                user_answer,
-                                record_id=temp_record_id
-                            )
-                            st.session_state.submitted = True
-
-                            # 保存练习记录（新建记录）
-                            save_practice({
-                                "mode": mode,
-                                "question": st.session_state.question,
-                                "user_answer": user_answer,
-                                "evaluation": st.session_state.evaluation
-                            })
-                            # 保存 record_id 到 session_state，用于刷新批改
-                            history = load_history()
-                            if history:
-                                st.session_state.current_record_id = history[-1].get("record_id")
+                            # 先在本地生成 record_id，薄弱点和练习记录用同一个
+                            record_id = new_record_id()
+
+                            st.session_state.evaluation = None
+                            failure = None
+                            with stream_area.container():
+                                st.markdown("---")
+                                st.subheader("📊 批改结果")
+                                summary_box = st.empty()
+                                completion_tokens = None
+
+                                def show_event(event, payload):
+                                    if event == "field" and payload[0] == "summary":
+                                        summary_box.success(payload[1])
+                                    elif event == "detail":
+                                        render_evaluation_detail(payload)
+
+                                try:
+                                    st.session_state.evaluation, completion_tokens = evaluate_answer_stream(
+                                        mode,
+                                        st.session_state.question,
+                                        user_answer,
+                                        on_event=show_event
+                                    )
+                                except Exception as e:
+                                    failure = e
+                            if failure is not None:
+                                # 清掉已经流式显示的部分结果，只留错误提示
+                                stream_area.error(f"批改失败: {str(failure)}")
+                            finish_submission(mode, record_id, user_answer, completion_tokens)
+                        # 批改完成后重新渲染完整结果
+                        if st.session_state.evaluation:
+                            st.rerun()
+                    elif blocking:
+                        st.warning(blocking[0]["message"])
                     else:
                         st.warning("请先输入你的答案！")
             
             with col2:
                 if st.button("刷新题目", icon=":material/refresh:", use_container_width=True):
                     with st.spinner("正在刷新题目..."):
-                        question = generate_question(get_today_mode())
+                        question = prepare_new_question(get_today_mode())
                         if question:
                             st.session_state.question = question
                             st.session_state.user_answer = ""
@@ -1236,65 +3257,25 @@ def practice_page():
                 st.markdown("---")
                 st.subheader("🔍 详细反馈")
                 for detail in eval_result["details"]:
-                    original = detail.get("original_sentence", "")
-                    correction = detail.get("correction", "")
-
-                    # 兼容旧格式
-                    if not original and not correction:
-                        original = detail.get("comment", "")
-
-                    if original:
-                        with st.expander(f"❌ {original[:50]}..."):
-                            st.error(f"**问题：** {original}")
-                            if correction:
-                                st.success(f"**建议：** {correction}")
+                    render_evaluation_detail(detail)
 
             # 刷新批改结果和继续练习按钮
             st.markdown("---")
             col1, col2 = st.columns(2)
             with col1:
+                force_fresh = st.checkbox("忽略缓存，重新让 AI 批改", key="refresh_fresh_current")
                 if st.button("刷新批改结果", icon=":material/refresh:", use_container_width=True):
                     with st.spinner("正在重新批改..."):
-                        # 先获取新批改结果（不自动保存薄弱点）
-                        new_evaluation = evaluate_answer(
+                        # 用提交时记下的答案重新批改，和提交时的缓存键一致
+                        new_evaluation = refresh_evaluation(
                             mode,
                             st.session_state.question,
                             st.session_state.user_answer,
                             record_id=st.session_state.get("current_record_id"),
-                            auto_save_weakness=False
+                            use_cache=not force_fresh
                         )
-
-                        # 只有批改成功才更新数据
                         if new_evaluation:
-                            # 删除旧薄弱点
-                            if st.session_state.get("current_record_id"):
-                                delete_weakness_points_by_record(st.session_state.current_record_id)
-
-                            # 手动保存新薄弱点
-                            if new_evaluation.get("details"):
-                                for detail in new_evaluation["details"]:
-                                    original = detail.get("original_sentence", "")
-                                    correction = detail.get("correction", "")
-                                    type_tag = detail.get("type", "其他")
-
-                                    if original and correction:
-                                        save_weakness_point({
-                                            "type": type_tag,
-                                            "issue": original,
-                                            "correction": correction,
-                                            "mode": mode
-                                        }, record_id=st.session_state.get("current_record_id"))
-
                             st.session_state.evaluation = new_evaluation
-
-                            # 更新历史记录，覆盖同一题目的批改结果
-                            if st.session_state.get("current_record_id"):
-                                save_practice({
-                                    "mode": mode,
-                                    "question": st.session_state.question,
-                                    "user_answer": st.session_state.user_answer,
-                                    "evaluation": new_evaluation
-                                }, update_record_id=st.session_state.current_record_id)
                             st.rerun()
                         else:
                             st.error("批改失败，请重试")
@@ -1308,23 +3289,50 @@ def practice_page():
                     st.session_state.current_record_id = None
                     st.rerun()
 
+# 薄弱点类型标签的样式，使用与侧边栏按钮相同的背景和边框
+def weakness_tag_style(type_text: str) -> str:
+    if type_text == "注意":
+        color = "#e57373"
+    elif type_text == "建议":
+        color = "#66bb6a"
+    else:
+        color = "#5a8f62"
+    return f"background: rgba(255, 255, 255, 0.5); border: 1px solid rgba(102, 187, 106, 0.3); color: {color}; padding: 2px 8px; border-radius: 4px; font-size: 12px; display: inline-block;"
+
+# 分页状态：筛选条件变化时回到第一页，返回当前页码
+def current_page(state_key: str, filters) -> int:
+    filters_key = f"{state_key}_filters"
+    if st.session_state.get(filters_key) != filters:
+        st.session_state[filters_key] = filters
+        st.session_state[state_key] = 0
+    return st.session_state.get(state_key, 0)
+
+# 上一页/下一页按钮，每次只渲染一页，元素数量不随数据量增长
+def render_pager(state_key: str, has_next: bool, label: str = ""):
+    page = st.session_state.get(state_key, 0)
+    col_prev, col_label, col_next = st.columns([1, 2, 1])
+    with col_prev:
+        if st.button("上一页", icon=":material/chevron_left:", disabled=page == 0, use_container_width=True, key=f"{state_key}_prev"):
+            st.session_state[state_key] = page - 1
+            st.rerun()
+    with col_label:
+        st.caption(label or f"第 {page + 1} 页")
+    with col_next:
+        if st.button("下一页", icon=":material/chevron_right:", disabled=not has_next, use_container_width=True, key=f"{state_key}_next"):
+            st.session_state[state_key] = page + 1
+            st.rerun()
+
 # 薄弱点页面
 def weakness_page():
     st.header("📊 薄弱点分析")
     st.markdown("---")
 
-    weakness_points = load_weakness_points()
-
-    if not weakness_points:
+    # 各类型的数量来自数据库端聚合的统计，不读薄弱点明细
+    type_counts = {ptype: count for ptype, count in load_practice_stats()["weakness_by_type"].items() if count > 0}
+    if not type_counts:
         st.info("还没有薄弱点记录，加油练习吧！")
         return
 
-    # 按类型统计
-    type_counts = {}
-    for point in weakness_points:
-        ptype = point.get("type", "其他")
-        type_counts[ptype] = type_counts.get(ptype, 0) + 1
-
     st.subheader("📈 薄弱点统计")
     # 使用横向排列显示统计卡片
     if type_counts:
@@ -1339,6 +3347,19 @@ def weakness_page():
             with cols[i % 3]:
                 st.metric(ptype, count)
 
+    # 旧格式薄弱点按当前规则重新归类
+    with st.expander("🛠️ 数据维护"):
+        st.caption("用最新的关键词规则重新归类旧版批改意见生成的薄弱点")
+        if st.button("重新归类旧薄弱点", icon=":material/sync:", key="backfill_weakness_types"):
+            with st.spinner("正在重新归类..."):
+                try:
+                    changed = backfill_weakness_types()
+                    st.success(f"已更新 {changed} 条薄弱点的类型")
+                    if changed:
+                        st.rerun()
+                except Exception as e:
+                    st.error(f"重新归类失败: {str(e)}")
+
     # 筛选功能
     st.markdown("---")
     st.markdown("📝 薄弱点详情")
@@ -1347,166 +3368,307 @@ def weakness_page():
     all_types = list(type_counts.keys())
     all_types.sort()
 
-    # 添加筛选器
-    selected_types = st.multiselect(
-        "筛选类型",
-        options=all_types,
-        default=all_types,
-        key="weakness_filter"
-    )
+    # 添加筛选器（过滤条件在数据库端执行）
+    col_type, col_mode, col_view = st.columns([2, 1, 1])
+    with col_type:
+        selected_types = st.multiselect(
+            "筛选类型",
+            options=all_types,
+            default=all_types,
+            key="weakness_filter"
+        )
+    with col_mode:
+        mode_options = ["全部题型"] + list(WRITING_MODES.values())
+        selected_mode = st.selectbox("筛选题型", mode_options, key="weakness_mode_filter")
+    with col_view:
+        # 默认逐条查看：过滤和分页都在数据库端完成，每次只取一页
+        view = st.radio("显示方式", ["逐条查看", "合并相同错误"], key="weakness_view")
+    mode_filter = None if selected_mode == "全部题型" else selected_mode
+    types_filter = selected_types if selected_types and len(selected_types) < len(all_types) else None
+
+    page = current_page("weakness_page_no", (view, tuple(types_filter or ()), mode_filter))
+
+    if view == "逐条查看":
+        points, total = load_weakness_page(types_filter, mode_filter, page)
+        total_pages = max(1, -(-total // WEAKNESS_PAGE_SIZE))
+        st.caption(f"共 {total} 条薄弱点")
+        for i, point in enumerate(points, page * WEAKNESS_PAGE_SIZE + 1):
+            st.markdown(f"**{i}.** <span style='{weakness_tag_style(point.type)}'>{point.type}</span> &nbsp; {point.mode}", unsafe_allow_html=True)
+            st.write(f"❌ 问题：{point.issue}")
+            st.write(f"✅ 建议：{point.correction}")
+            st.caption(f"🕐 时间：{point.timestamp}")
+            st.markdown("---")
+        render_pager("weakness_page_no", page + 1 < total_pages, f"第 {page + 1} / {total_pages} 页")
+        return
 
-    # 根据筛选过滤薄弱点
-    if selected_types:
-        filtered_points = [p for p in weakness_points if p.get("type", "其他") in selected_types]
-    else:
-        filtered_points = weakness_points
-    # 按模式分组
-    mode_groups = {}
-    for point in filtered_points:
-        mode = point.get("mode", "其他")
-        if mode not in mode_groups:
-            mode_groups[mode] = []
-        mode_groups[mode].append(point)
-
-    for mode, points in mode_groups.items():
-        with st.expander(f"📌 {mode} ({len(points)}个)"):
-            for i, point in enumerate(points, 1):
-                type_text = point.get('type', '')
-                # 根据类型设置不同的标签颜色，使用与侧边栏按钮相同的背景和边框
-                if type_text == "注意":
-                    tag_style = "background: rgba(255, 255, 255, 0.5); border: 1px solid rgba(102, 187, 106, 0.3); color: #e57373; padding: 2px 8px; border-radius: 4px; font-size: 12px; display: inline-block;"
-                elif type_text == "建议":
-                    tag_style = "background: rgba(255, 255, 255, 0.5); border: 1px solid rgba(102, 187, 106, 0.3); color: #66bb6a; padding: 2px 8px; border-radius: 4px; font-size: 12px; display: inline-block;"
-                else:
-                    tag_style = "background: rgba(255, 255, 255, 0.5); border: 1px solid rgba(102, 187, 106, 0.3); color: #5a8f62; padding: 2px 8px; border-radius: 4px; font-size: 12px; display: inline-block;"
-                st.markdown(f"**{i}.** <span style='{tag_style}'>{type_text}</span>", unsafe_allow_html=True)
-                st.write(f"❌ 问题：{point.get('issue', '')}")
-                st.write(f"✅ 建议：{point.get('correction', '')}")
-                st.caption(f"🕐 时间：{point.get('timestamp', '')}")
-                st.markdown("---")
+    # 相同或相近的薄弱点合并显示，按出现次数从多到少（聚类在薄弱点画像里，切到这个视图时才建立）
+    try:
+        clusters = get_weakness_profile().top_clusters(types=types_filter, mode=mode_filter)
+    except Exception as e:
+        st.error(f"读取薄弱点失败: {str(e)}")
+        return
+    total_pages = max(1, -(-len(clusters) // WEAKNESS_PAGE_SIZE))
+    st.caption(f"共 {sum(c.count for c in clusters)} 条薄弱点，合并为 {len(clusters)} 类")
+
+    for cluster in clusters[page * WEAKNESS_PAGE_SIZE:(page + 1) * WEAKNESS_PAGE_SIZE]:
+        modes = "、".join(mode for mode, n in cluster.modes.most_common() if n > 0)
+        st.markdown(
+            f"<span style='{weakness_tag_style(cluster.type)}'>{cluster.type}</span> **×{cluster.count}** &nbsp; {modes}",
+            unsafe_allow_html=True
+        )
+        st.write(f"❌ 问题：{cluster.issue}")
+        st.write(f"✅ 建议：{cluster.correction}")
+        if cluster.count > 1:
+            with st.expander(f"最近的 {len(cluster.examples)} 次"):
+                for example in reversed(cluster.examples):
+                    st.write(f"❌ {example['issue']}")
+                    st.write(f"✅ {example['correction']}")
+                    st.caption(f"🕐 时间：{example['timestamp']}")
+        else:
+            st.caption(f"🕐 时间：{cluster.latest}")
+        st.markdown("---")
+
+    render_pager("weakness_page_no", page + 1 < total_pages, f"第 {page + 1} / {total_pages} 页")
+
+# 历史记录详情（题目、答案、批改）
+def render_history_record(record: PracticeRecord):
+    mode = record.mode
+    question = record.question
+    user_answer = record.user_answer
+    evaluation = record.evaluation
+
+    # 显示题目
+    if mode == "Phrase Practice":
+        phrases = ', '.join(question.get('phrases', []))
+        st.info(f"短语：{phrases}")
+    elif mode == "Translation":
+        st.info(f"题目：{question.get('chinese_sentence', '')}")
+    elif mode == "Transition Practice":
+        st.info(f"题目：{question.get('part1', '')} + {question.get('part2', '')}")
+    elif mode == "Sentence Structure":
+        st.info(f"句型：{question.get('structure', '')}")
+    elif mode == "Sentence Variety":
+        st.info(f"原句：{question.get('original_sentence', '')}")
+    elif mode == "Sentence Correction":
+        st.info(f"题目：{question.get('question', '')}")
+    elif mode == "Paraphrasing":
+        st.info(f"题目：{question.get('original_sentence', '')}")
+
+    # 显示用户答案
+    st.write(f"✍️ 你的答案：{user_answer}")
+
+    # 显示薄弱点详情
+    details = evaluation.get("details", [])
+    if details:
+        st.markdown("---")
+        st.markdown("🔍 薄弱点详情")
+        for detail in details:
+            render_evaluation_detail(detail)
 
 # 历史记录页面
 def history_page():
     st.header("📜 练习历史")
     st.markdown("---")
-    
-    history = load_history()
-    
-    if not history:
+
+    stats = load_practice_stats()
+
+    if not stats["total_practices"]:
         st.info("还没有练习记录，开始练习吧！")
         return
-    
+
     # 统计信息
     col1, col2 = st.columns(2)
     with col1:
-        st.metric("总练习次数", len(history))
+        st.metric("总练习次数", stats["total_practices"])
     with col2:
         # 练习模式分布
-        mode_counts = {}
-        for h in history:
-            mode = h.get("mode", "其他")
-            mode_counts[mode] = mode_counts.get(mode, 0) + 1
+        mode_counts = stats["mode_counts"]
         most_common = max(mode_counts.items(), key=lambda x: x[1])[0] if mode_counts else "无"
         st.metric("最常练习", most_common)
-    
+
     st.markdown("---")
-    
-    # 按日期分组显示
+
+    # 按题型筛选（在数据库端过滤），一次只显示一页
+    mode_options = ["全部题型"] + sorted(mode_counts)
+    selected_mode = st.selectbox("筛选题型", mode_options, key="history_mode_filter")
+    mode_filter = None if selected_mode == "全部题型" else selected_mode
+
+    # 键集分页只能顺序翻页，记下每一页的起始游标
+    page = current_page("history_page_no", mode_filter)
+    if page == 0 or "history_cursors" not in st.session_state:
+        st.session_state.history_cursors = {0: None}
+    page = min(page, max(st.session_state.history_cursors))
+    st.session_state.history_page_no = page
+
+    # 多取一条用来判断是否还有下一页
+    records = load_history_page(st.session_state.history_cursors[page], HISTORY_PAGE_SIZE + 1, mode_filter)
+    has_more = len(records) > HISTORY_PAGE_SIZE
+    records = records[:HISTORY_PAGE_SIZE]
+    if has_more:
+        last = records[-1]
+        st.session_state.history_cursors[page + 1] = (last.created_at, last.record_id)
+
+    # 按日期分组显示（最新的日期在前）
     date_groups = {}
-    for record in reversed(history):
-        timestamp = record.get("timestamp", "")
+    for record in records:
+        timestamp = record.timestamp
         date_str = timestamp.split("T")[0] if timestamp else "未知日期"
         if date_str not in date_groups:
             date_groups[date_str] = []
         date_groups[date_str].append(record)
-    
-    for date_str, records in date_groups.items():
-        with st.expander(f"📅 {date_str} ({len(records)}条记录)"):
-            for i, record in enumerate(records, 1):
-                mode = record.get("mode", "")
-                question = record.get("question", {})
-                user_answer = record.get("user_answer", "")
-                evaluation = record.get("evaluation", {})
-                
-                st.markdown(f"**{i}. {mode}**")
-                
-                # 显示题目
-                if mode == "Phrase Practice":
-                    phrases = ', '.join(question.get('phrases', []))
-                    st.info(f"短语：{phrases}")
-                elif mode == "Translation":
-                    st.info(f"题目：{question.get('chinese_sentence', '')}")
-                elif mode == "Transition Practice":
-                    st.info(f"题目：{question.get('part1', '')} + {question.get('part2', '')}")
-                elif mode == "Sentence Structure":
-                    st.info(f"句型：{question.get('structure', '')}")
-                elif mode == "Sentence Variety":
-                    st.info(f"原句：{question.get('original_sentence', '')}")
-                elif mode == "Sentence Correction":
-                    st.info(f"题目：{question.get('question', '')}")
-                elif mode == "Paraphrasing":
-                    st.info(f"题目：{question.get('original_sentence', '')}")
-                
-                # 显示用户答案
-                st.write(f"✍️ 你的答案：{user_answer}")
-                
-                # 显示评价
-                if evaluation:
-                    summary = evaluation.get("summary", "")
-                    st.info(f"📝 {summary}")
-                    
-                    # 显示薄弱点详情
-                    details = evaluation.get("details", [])
-                    if details:
-                        st.markdown("---")
-                        st.markdown("🔍 薄弱点详情")
-                        for detail in details:
-                            original = detail.get("original_sentence", "")
-                            correction = detail.get("correction", "")
-
-                            # 兼容旧格式
-                            if not original and not correction:
-                                original = detail.get("comment", "")
-
-                            if original:
-                                with st.expander(f"❌ {original[:50]}..."):
-                                    st.error(f"**问题：** {original}")
-                                    if correction:
-                                        st.success(f"**建议：** {correction}")
-                
-                st.caption(f"🕐 时间：{record.get('timestamp', '')}")
+
+    for date_str, group in date_groups.items():
+        with st.expander(f"📅 {date_str} ({len(group)}条记录)"):
+            for i, record in enumerate(group, 1):
+                record_id = record.record_id
+                st.markdown(f"**{i}. {record.mode}**")
+
+                if record.summary:
+                    st.info(f"📝 {record.summary}")
+
+                # 打开开关后才读取这条记录的题目和批改详情
+                if st.toggle("查看详情", key=f"history_detail_{record_id}"):
+                    full_record = load_practice_record(record_id)
+                    if full_record:
+                        render_history_record(full_record)
+
+                st.caption(f"🕐 时间：{record.timestamp}")
                 st.markdown("---")
 
+    render_pager("history_page_no", has_more)
+
+# 对话列表每次加载的条数、每次加载的消息条数
+CHAT_CONVERSATION_PAGE_SIZE = 50
+CHAT_MESSAGE_PAGE_SIZE = 20
+
+# 按 (created_at, id) 倒序分页读取对话（只有标题等元数据，不含消息）
+def load_conversations(cursor: Optional[tuple] = None, limit: int = CHAT_CONVERSATION_PAGE_SIZE) -> List[Dict]:
+    try:
+        return get_storage().list_conversations(cursor, limit)
+    except Exception as e:
+        st.error(f"读取对话列表失败: {str(e)}")
+        return []
+
+# 按 id 倒序分页读取某个对话的消息，返回 (按时间正序的消息, 消息总数)
+def load_conversation_messages(conv_id: str, before_id: Optional[int] = None, limit: int = CHAT_MESSAGE_PAGE_SIZE) -> tuple:
+    try:
+        rows, total = get_storage().conversation_messages(conv_id, before_id, limit)
+        return list(reversed(rows)), total
+    except Exception as e:
+        st.error(f"读取对话消息失败: {str(e)}")
+        return [], 0
+
+# 保存新对话
+def save_conversation(conv: Dict):
+    try:
+        get_storage().insert("ai_conversations", [{
+            "id": conv["id"],
+            "title": conv["title"],
+            "created_at": conv["created_at"]
+        }])
+    except Exception as e:
+        st.error(f"保存对话失败: {str(e)}")
+
+# 更新对话的标题或摘要
+def update_conversation(conv_id: str, fields: Dict):
+    try:
+        get_storage().update_conversation(conv_id, fields)
+    except Exception as e:
+        st.error(f"更新对话失败: {str(e)}")
+
+# 删除对话（消息随外键级联删除）
+def delete_conversation(conv_id: str):
+    try:
+        get_storage().delete_conversation(conv_id)
+    except Exception as e:
+        st.error(f"删除对话失败: {str(e)}")
+
+# 保存一条消息，返回数据库生成的 id
+def save_conversation_message(conv_id: str, message: Dict) -> Optional[int]:
+    try:
+        rows = get_storage().insert("ai_messages", [{
+            "conversation_id": conv_id,
+            "role": message["role"],
+            "content": message["content"],
+            "timestamp": message["timestamp"]
+        }])
+        return rows[0].get("id") if rows else None
+    except Exception as e:
+        st.error(f"保存消息失败: {str(e)}")
+        return None
+
 # 对话管理辅助函数
 def init_ai_chat_state():
-    """初始化 AI 聊天状态"""
+    """初始化 AI 聊天状态：ai_conversations 是 id -> 对话 的字典（最新的在前），消息打开对话时才加载"""
     if "ai_conversations" not in st.session_state:
-        st.session_state.ai_conversations = []
+        st.session_state.ai_conversations = {}
+        load_more_conversations()
     if "current_conversation_id" not in st.session_state:
-        st.session_state.current_conversation_id = None
+        # 默认打开最近的一次对话
+        st.session_state.current_conversation_id = next(iter(st.session_state.ai_conversations), None)
+
+def load_more_conversations():
+    """在对话列表末尾追加更早的一页对话，游标是已加载的最早一个对话"""
+    conversations = st.session_state.ai_conversations
+    oldest = next(reversed(conversations.values()), None)
+    cursor = (oldest["created_at"], oldest["id"]) if oldest else None
+    # 多取一条，用来判断后面还有没有
+    rows = load_conversations(cursor, CHAT_CONVERSATION_PAGE_SIZE + 1)
+    st.session_state.conversations_has_more = len(rows) > CHAT_CONVERSATION_PAGE_SIZE
+    for row in rows[:CHAT_CONVERSATION_PAGE_SIZE]:
+        conversations.setdefault(row["id"], {
+            "id": row["id"],
+            "title": row.get("title") or "新对话",
+            "created_at": row.get("created_at") or "",
+            "summary": row.get("summary"),
+            "summary_upto": row.get("summary_upto") or 0,
+            "messages": None
+        })
 
 def create_new_conversation():
     """创建新对话"""
-    import time
     conversation = {
-        "id": f"conv_{int(time.time())}",
+        "id": f"conv_{int(time.time() * 1000)}",
         "title": "新对话",
         "created_at": datetime.now().isoformat(),
-        "messages": []
+        "summary": None,
+        "summary_upto": 0,
+        "messages": [],
+        "message_offset": 0,
+        "has_more": False
     }
-    st.session_state.ai_conversations.insert(0, conversation)
+    save_conversation(conversation)
+    st.session_state.ai_conversations = {conversation["id"]: conversation, **st.session_state.ai_conversations}
     st.session_state.current_conversation_id = conversation["id"]
     return conversation["id"]
 
+def load_older_messages(conv: Dict):
+    """加载更早的一页消息，message_offset 是 messages[0] 在整个对话里的序号"""
+    if conv["messages"] is None:
+        messages, total = load_conversation_messages(conv["id"])
+    else:
+        # 保存失败的消息没有 id（只留在本次会话里），跳过它们找最早一条已保存的消息作为游标
+        oldest_id = next((m["id"] for m in conv["messages"] if m.get("id") is not None), None)
+        if oldest_id is None and conv["messages"]:
+            # 列表里全是没保存的消息，数据库里没有更早的了
+            conv["has_more"] = False
+            return
+        messages, total = load_conversation_messages(conv["id"], before_id=oldest_id)
+        messages = messages + conv["messages"]
+        total = max(total + len(conv["messages"]), len(messages))
+    conv["messages"] = messages
+    conv["message_offset"] = total - len(messages)
+    conv["has_more"] = conv["message_offset"] > 0
+
 def get_current_conversation():
-    """获取当前对话"""
+    """获取当前对话（第一次打开时加载最近一页消息）"""
     conv_id = st.session_state.current_conversation_id
     if not conv_id:
         return None
-    for conv in st.session_state.ai_conversations:
-        if conv["id"] == conv_id:
-            return conv
-    return None
+    conv = st.session_state.ai_conversations.get(conv_id)
+    if conv and conv["messages"] is None:
+        load_older_messages(conv)
+    return conv
 
 def add_message_to_conversation(role, content):
     """添加消息到当前对话"""
@@ -1517,14 +3679,225 @@ def add_message_to_conversation(role, content):
             "content": content,
             "timestamp": datetime.now().isoformat()
         }
+        message["id"] = save_conversation_message(conv["id"], message)
         conv["messages"].append(message)
 
         # 如果是第一条用户消息，更新对话标题
-        if role == "user" and len(conv["messages"]) == 1:
+        if role == "user" and conv.get("message_offset", 0) + len(conv["messages"]) == 1:
             conv["title"] = content[:30] + ("..." if len(content) > 30 else "")
+            update_conversation(conv["id"], {"title": conv["title"]})
+
+# 每条消息在 estimate_tokens() 之外另加 4 个格式开销
+def estimate_message_tokens(message: Dict) -> int:
+    return estimate_tokens(message["content"]) + 4
+
+# 聊天答案缓存：对首轮问题做字符 n-gram MinHash + LSH，相似问题直接回放之前的回答
+class ChatAnswerCache:
+    """只缓存对话的第一个问题（没有上下文，回答可复用）。
+    磁盘上只存规范化后的问题、回答和命中次数，MinHash 签名和 LSH 桶在加载时重算；
+    超过 capacity 条按最近使用淘汰。put 时立即写盘；get 只改内存里的命中次数，
+    距上次写盘超过 save_interval 秒才顺带写一次。"""
+
+    _PRIME = (1 << 61) - 1
+    _PUNCTUATION = re.compile(r"[\W_]+", re.UNICODE)
+    # 只影响语气、不影响问题本身的词
+    _FILLERS = re.compile(r"(请问|请教|一下|老师|谢谢|呢|吗|呀|啊|吧)")
+
+    def __init__(self, capacity: int, path: str, threshold: float, ngram: int = 2, bands: int = 16, rows: int = 4,
+                 save_interval: float = 60.0):
+        self.capacity = capacity
+        self.path = path
+        self.threshold = threshold
+        self.save_interval = save_interval
+        self.ngram = ngram
+        self.bands = bands
+        self.rows = rows
+        rng = random.Random(20240601)
+        self._coefficients = [
+            (rng.randrange(1, self._PRIME), rng.randrange(0, self._PRIME))
+            for _ in range(bands * rows)
+        ]
+        self._lock = threading.Lock()
+        # 写文件不占 _lock；_version 保证并发写盘时旧快照不会覆盖新快照
+        self._file_lock = threading.Lock()
+        self._version = 0
+        self._written_version = 0
+        self._saved_at = time.monotonic()
+        self._entries: "OrderedDict[str, Dict]" = OrderedDict()
+        self._buckets: Dict[tuple, set] = {}
+        self.lookups = 0
+        self.hits = 0
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            self.lookups = data.get("lookups", 0)
+            self.hits = data.get("hits", 0)
+            for key, entry in data.get("entries", {}).items():
+                self._index(key, entry)
+        except (OSError, ValueError, AttributeError):
+            pass
+
+    def normalize(self, text: str) -> str:
+        text = text.lower()
+        text = self._FILLERS.sub("", text)
+        return self._PUNCTUATION.sub("", text)
+
+    def _shingles(self, normalized: str) -> set:
+        if len(normalized) <= self.ngram:
+            return {normalized} if normalized else set()
+        return {normalized[i:i + self.ngram] for i in range(len(normalized) - self.ngram + 1)}
+
+    def _signature(self, shingles: set) -> List[int]:
+        hashes = [
+            int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=8).digest(), "big")
+            for s in shingles
+        ]
+        return [min((a * h + b) % self._PRIME for h in hashes) for a, b in self._coefficients]
+
+    def _band_keys(self, signature: List[int]) -> List[tuple]:
+        return [
+            (band, tuple(signature[band * self.rows:(band + 1) * self.rows]))
+            for band in range(self.bands)
+        ]
+
+    def _index(self, key: str, entry: Dict):
+        shingles = self._shingles(entry["question"])
+        if not shingles:
+            return
+        entry["_shingles"] = shingles
+        entry["_bands"] = self._band_keys(self._signature(shingles))
+        self._entries[key] = entry
+        for band_key in entry["_bands"]:
+            self._buckets.setdefault(band_key, set()).add(key)
+
+    def _unindex(self, key: str):
+        entry = self._entries.pop(key)
+        for band_key in entry["_bands"]:
+            bucket = self._buckets.get(band_key)
+            if bucket is not None:
+                bucket.discard(key)
+                if not bucket:
+                    del self._buckets[band_key]
+
+    def _snapshot(self) -> tuple:
+        """在持有 _lock 时调用，复制出要写盘的内容"""
+        self._version += 1
+        self._saved_at = time.monotonic()
+        entries = {
+            key: {"question": e["question"], "answer": e["answer"], "hits": e.get("hits", 0)}
+            for key, e in self._entries.items()
+        }
+        return self._version, {"lookups": self.lookups, "hits": self.hits, "entries": entries}
+
+    def _save(self, snapshot: tuple):
+        version, data = snapshot
+        with self._file_lock:
+            if version <= self._written_version:
+                return
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                tmp_path = self.path + ".tmp"
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump(data, f, ensure_ascii=False)
+                os.replace(tmp_path, self.path)
+                self._written_version = version
+            except OSError:
+                pass
+
+    @property
+    def hit_rate(self) -> float:
+        return self.hits / self.lookups if self.lookups else 0.0
+
+    def get(self, question: str) -> Optional[str]:
+        """找最相似的已缓存问题，Jaccard 相似度达到阈值才算命中"""
+        normalized = self.normalize(question)
+        shingles = self._shingles(normalized)
+        if not shingles:
+            return None
+        band_keys = self._band_keys(self._signature(shingles))
+        answer, snapshot = None, None
+        with self._lock:
+            self.lookups += 1
+            candidates = set()
+            for band_key in band_keys:
+                candidates |= self._buckets.get(band_key, set())
+            best_key, best_score = None, 0.0
+            for key in candidates:
+                cached = self._entries[key]["_shingles"]
+                score = len(shingles & cached) / len(shingles | cached)
+                if score > best_score:
+                    best_key, best_score = key, score
+            if best_key is not None and best_score >= self.threshold:
+                self.hits += 1
+                entry = self._entries[best_key]
+                entry["hits"] = entry.get("hits", 0) + 1
+                self._entries.move_to_end(best_key)
+                answer = entry["answer"]
+            if time.monotonic() - self._saved_at >= self.save_interval:
+                snapshot = self._snapshot()
+        if snapshot:
+            self._save(snapshot)
+        return answer
+
+    def put(self, question: str, answer: str):
+        normalized = self.normalize(question)
+        if not normalized or not answer:
+            return
+        key = hashlib.sha256(normalized.encode("utf-8")).hexdigest()[:16]
+        with self._lock:
+            if key in self._entries:
+                self._unindex(key)
+            self._index(key, {"question": normalized, "answer": answer, "hits": 0})
+            while len(self._entries) > self.capacity:
+                self._unindex(next(iter(self._entries)))
+            snapshot = self._snapshot()
+        self._save(snapshot)
+
+@st.cache_resource
+def get_chat_answer_cache() -> ChatAnswerCache:
+    return ChatAnswerCache(
+        capacity=int(get_setting("CHAT_CACHE_SIZE", 300)),
+        path=os.path.join(CACHE_DIR, "chat_answer_cache.json"),
+        threshold=float(get_setting("CHAT_CACHE_THRESHOLD", 0.8))
+    )
+
+# 按小段回放缓存的回答，让 st.write_stream 的显示和实时回答一致
+def replay_answer(answer: str, chunk_size: int = 20):
+    for i in range(0, len(answer), chunk_size):
+        yield answer[i:i + chunk_size]
+
+# 滚动摘要：把更早的对话压缩成一段摘要，只在新挤出去的消息够多时才重新生成
+def update_conversation_summary(conv: Dict, upto: int, refresh_every: int = 4):
+    """保证 conv["summary"] 覆盖对话前 upto 条消息的大部分内容；落后不到 refresh_every 条时沿用旧摘要。
+    upto 和 summary_upto 都是消息在整个对话里的序号，没加载到内存的更早消息不会再补进摘要"""
+    offset = conv.get("message_offset", 0)
+    summarized = max(conv.get("summary_upto", 0), offset)
+    if upto - summarized < refresh_every and conv.get("summary"):
+        return
 
-def get_conversation_context(conv_id=None, max_turns=5):
-    """获取对话上下文"""
+    new_messages = conv["messages"][summarized - offset:upto - offset]
+    transcript = "\n".join(
+        f"{'我' if m['role'] == 'user' else '搭子'}：{m['content'][:500]}" for m in new_messages
+    )
+    try:
+        summary = get_llm_gateway().complete(
+            model=get_setting("LLM_SUMMARY_MODEL", "qwen-turbo"),
+            messages=[
+                {"role": "system", "content": "你负责压缩英语学习对话的历史。用中文写不超过 200 字的摘要，保留我问过的问题、讲过的知识点和还没解决的疑问。只输出摘要。"},
+                {"role": "user", "content": f"已有摘要：{conv.get('summary') or '（无）'}\n\n新增对话：\n{transcript}"}
+            ],
+            temperature=0.3,
+            max_tokens=300
+        )
+    except Exception:
+        # 摘要失败时沿用旧摘要，只是覆盖范围少一些
+        return
+    conv["summary"] = summary.strip()
+    conv["summary_upto"] = upto
+    update_conversation(conv["id"], {"summary": conv["summary"], "summary_upto": upto})
+
+def get_conversation_context(conv_id=None, token_budget=None):
+    """获取对话上下文：从最新消息往前装，装满 token 预算为止，更早的消息用滚动摘要代替"""
     if not conv_id:
         conv_id = st.session_state.current_conversation_id
     if not conv_id:
@@ -1534,14 +3907,35 @@ def get_conversation_context(conv_id=None, max_turns=5):
     if not conv:
         return []
 
+    if token_budget is None:
+        token_budget = int(get_setting("CHAT_CONTEXT_TOKENS", 3000))
+    # 给摘要预留的预算
+    summary_reserve = 320
+
     messages = conv["messages"]
-    # 保留最近的 N 轮对话（1轮 = 1个用户 + 1个助手）
-    if len(messages) > max_turns * 2:
-        messages = messages[-max_turns * 2:]
+    start = len(messages)
+    used = 0
+    while start > 0:
+        cost = estimate_message_tokens(messages[start - 1])
+        # 最新的一条（本轮提问）无论多长都要带上
+        if start < len(messages) and used + cost > token_budget - summary_reserve:
+            break
+        used += cost
+        start -= 1
 
     # 转换为 API 格式
     api_messages = []
-    for msg in messages:
+    offset = conv.get("message_offset", 0)
+    if offset + start > 0:
+        update_conversation_summary(conv, offset + start)
+        if conv.get("summary"):
+            api_messages.append({
+                "role": "system",
+                "content": f"之前的对话摘要：{conv['summary']}"
+            })
+            # 摘要沿用旧的时只覆盖到 summary_upto，之后被挤出窗口的消息照原样带上，不能丢
+            start = min(start, max(conv.get("summary_upto", 0) - offset, 0))
+    for msg in messages[start:]:
         api_messages.append({
             "role": msg["role"],
             "content": msg["content"]
@@ -1550,21 +3944,18 @@ def get_conversation_context(conv_id=None, max_turns=5):
 
 def ask_ai_with_context(messages):
     """带上下文的 AI 调用"""
-    system_prompt = "你是我的英语学习搭子！我们都是四级备考的战友。请用轻松、口语化的中文跟我交流，就像朋友聊天一样。回答问题时：1）不要追求简洁，可以详细展开讲；2）结合四级备考的背景，补充相关的考点、高频词汇、易错点等；3）多用例子和场景帮助理解；4）鼓励我，给我实用的学习建议。记住：我们是朋友，不是师生！"
-
     # 构建消息列表
     api_messages = [
-        {"role": "system", "content": system_prompt}
+        {"role": "system", "content": CHAT_SYSTEM_PROMPT}
     ]
     api_messages.extend(messages)
 
     try:
-        response = client.chat.completions.create(
+        response = get_llm_gateway().stream(
             model="qwen-max",
             messages=api_messages,
             temperature=0.8,
-            max_tokens=2000,
-            stream=True
+            max_tokens=2000
         )
         return response
     except Exception as e:
@@ -1591,7 +3982,7 @@ def ai_chat_page():
             st.rerun()
 
         # 显示对话列表
-        for conv in st.session_state.ai_conversations:
+        for conv in list(st.session_state.ai_conversations.values()):
             is_current = conv["id"] == st.session_state.current_conversation_id
 
             # 显示对话信息
@@ -1608,19 +3999,27 @@ def ai_chat_page():
                         st.rerun()
                 with col_del:
                     if st.button("×", key=f"del_{conv['id']}", help="删除对话"):
-                        st.session_state.ai_conversations = [
-                            c for c in st.session_state.ai_conversations
-                            if c["id"] != conv["id"]
-                        ]
+                        delete_conversation(conv["id"])
+                        st.session_state.ai_conversations.pop(conv["id"], None)
                         if st.session_state.current_conversation_id == conv["id"]:
                             if st.session_state.ai_conversations:
-                                st.session_state.current_conversation_id = st.session_state.ai_conversations[0]["id"]
+                                st.session_state.current_conversation_id = next(iter(st.session_state.ai_conversations))
                             else:
                                 create_new_conversation()
                         st.rerun()
 
                 st.caption(f"🕐 {conv['created_at'].split('T')[0]}")
 
+        if st.session_state.get("conversations_has_more"):
+            if st.button("加载更早的对话", use_container_width=True, key="more_convs"):
+                load_more_conversations()
+                st.rerun()
+
+        # 相似问题缓存命中率
+        answer_cache = get_chat_answer_cache()
+        if answer_cache.lookups:
+            st.caption(f"⚡ 相似问题缓存命中 {answer_cache.hits}/{answer_cache.lookups}（{answer_cache.hit_rate:.0%}）")
+
     # 右侧：聊天区域
     with col2:
         conv = get_current_conversation()
@@ -1632,6 +4031,10 @@ def ai_chat_page():
         if not conv["messages"]:
             st.info("开始一个新的对话吧！有什么英语学习问题尽管问我。")
         else:
+            if conv.get("has_more"):
+                if st.button("加载更早的消息", icon=":material/expand_less:", key=f"older_{conv['id']}"):
+                    load_older_messages(conv)
+                    st.rerun()
             for message in conv["messages"]:
                 with st.chat_message(message["role"]):
                     st.write(message["content"])
@@ -1647,13 +4050,20 @@ def ai_chat_page():
             with st.chat_message("user"):
                 st.write(user_input)
 
-            # 获取上下文
-            context = get_conversation_context()
+            # 对话的第一个问题没有上下文，可以直接复用相似问题的回答
+            answer_cache = get_chat_answer_cache()
+            is_first_turn = conv.get("message_offset", 0) + len(conv["messages"]) == 1
+            cached_answer = answer_cache.get(user_input) if is_first_turn else None
 
             # 调用 AI
             with st.chat_message("assistant"):
                 with st.spinner("正在思考..."):
-                    response_stream = ask_ai_with_context(context)
+                    if cached_answer:
+                        response_stream = replay_answer(cached_answer)
+                    else:
+                        # 获取上下文
+                        context = get_conversation_context()
+                        response_stream = ask_ai_with_context(context)
 
                     if response_stream:
                         # 使用 st.write_stream 进行流式输出
@@ -1661,6 +4071,8 @@ def ai_chat_page():
 
                         # 添加助手消息
                         add_message_to_conversation("assistant", full_response)
+                        if is_first_turn and not cached_answer:
+                            answer_cache.put(user_input, full_response)
 
                         # AI 回答完成后，使用 rerun 刷新页面并滚动到底部
                         st.rerun()
@@ -1684,5 +4096,25 @@ def main():
     elif page == "AI 聊天":
         ai_chat_page()
 
+# 记录本次运行耗时：进程里第一次是冷启动（含第三方库导入），之后是每次 rerun 重新执行本文件的开销，
+# 分成加载（导入和模块级代码）和页面渲染（main）两段
+@st.cache_resource
+def _startup_state() -> Dict:
+    return {"cold": True}
+
+_run_kind = "冷启动" if _startup_state().pop("cold", False) else "重新执行"
+_module_loaded = time.perf_counter()
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    try:
+        main()
+    finally:
+        # st.rerun() / st.stop() 以异常结束 main，同样记一次
+        _finished = time.perf_counter()
+        logger.info(
+            "app.py %s耗时 %.1f ms（加载 %.1f ms，页面渲染 %.1f ms）",
+            _run_kind,
+            (_finished - _module_started) * 1000,
+            (_module_loaded - _module_started) * 1000,
+            (_finished - _module_loaded) * 1000
+        )
\ No newline at end of file
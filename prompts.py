@@ -0,0 +1,407 @@
+# 提示词注册表：出题和批改的模板文本、共用的系统提示词、预编译的模板对象和本地 token 估算。
+# 只依赖标准库，app.py 在进程里建一次注册表（get_prompt_registry）
+import hashlib
+import re
+import string
+from typing import Dict, List, Optional
+
+# 各题型的出题提示词（作答字数要求也从这里读取）
+QUESTION_PROMPTS = {
+    "Phrase Practice": """请生成一个CET4水平的短语造句题目。每次生成必须完全不同，不要重复之前的题目。
+要求：
+1. 给出1-2个CET4写作常用短语或搭配（如：in addition、as a result、pay attention to等）
+2. 要求学生用给定的短语造句
+3. 短语场景要多样化，涵盖学习、生活、工作、环境等不同主题
+4. 每次选择不同的短语
+5. 建议作答时间：3-5分钟
+6. 造句约10-20词
+
+返回JSON格式：
+{{
+    "phrases": ["短语1", "短语2（可选）"],
+    "hint": "提示信息（可以给一个造句场景或主题建议）"
+}}""",
+
+    "Translation": """请生成一个CET4水平的英译中题目。每次生成必须完全不同，不要重复之前的题目。
+要求：
+1. 中文句子表达常见场景（学习、生活、工作）
+2. 包含2-3个重点词汇或短语
+3. 适合CET4词汇水平
+4. 场景要多样化，不要重复
+5. 建议作答时间：5-8分钟
+6. 翻译后英文约15-25词
+
+返回JSON格式：
+{{
+    "chinese_sentence": "中文句子",
+    "key_words": ["重点词1", "重点词2"],
+    "hint": "提示信息"
+}}""",
+
+    "Transition Practice": """请生成一个CET4水平的过渡练习题目。每次生成必须完全不同，不要重复之前的题目。
+要求：
+1. 给出两个独立的句子片段或观点
+2. 要求学生用合适的过渡词/过渡句连接起来
+3. 过渡词要多样化（如：however、therefore、in addition、on the other hand等）
+4. 场景要多样化，不要重复
+5. 建议作答时间：3-5分钟
+6. 连接后约20-30词
+
+返回JSON格式：
+{{
+    "part1": "第一部分句子",
+    "part2": "第二部分句子",
+    "hint": "提示可能的过渡词类型"
+}}""",
+
+    "Sentence Structure": """请生成一个CET4水平的句式练习题目。每次生成必须完全不同，不要重复之前的题目。
+要求：
+1. 给出一个常用句型结构（如：It is...that...、There is no doubt that...、Not only...but also...、It is universally acknowledged that...等）
+2. 要求学生用这个句型造句
+3. 句型要多样化，每次选择不同的句型
+4. 建议作答时间：3-5分钟
+5. 造句约15-25词
+
+返回JSON格式：
+{{
+    "structure": "句型结构",
+    "structure_example": "句型示例（可选）",
+    "hint": "提示信息（可以给一个造句主题）"
+}}""",
+
+    "Sentence Variety": """请生成一个CET4水平的句式多样性题目。每次生成必须完全不同，不要重复之前的题目。
+要求：
+1. 给出一个普通句型
+2. 要求学生改写成特定句型（如：倒装句、强调句、被动语态、虚拟语气等）
+3. 句型转换类型要多样化
+4. 内容场景要多样化
+5. 建议作答时间：5-7分钟
+6. 改写后句子约15-25词
+
+返回JSON格式：
+{{
+    "original_sentence": "原句",
+    "target_type": "目标句型（如倒装句/强调句/被动语态等）",
+    "hint": "提示信息"
+}}""",
+
+    "Sentence Correction": """请生成一个CET4水平的病句题目。每次生成必须完全不同，不要重复之前的题目。
+要求：
+1. 句子长度15-25词
+2. 包含常见的语法错误（如时态、主谓一致、冠词、介词等）
+3. 错误要隐蔽但有迹可循
+4. 内容要多样化，涵盖学习、生活、工作等不同场景
+5. 建议作答时间：3-5分钟
+
+返回JSON格式：
+{{
+    "question": "包含错误的句子",
+    "error_type": "错误类型",
+    "hint": "提示信息（不直接给出答案）"
+}}""",
+
+    "Paraphrasing": """请生成一个CET4水平的改写题目。每次生成必须完全不同，不要重复之前的题目。
+要求：
+1. 给出一个表达清晰的句子
+2. 要求学生换一种方式表达相同意思
+3. 使用不同的词汇或句式
+4. 句子内容要多样化，不要重复
+5. 建议作答时间：5-8分钟
+6. 改写后句子约15-25词
+
+返回JSON格式：
+{{
+    "original_sentence": "原句",
+    "hint": "提示信息（如可以使用的同义词或句型）"
+}}"""
+}
+
+# 各题型批改的固定说明（评分规则和返回格式），放在系统提示词里，同一题型的每次批改都一样
+EVALUATION_INSTRUCTIONS = {
+    "Phrase Practice": """你是我同桌，用轻松亲切的中文口吻批改，多鼓励。给出参考造句和更多示例。
+如果用户造句中有错误或可以改进的地方，请在 details 中列出，包含：
+- type: 错误类型标签，严格按照以下规则分类：
+  * "注意"：语法错误（时态、主谓一致、冠词、介词等）或单词错误（拼写错误、用词错误、词汇选择不当等）
+  * "建议"：语法和单词都正确，仅仅是表达不够流畅、不够优美或可以更地道
+  * "其他"：不属于以上两种情况的问题
+- original_sentence: 用户句子中可以改进的部分（保持原样）
+- correction: 更好的表达建议，英文部分必须用英文表达
+
+返回JSON格式：
+{
+    "summary": "整体评价（中文）",
+    "reference_sentence": "参考造句（英文）",
+    "high_score_expression": "更多示例（英文）",
+    "details": [
+        {
+            "type": "注意/建议/其他",
+            "original_sentence": "用户句子中可以改进的部分",
+            "correction": "更好的表达建议（英文部分用英文）"
+        }
+    ]
+}""",
+
+    "Translation": """你是我同桌，用轻松亲切的中文口吻批改，多鼓励。给出参考译文和高分表达。
+如果用户答案中有错误或可以改进的地方，请在 details 中列出，包含：
+- type: 错误类型标签，严格按照以下规则分类：
+  * "注意"：语法错误（时态、主谓一致、冠词、介词等）或单词错误（拼写错误、用词错误、词汇选择不当等）
+  * "建议"：语法和单词都正确，仅仅是表达不够流畅、不够优美或可以更地道
+  * "其他"：不属于以上两种情况的问题
+- original_sentence: 用户有问题的原句片段（保持原样）
+- correction: 修改建议，英文部分必须用英文表达，中文部分用中文表达
+
+返回JSON格式：
+{
+    "summary": "整体评价（中文）",
+    "reference_translation": "参考译文（英文）",
+    "high_score_expression": "高分表达（英文）",
+    "details": [
+        {
+            "type": "注意/建议/其他",
+            "original_sentence": "用户有问题的原句片段",
+            "correction": "修改建议（英文部分用英文，中文部分用中文）"
+        }
+    ]
+}""",
+
+    "Transition Practice": """你是我同桌，用轻松亲切的中文口吻批改，多鼓励。给出参考答案和更多过渡词选择。
+如果用户答案中的过渡词使用可以改进，请在 details 中列出，包含：
+- type: 错误类型标签，严格按照以下规则分类：
+  * "注意"：语法错误（时态、主谓一致、冠词、介词等）或单词错误（拼写错误、用词错误、词汇选择不当等）
+  * "建议"：语法和单词都正确，仅仅是表达不够流畅、不够优美或可以更地道
+  * "其他"：不属于以上两种情况的问题
+- original_sentence: 用户的原句（保持原样）
+- correction: 更好的过渡词选择和解释，英文部分必须用英文表达
+
+返回JSON格式：
+{
+    "summary": "整体评价（中文）",
+    "reference_answer": "参考答案（英文）",
+    "high_score_expression": "更多过渡词（英文）",
+    "details": [
+        {
+            "type": "注意/建议/其他",
+            "original_sentence": "用户的原句",
+            "correction": "更好的过渡词选择和解释（英文部分用英文）"
+        }
+    ]
+}""",
+
+    "Sentence Structure": """你是我同桌，用轻松亲切的中文口吻批改，多鼓励。给出参考造句和更多示例。
+如果用户造句中有错误或可以改进的地方，请在 details 中列出，包含：
+- type: 错误类型标签，严格按照以下规则分类：
+  * "注意"：语法错误（时态、主谓一致、冠词、介词等）或单词错误（拼写错误、用词错误、词汇选择不当等）
+  * "建议"：语法和单词都正确，仅仅是表达不够流畅、不够优美或可以更地道
+  * "其他"：不属于以上两种情况的问题
+- original_sentence: 用户句子中可以改进的部分（保持原样）
+- correction: 更好的表达建议，英文部分必须用英文表达
+
+返回JSON格式：
+{
+    "summary": "整体评价（中文）",
+    "reference_sentence": "参考造句（英文）",
+    "high_score_expression": "更多示例（英文）",
+    "details": [
+        {
+            "type": "注意/建议/其他",
+            "original_sentence": "用户句子中可以改进的部分",
+            "correction": "更好的表达建议（英文部分用英文）"
+        }
+    ]
+}""",
+
+    "Sentence Variety": """你是我同桌，用轻松亲切的中文口吻批改，多鼓励。给出参考答案和其他转换方式。
+如果用户答案中的句式转换可以改进，请在 details 中列出，包含：
+- type: 错误类型标签，严格按照以下规则分类：
+  * "注意"：语法错误（时态、主谓一致、冠词、介词等）或单词错误（拼写错误、用词错误、词汇选择不当等）
+  * "建议"：语法和单词都正确，仅仅是表达不够流畅、不够优美或可以更地道
+  * "其他"：不属于以上两种情况的问题
+- original_sentence: 用户的原句（保持原样）
+- correction: 更好的转换方式和解释，英文部分必须用英文表达
+
+返回JSON格式：
+{
+    "summary": "整体评价（中文）",
+    "reference_answer": "参考答案（英文）",
+    "high_score_expression": "其他方式（英文）",
+    "details": [
+        {
+            "type": "注意/建议/其他",
+            "original_sentence": "用户的原句",
+            "correction": "更好的转换方式和解释（英文部分用英文）"
+        }
+    ]
+}""",
+
+    "Sentence Correction": """你是我同桌，用轻松亲切的中文口吻批改，多鼓励。请判断用户是否正确改出了原句中的错误。给出正确答案和高分表达。
+
+重要提示：你需要对比用户改写后的答案和正确的改写答案，判断用户的改写是否完全正确。
+
+如果用户改写后仍然有错误（没有完全改对，或者改写时引入了新的错误），请在 details 中列出每个问题，包含：
+- type: 错误类型标签，严格按照以下规则分类：
+  * "注意"：语法错误（时态、主谓一致、冠词、介词等）或单词错误（拼写错误、用词错误、词汇选择不当等）。这是四级作文一定会扣分的错误，必须改。
+  * "建议"：语法和单词都正确，仅仅是表达不够流畅、不够优美或可以更地道。不改也没问题，但改了会更好。
+  * "其他"：不属于以上两种情况的问题
+- original_sentence: 用户改写后仍然错误或可以改进的部分（保持原样）
+- correction: 正确的改法或更好的表达，英文部分必须用英文表达，中文部分用中文表达
+
+如果用户完全改对了，details 可以为空列表。
+
+返回JSON格式：
+{
+    "summary": "整体评价（中文），说明用户是否正确改出了错误",
+    "correct_answer": "正确答案（英文）",
+    "high_score_expression": "高分表达（英文）",
+    "details": [
+        {
+            "type": "注意/建议/其他",
+            "original_sentence": "用户改写后仍然错误或可以改进的部分",
+            "correction": "正确的改法或更好的表达（英文部分用英文，中文部分用中文）"
+        }
+    ]
+}""",
+
+    "Paraphrasing": """你是我同桌，用轻松亲切的中文口吻批改，多鼓励。给出参考改写和更好的改写方式。
+如果用户答案中的改写可以改进，请在 details 中列出，包含：
+- type: 错误类型标签，严格按照以下规则分类：
+  * "注意"：语法错误（时态、主谓一致、冠词、介词等）或单词错误（拼写错误、用词错误、词汇选择不当等）
+  * "建议"：语法和单词都正确，仅仅是表达不够流畅、不够优美或可以更地道
+  * "其他"：不属于以上两种情况的问题
+- original_sentence: 用户的改写（保持原样）
+- correction: 更好的改写方式和解释，英文部分必须用英文表达
+
+返回JSON格式：
+{
+    "summary": "整体评价（中文）",
+    "reference_paraphrase": "参考改写（英文）",
+    "high_score_expression": "更好的方式（英文）",
+    "details": [
+        {
+            "type": "注意/建议/其他",
+            "original_sentence": "用户的改写",
+            "correction": "更好的改写方式和解释（英文部分用英文）"
+        }
+    ]
+}"""
+}
+
+# 各题型批改的题目和答案，{字段} 由 prompt_fields() 从题目和用户答案填入，放在消息最后
+EVALUATION_PROMPTS = {
+    "Phrase Practice": """请批改以下短语造句题目。
+
+短语：{phrases}
+用户造句：{user_answer}""",
+
+    "Translation": """请批改以下翻译题目。
+
+中文句子：{chinese_sentence}
+重点词汇：{key_words}
+用户答案：{user_answer}""",
+
+    "Transition Practice": """请批改以下过渡练习题目。
+
+第一部分：{part1}
+第二部分：{part2}
+用户答案：{user_answer}""",
+
+    "Sentence Structure": """请批改以下句式练习题目。
+
+句型结构：{structure}
+用户造句：{user_answer}""",
+
+    "Sentence Variety": """请批改以下句式多样性题目。
+
+原句：{original_sentence}
+目标句型：{target_type}
+用户答案：{user_answer}""",
+
+    "Sentence Correction": """请批改以下句子改错题目。
+
+原句（包含错误）：{question}
+错误类型：{error_type}
+用户改写后的答案：{user_answer}""",
+
+    "Paraphrasing": """请批改以下改写题目。
+
+原句：{original_sentence}
+用户答案：{user_answer}"""
+}
+
+# 出题和批改共用的系统提示词，放在系统消息最前面且一字不变
+PROMPT_SYSTEM_PREFIX = "你是一个专业的英语教学助手，专门帮助CET4学生提升写作能力。请严格按照JSON格式返回。"
+
+# 出题模板开头的固定要求（原来在出题的系统提示词里，放到模板里以保持系统提示词和批改共用）
+QUESTION_PROMPT_PREFIX = "每次生成题目时都要确保内容完全不同，不要重复。"
+
+# 本地估算 token 数：汉字和标点各算 1 个，英文单词和数字约每 4 个字符 1 个，每条消息另加 4 个格式开销
+def estimate_tokens(text: str) -> int:
+    tokens = 0
+    for match in re.finditer(r"[A-Za-z]+|\d+|\S", text or ""):
+        piece = match.group(0)
+        tokens += (len(piece) + 3) // 4 if piece[0].isascii() and piece[0].isalnum() else 1
+    return tokens
+
+# AI 聊天的系统提示词（单次提问和多轮对话共用）
+CHAT_SYSTEM_PROMPT = "你是我的英语学习搭子！我们都是四级备考的战友。请用轻松、口语化的中文跟我交流，就像朋友聊天一样。回答问题时：1）不要追求简洁，可以详细展开讲；2）结合四级备考的背景，补充相关的考点、高频词汇、易错点等；3）多用例子和场景帮助理解；4）鼓励我，给我实用的学习建议。记住：我们是朋友，不是师生！"
+
+# 预编译的提示词模板
+class PromptTemplate:
+    """创建时拆好字面文本和 {字段}，拼好系统消息，算好版本号和固定部分的 token 数，并带上返回 JSON 的校验规则。
+    系统消息是共用前缀加本模板的固定说明（instructions），题目、答案等字段都在之后的用户消息里，
+    同一模板的每次调用开头完全相同，服务端的提示词缓存可以命中。
+    版本号是系统消息加模板文本的哈希，模板一改就变，可以直接用作结果缓存的键；
+    tokens 是系统消息和模板字面文本的估算 token 数（含两条消息的格式开销），不含填入的字段"""
+
+    __slots__ = ("kind", "mode", "version", "schema", "system", "tokens", "_parts")
+
+    def __init__(self, kind: str, mode: str, text: str, schema: Dict, instructions: str = ""):
+        self.kind = kind
+        self.mode = mode
+        self.system = f"{PROMPT_SYSTEM_PREFIX}\n\n{instructions}" if instructions else PROMPT_SYSTEM_PREFIX
+        self._parts = [(literal, field) for literal, field, _, _ in string.Formatter().parse(text)]
+        digest = hashlib.sha256(f"{self.system}\n{text}".encode("utf-8")).hexdigest()[:12]
+        self.version = f"{kind}/{mode}@{digest}"
+        self.schema = schema
+        static_text = "".join(literal for literal, _ in self._parts)
+        self.tokens = estimate_tokens(self.system) + estimate_tokens(static_text) + 8
+
+    def render(self, fields: Optional[Dict] = None) -> str:
+        fields = fields or {}
+        return "".join(
+            literal + (str(fields.get(field, "")) if field is not None else "")
+            for literal, field in self._parts
+        )
+
+    def messages(self, fields: Optional[Dict] = None, suffix: str = "") -> List[Dict]:
+        """suffix 接在模板后面（如薄弱点提示），不打断系统消息和模板开头组成的公共前缀"""
+        prompt = self.render(fields)
+        if suffix:
+            prompt = f"{prompt}\n\n{suffix}"
+        return [
+            {"role": "system", "content": self.system},
+            {"role": "user", "content": prompt}
+        ]
+
+# 提示词注册表：按 (用途, 题型) 查模板，未知题型退回到 Sentence Correction
+class PromptRegistry:
+    def __init__(self):
+        self._templates: Dict[tuple, PromptTemplate] = {}
+
+    def register(self, kind: str, mode: str, text: str, schema: Dict, instructions: str = ""):
+        self._templates[(kind, mode)] = PromptTemplate(kind, mode, text, schema, instructions)
+
+    def get(self, kind: str, mode: str) -> PromptTemplate:
+        return self._templates.get((kind, mode)) or self._templates[(kind, "Sentence Correction")]
+
+    def tokens(self, kind: str, mode: str) -> int:
+        """模板固定部分的估算 token 数，每次调用的输入 token 至少是这么多"""
+        return self.get(kind, mode).tokens
+
+# 批改模板的填充字段：题目里的字段原样填入，列表用逗号连接
+def prompt_fields(question: Dict, user_answer: str = "") -> Dict:
+    fields = {
+        key: ", ".join(str(v) for v in value) if isinstance(value, list) else value
+        for key, value in (question or {}).items()
+    }
+    fields["user_answer"] = user_answer
+    return fields
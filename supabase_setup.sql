@@ -0,0 +1,141 @@
+-- CET4 微写作：Supabase 数据库补充设置
+-- 在 Supabase 控制台的 SQL Editor 中执行。基础表 practice_history、weakness_points、
+-- daily_questions 需已存在；这里的语句均可重复执行。
+
+-- 重新批改时用新薄弱点整体替换旧薄弱点，先删后插在同一个事务中完成
+create or replace function replace_weakness_points(p_record_id text, p_points jsonb)
+returns void
+language plpgsql
+as $$
+begin
+    delete from weakness_points where record_id = p_record_id;
+    insert into weakness_points (record_id, type, issue, correction, mode, "timestamp", client_id, signature)
+    select p_record_id, p.type, p.issue, p.correction, p.mode, p."timestamp", p.client_id, p.signature
+    from jsonb_populate_recordset(null::weakness_points, p_points) as p;
+end;
+$$;
+
+-- 侧边栏统计：总练习数、练习天数、连续天数、各类薄弱点数量，只返回一行 JSON
+create or replace function get_practice_stats(p_today date default current_date)
+returns jsonb
+language sql
+stable
+as $$
+    with days as (
+        select distinct left("timestamp"::text, 10)::date as d
+        from practice_history
+        where "timestamp" is not null
+    ),
+    islands as (
+        select d, d + (row_number() over (order by d desc))::int as grp
+        from days
+    )
+    select jsonb_build_object(
+        'total_practices', (select count(*) from practice_history),
+        'practice_days', (select count(*) from days),
+        'streak', (
+            select count(*) from islands
+            where grp = (select max(d) + 1 from days)
+              and (select max(d) from days) >= p_today - 1
+        ),
+        'weakness_total', (select count(*) from weakness_points),
+        'weakness_by_type', coalesce((
+            select jsonb_object_agg(t, c)
+            from (select coalesce(type, '其他') as t, count(*) as c from weakness_points group by 1) w
+        ), '{}'::jsonb),
+        'mode_counts', coalesce((
+            select jsonb_object_agg(m, c)
+            from (select coalesce(mode, '其他') as m, count(*) as c from practice_history group by 1) h
+        ), '{}'::jsonb)
+    );
+$$;
+
+-- 历史记录键集分页：按 (created_at, record_id) 倒序翻页
+create index if not exists practice_history_created_at_record_id_idx
+    on practice_history (created_at desc, record_id desc);
+
+-- 按日期范围查询当天的练习记录
+create index if not exists practice_history_timestamp_idx
+    on practice_history ("timestamp");
+
+-- 批改结果缓存（可选，设置 EVAL_CACHE_SUPABASE=1 时使用）
+create table if not exists evaluation_cache (
+    cache_key text primary key,
+    mode text,
+    evaluation jsonb not null,
+    created_at timestamptz not null default now()
+);
+
+-- 每日题目按 date_str 做 upsert，需要唯一约束
+create unique index if not exists daily_questions_date_str_key
+    on daily_questions (date_str);
+
+-- AI 聊天对话与消息
+create table if not exists ai_conversations (
+    id text primary key,
+    title text not null default '新对话',
+    created_at timestamptz not null default now(),
+    summary text,
+    summary_upto integer not null default 0
+);
+
+create index if not exists ai_conversations_created_at_idx
+    on ai_conversations (created_at desc);
+
+create table if not exists ai_messages (
+    id bigserial primary key,
+    conversation_id text not null references ai_conversations (id) on delete cascade,
+    role text not null,
+    content text not null,
+    "timestamp" timestamptz not null default now()
+);
+
+-- 按对话倒序分页读取消息
+create index if not exists ai_messages_conversation_id_id_idx
+    on ai_messages (conversation_id, id desc);
+
+-- 薄弱点页按类型、题型过滤后按时间分页
+create index if not exists weakness_points_type_mode_created_at_idx
+    on weakness_points (type, mode, created_at desc);
+
+-- 历史记录页按题型过滤后键集分页
+create index if not exists practice_history_mode_created_at_record_id_idx
+    on practice_history (mode, created_at desc, record_id desc);
+
+-- 记录每次批改的输出 token 数，用来按题型估算 max_tokens
+alter table practice_history add column if not exists completion_tokens integer;
+
+-- 写后队列重试时按唯一键去重：练习记录按 record_id，薄弱点按本地生成的 client_id
+create unique index if not exists practice_history_record_id_key
+    on practice_history (record_id);
+alter table weakness_points add column if not exists client_id text;
+create unique index if not exists weakness_points_client_id_idx
+    on weakness_points (client_id);
+
+-- 薄弱点的错误签名（应用写入时计算），薄弱点画像按 (type, mode, signature) 在数据库端聚合
+alter table weakness_points add column if not exists signature text;
+
+-- 薄弱点画像：每组一行计数、最新时间和最新一条的 issue / correction，
+-- 没有签名的旧数据按 (issue, correction) 分组；组按最新写入从旧到新排列
+create or replace function get_weakness_groups()
+returns jsonb
+language sql
+stable
+as $$
+    select coalesce(jsonb_agg(to_jsonb(g) - 'latest_id' order by g.latest_id), '[]'::jsonb)
+    from (
+        select
+            type,
+            mode,
+            signature,
+            (array_agg(issue order by id desc))[1] as issue,
+            (array_agg(correction order by id desc))[1] as correction,
+            count(*) as count,
+            max("timestamp")::text as "timestamp",
+            max(id) as latest_id
+        from weakness_points
+        group by type, mode, signature,
+            case when signature is null then issue end,
+            case when signature is null then correction end
+    ) g;
+$$;
@@ -0,0 +1,23 @@
+import os
+import sys
+
+import pytest
+
+# 测试直接导入仓库根目录下的 app.py（streamlit 以 bare 模式运行，不会执行 main）
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("STORAGE_BACKEND", "sqlite")
+
+import app as app_module
+
+
+@pytest.fixture
+def app():
+    return app_module
+
+
+@pytest.fixture
+def storage(app, tmp_path, monkeypatch):
+    """临时目录里的 SQLite 后端，同时替换掉 app 里的 get_storage"""
+    backend = app.SQLiteStorage(str(tmp_path / "test.db"))
+    monkeypatch.setattr(app, "get_storage", lambda: backend)
+    return backend
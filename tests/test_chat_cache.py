@@ -0,0 +1,43 @@
+import json
+import os
+
+
+def test_similar_questions_hit_and_dissimilar_miss(app, tmp_path):
+    cache = app.ChatAnswerCache(capacity=10, path=str(tmp_path / "cache.json"), threshold=0.6)
+    cache.put("请问 present perfect 和 past simple 有什么区别？", "区别在于……")
+
+    assert cache.get("present perfect 和 past simple 有什么区别呢") == "区别在于……"
+    assert cache.get("怎么背单词") is None
+    assert (cache.hits, cache.lookups) == (1, 2)
+
+
+def test_get_does_not_rewrite_the_file_on_every_lookup(app, tmp_path):
+    path = str(tmp_path / "cache.json")
+    cache = app.ChatAnswerCache(capacity=10, path=path, threshold=0.6, save_interval=3600)
+    cache.put("定语从句怎么用", "先找先行词……")
+    os.utime(path, ns=(0, 0))
+
+    assert cache.get("定语从句怎么用") == "先找先行词……"
+    assert os.stat(path).st_mtime_ns == 0
+
+    # 超过 save_interval 后下一次查询顺带写盘，命中次数随之保存
+    cache.save_interval = 0
+    cache.get("定语从句怎么用")
+    assert os.stat(path).st_mtime_ns > 0
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    assert (data["hits"], data["lookups"]) == (2, 2)
+    assert [e["hits"] for e in data["entries"].values()] == [2]
+
+
+def test_capacity_evicts_least_recently_used(app, tmp_path):
+    path = str(tmp_path / "cache.json")
+    cache = app.ChatAnswerCache(capacity=2, path=path, threshold=0.6)
+    cache.put("怎么写好作文开头", "a")
+    cache.put("虚拟语气的用法", "b")
+    cache.get("怎么写好作文开头")
+    cache.put("被动语态什么时候用", "c")
+
+    reloaded = app.ChatAnswerCache(capacity=2, path=path, threshold=0.6)
+    assert reloaded.get("怎么写好作文开头") == "a"
+    assert reloaded.get("虚拟语气的用法") is None
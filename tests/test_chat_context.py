@@ -0,0 +1,68 @@
+import pytest
+
+
+def make_conversation(count, offset=0, size=96):
+    # 每条消息按汉字计 size 个 token，再加 4 个格式开销
+    return {
+        "id": "c1",
+        "messages": [{"role": "user" if i % 2 == 0 else "assistant", "content": str(i % 10) + "中" * (size - 1)} for i in range(count)],
+        "message_offset": offset,
+        "summary": None
+    }
+
+
+@pytest.fixture
+def context(app, monkeypatch):
+    summarized = []
+
+    def fake_summary(conv, upto):
+        summarized.append(upto)
+        conv["summary"] = f"前 {upto} 条的摘要"
+        conv["summary_upto"] = upto
+
+    def build(conv, budget):
+        monkeypatch.setattr(app, "get_current_conversation", lambda: conv)
+        monkeypatch.setattr(app, "update_conversation_summary", fake_summary)
+        return app.get_conversation_context("c1", token_budget=budget)
+
+    build.summarized = summarized
+    return build
+
+
+def test_context_keeps_newest_messages_within_budget(context):
+    # 预留 320 给摘要，剩下 300 正好装下最后 3 条
+    conv = make_conversation(10, offset=5)
+    messages = context(conv, 620)
+    assert messages[0] == {"role": "system", "content": "之前的对话摘要：前 12 条的摘要"}
+    assert [m["content"] for m in messages[1:]] == [m["content"] for m in conv["messages"][7:]]
+    assert context.summarized == [12]
+
+
+def test_context_always_includes_the_newest_message(context):
+    conv = make_conversation(3, size=1000)
+    messages = context(conv, 620)
+    assert [m["content"] for m in messages[1:]] == [conv["messages"][-1]["content"]]
+
+
+def test_context_without_older_messages_needs_no_summary(context):
+    conv = make_conversation(3)
+    messages = context(conv, 3000)
+    assert [m["role"] for m in messages] == ["user", "assistant", "user"]
+    assert context.summarized == []
+
+
+def test_context_keeps_messages_after_a_lagging_summary(app, monkeypatch):
+    # 摘要只覆盖到第 10 条，窗口从第 12 条开始，落后不到 4 条不重新生成摘要
+    conv = make_conversation(10, offset=5)
+    conv["summary"] = "前 10 条的摘要"
+    conv["summary_upto"] = 10
+    monkeypatch.setattr(app, "get_current_conversation", lambda: conv)
+
+    def fail():
+        raise AssertionError("不应重新生成摘要")
+
+    monkeypatch.setattr(app, "get_llm_gateway", fail)
+    messages = app.get_conversation_context("c1", token_budget=620)
+    assert messages[0] == {"role": "system", "content": "之前的对话摘要：前 10 条的摘要"}
+    # 第 10、11 条不在摘要里，也要带上
+    assert [m["content"] for m in messages[1:]] == [m["content"] for m in conv["messages"][5:]]
@@ -0,0 +1,89 @@
+import time
+
+import pytest
+
+
+@pytest.fixture
+def clock(app, monkeypatch):
+    """可以手动拨动的 time.monotonic，只替换 app 模块看到的 time，其他函数照旧"""
+    now = [1000.0]
+
+    class Clock:
+        def __getattr__(self, name):
+            return getattr(time, name)
+
+        def monotonic(self):
+            return now[0]
+
+    monkeypatch.setattr(app, "time", Clock())
+    return now
+
+
+def counting_loader(values):
+    calls = []
+
+    def load():
+        calls.append(1)
+        return values[len(calls) - 1]
+
+    load.calls = calls
+    return load
+
+
+def test_entries_expire_after_ttl(app, clock):
+    cache = app.DataCache(ttl=60)
+    load = counting_loader(["old", "new"])
+    assert cache.get_or_load(("k",), ("practice_history",), load) == "old"
+
+    clock[0] += 59
+    assert cache.get_or_load(("k",), ("practice_history",), load) == "old"
+    assert len(load.calls) == 1
+
+    clock[0] += 1
+    assert cache.get_or_load(("k",), ("practice_history",), load) == "new"
+    assert len(load.calls) == 2
+
+
+def test_invalidate_only_drops_entries_of_that_table(app, clock):
+    cache = app.DataCache(ttl=60)
+    history = counting_loader(["h1", "h2"])
+    weakness = counting_loader(["w1", "w2"])
+    both = counting_loader(["b1", "b2"])
+    cache.get_or_load(("history",), ("practice_history",), history)
+    cache.get_or_load(("weakness",), ("weakness_points",), weakness)
+    cache.get_or_load(("stats",), ("practice_history", "weakness_points"), both)
+
+    cache.invalidate("weakness_points")
+
+    assert cache.get_or_load(("history",), ("practice_history",), history) == "h1"
+    assert cache.get_or_load(("weakness",), ("weakness_points",), weakness) == "w2"
+    assert cache.get_or_load(("stats",), ("practice_history", "weakness_points"), both) == "b2"
+
+
+def test_result_loaded_across_a_write_is_not_cached(app, clock):
+    cache = app.DataCache(ttl=60)
+    calls = []
+
+    def racing_load():
+        calls.append(1)
+        if len(calls) == 1:
+            # 读数据库期间另一个线程写入了这张表
+            cache.invalidate("practice_history")
+            return "stale"
+        return "fresh"
+
+    # 这次读到的结果照常返回给调用方，但不放进缓存
+    assert cache.get_or_load(("k",), ("practice_history",), racing_load) == "stale"
+    assert cache.get_or_load(("k",), ("practice_history",), racing_load) == "fresh"
+    assert cache.get_or_load(("k",), ("practice_history",), racing_load) == "fresh"
+    assert len(calls) == 2
+
+    # 写入的是无关的表时结果照常缓存
+    other = counting_loader(["v1", "v2"])
+
+    def load_during_other_write():
+        cache.invalidate("weakness_points")
+        return other()
+
+    assert cache.get_or_load(("other",), ("practice_history",), load_during_other_write) == "v1"
+    assert cache.get_or_load(("other",), ("practice_history",), other) == "v1"
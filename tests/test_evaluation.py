@@ -0,0 +1,138 @@
+import json
+
+import pytest
+
+EVALUATION = {
+    "summary": "整体不错，注意 \"冠词\" 的用法",
+    "details": [
+        {"original": "I have a apple.", "corrected": "I have an apple.", "comment": "元音前用 an"},
+        {"original": "He go home.", "corrected": "He goes home.", "comment": "第三人称单数 {s}"}
+    ],
+    "score": 8
+}
+
+
+def feed_in_chunks(parser, text, size):
+    events = []
+    for i in range(0, len(text), size):
+        events.extend(parser.feed(text[i:i + size]))
+    return events
+
+
+def test_stream_parser_yields_fields_and_details_for_any_chunking(app):
+    text = json.dumps(EVALUATION, ensure_ascii=False, indent=2)
+    for size in (1, 3, 7, len(text)):
+        parser = app.JsonStreamParser()
+        events = feed_in_chunks(parser, text, size)
+        assert events == [
+            ("field", ("summary", EVALUATION["summary"])),
+            ("detail", EVALUATION["details"][0]),
+            ("detail", EVALUATION["details"][1])
+        ]
+        assert parser.closed
+
+
+def test_stream_parser_stops_when_the_object_closes(app):
+    parser = app.JsonStreamParser()
+    events = parser.feed('```json\n{"summary": "好"}\n```\n{"summary": "多余"}')
+    assert events == [("field", ("summary", "好"))]
+    assert parser.closed
+    assert parser.feed('{"summary": "还是多余"}') == []
+
+
+def test_evaluation_cache_key_normalizes_the_answer(app):
+    question = {"chinese_sentence": "我爱你"}
+    key = app.evaluation_cache_key("Translation", question, "I love you.")
+    assert app.evaluation_cache_key("Translation", question, "  i   LOVE you. ") == key
+    assert app.evaluation_cache_key("Translation", question, "I love her.") != key
+    assert app.evaluation_cache_key("Paraphrasing", question, "I love you.") != key
+    assert app.evaluation_cache_key("Translation", {"chinese_sentence": "我恨你"}, "I love you.") != key
+
+
+def test_evaluation_cache_falls_back_to_storage_and_evicts_lru(app, storage, tmp_path):
+    path = str(tmp_path / "evaluation_cache.json")
+    cache = app.EvaluationCache(capacity=2, path=path, use_storage=True)
+    cache.put("k1", "Translation", {"summary": "1"})
+    cache.put("k2", "Translation", {"summary": "2"})
+    cache.get("k1")
+    cache.put("k3", "Translation", {"summary": "3"})
+
+    local = app.EvaluationCache(capacity=2, path=path, use_storage=False)
+    assert local.get("k2") is None
+    assert local.get("k1") == {"summary": "1"}
+    # 本地淘汰掉的仍能从存储层的 evaluation_cache 表取回
+    assert cache.get("k2") == {"summary": "2"}
+
+
+def test_refresh_reuses_the_answer_recorded_at_submit(app, tmp_path, monkeypatch):
+    question = {"chinese_sentence": "我爱你"}
+    cache = app.EvaluationCache(capacity=10, path=str(tmp_path / "evaluation_cache.json"), use_storage=False)
+    cache.put(app.evaluation_cache_key("Translation", question, "I love you."), "Translation", EVALUATION)
+    monkeypatch.setattr(app, "get_evaluation_cache", lambda: cache)
+    saved = []
+    monkeypatch.setattr(app, "save_practice", lambda record, update_record_id=None: saved.append((record, update_record_id)) or "r1")
+    monkeypatch.setattr(app, "replace_weakness_points", lambda record_id, points: None)
+    saved_points = []
+    monkeypatch.setattr(app, "save_weakness_points", lambda points, record_id=None: saved_points.append(record_id))
+
+    def fail(*args, **kwargs):
+        raise AssertionError("应命中提交时的批改缓存")
+
+    monkeypatch.setattr(app, "complete_json", fail)
+
+    app.st.session_state.question = question
+    app.st.session_state.evaluation = EVALUATION
+    app.st.session_state.user_answer = ""
+    app.finish_submission("Translation", "r1", "I love you.")
+    assert app.st.session_state.user_answer == "I love you."
+    assert app.st.session_state.current_record_id == "r1"
+    # 提交时的薄弱点和练习记录用同一个 record_id
+    assert saved_points == ["r1"]
+
+    refreshed = app.refresh_evaluation(
+        "Translation", question, app.st.session_state.user_answer,
+        record_id=app.st.session_state.current_record_id
+    )
+    assert refreshed == EVALUATION
+    assert saved[-1][0]["user_answer"] == "I love you."
+    assert saved[-1][1] == "r1"
+
+
+class FakeStream:
+    def __init__(self, text, size):
+        self.chunks = [text[i:i + size] for i in range(0, len(text), size)]
+        self.closed = False
+
+    def __iter__(self):
+        return iter(self.chunks)
+
+    def close(self):
+        self.closed = True
+
+
+def test_stream_evaluation_reports_events_and_replays_from_cache(app, tmp_path, monkeypatch):
+    text = json.dumps(EVALUATION, ensure_ascii=False) + "\n多余的输出"
+    stream = FakeStream(text, 5)
+    monkeypatch.setattr(app, "get_llm_gateway", lambda: type("Gateway", (), {"stream": lambda self, **kwargs: stream})())
+    monkeypatch.setattr(app, "get_generation_budget", lambda: app.GenerationBudget(str(tmp_path / "budget.json")))
+    cache = app.EvaluationCache(capacity=10, path=str(tmp_path / "evaluation_cache.json"), use_storage=False)
+    monkeypatch.setattr(app, "get_evaluation_cache", lambda: cache)
+    question = {"chinese_sentence": "我有一个苹果"}
+
+    events = []
+    result, tokens = app.evaluate_answer_stream("Translation", question, "I have a apple.", on_event=lambda *e: events.append(e))
+    assert result == EVALUATION
+    assert tokens > 0
+    assert stream.closed
+    expected = [
+        ("field", ("summary", EVALUATION["summary"])),
+        ("detail", EVALUATION["details"][0]),
+        ("detail", EVALUATION["details"][1])
+    ]
+    assert events == expected
+
+    # 第二次命中缓存，按同样的事件回放，不再调用模型
+    monkeypatch.setattr(app, "get_llm_gateway", lambda: pytest.fail("命中缓存时调用了模型"))
+    replayed = []
+    assert app.evaluate_answer_stream("Translation", question, "I have a apple.", on_event=lambda *e: replayed.append(e)) == (EVALUATION, None)
+    assert replayed == expected
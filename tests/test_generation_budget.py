@@ -0,0 +1,64 @@
+import pytest
+
+
+@pytest.fixture
+def budget(app, tmp_path):
+    return app.GenerationBudget(str(tmp_path / "generation_budget.json"), window=50, min_samples=5, margin=1.3)
+
+
+def test_few_samples_use_the_default_but_never_shrink(budget):
+    assert budget.max_tokens("evaluation", "Translation") == 800
+    budget.seed("evaluation", "Translation", [300, 900])
+    # 样本不足 5 个：只放宽到最长的样本，不按 p95 收紧
+    assert budget.sample_count("evaluation", "Translation") == 2
+    assert budget.max_tokens("evaluation", "Translation") == 900
+    assert budget.max_tokens("evaluation", "Paraphrasing") == 800
+
+
+def test_enough_samples_use_p95_with_margin(budget):
+    budget.seed("evaluation", "Translation", [200] * 19 + [400])
+    # 20 个样本的 p95 取第 19 个（从 0 数），再乘 1.3 加 50
+    assert budget.max_tokens("evaluation", "Translation") == int(400 * 1.3) + 50
+
+
+def test_max_tokens_stays_within_floor_and_ceiling(budget):
+    budget.seed("evaluation", "Translation", [10] * 10)
+    assert budget.max_tokens("evaluation", "Translation") == 300
+    budget.seed("question", "Translation", [5000] * 10)
+    assert budget.max_tokens("question", "Translation") == 1000
+    # 样本不足时同样不超过上限
+    budget.seed("question", "Paraphrasing", [5000])
+    assert budget.max_tokens("question", "Paraphrasing") == 1000
+
+
+def test_seed_keeps_the_newest_window_behind_local_samples(app, tmp_path):
+    budget = app.GenerationBudget(str(tmp_path / "generation_budget.json"), window=3)
+    budget.observe("evaluation", "Translation", "word " * 40, 800, True)
+    budget.seed("evaluation", "Translation", [100, 200, 300, None])
+    assert budget._samples["evaluation|Translation"] == [200, 300, 40]
+
+
+def test_truncated_output_is_recorded_at_one_and_a_half_times_the_limit(app, budget, tmp_path):
+    text = "word " * 90
+    # 没闭合且接近上限，按上限的 1.5 倍记
+    assert budget.observe("evaluation", "Translation", text, 100, closed=False) == 150
+    # 闭合了就按实际长度记
+    assert budget.observe("evaluation", "Translation", text, 100, closed=True) == 90
+    # 没闭合但离上限还远（如请求中途出错），也按实际长度记
+    assert budget.observe("evaluation", "Translation", "word " * 10, 100, closed=False) == 10
+
+    # 样本写进文件，重启后仍在
+    reloaded = app.GenerationBudget(str(tmp_path / "generation_budget.json"), min_samples=5)
+    assert reloaded.sample_count("evaluation", "Translation") == 3
+    # 样本不足时取默认值和最长样本中较大的
+    assert reloaded.max_tokens("evaluation", "Translation") == 800
+
+
+def test_truncation_raises_the_next_limit(budget):
+    budget.seed("question", "Translation", [300] * 10)
+    before = budget.max_tokens("question", "Translation")
+    assert before == int(300 * 1.3) + 50
+    for _ in range(2):
+        budget.observe("question", "Translation", "word " * before, before, closed=False)
+    # 12 个样本里有 2 个按 1.5 倍记，p95 落在截断样本上
+    assert budget.max_tokens("question", "Translation") == min(1000, int(before * 1.5 * 1.3) + 50)
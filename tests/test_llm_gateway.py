@@ -0,0 +1,129 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """模拟 OpenAI 兼容接口的 /chat/completions，行为由 server.script 里的函数依次决定"""
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        self.server.requests.append(body)
+        self.server.script.pop(0)(self, body)
+
+    def send_json(self, status, payload):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def start_stream(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+
+    def send_chunk(self, content):
+        chunk = {
+            "id": "c", "object": "chat.completion.chunk", "created": 0, "model": "stub",
+            "choices": [{"index": 0, "delta": {"content": content}, "finish_reason": None}]
+        }
+        self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+        self.wfile.flush()
+
+
+def unavailable(handler, body):
+    handler.send_json(503, {"error": {"message": "busy"}})
+
+
+def answer(handler, body):
+    handler.send_json(200, {
+        "id": "c", "object": "chat.completion", "created": 0, "model": "stub",
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": "ok"}, "finish_reason": "stop"}]
+    })
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    httpd.requests, httpd.script = [], []
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield httpd
+    httpd.shutdown()
+
+
+@pytest.fixture
+def gateway(app, server):
+    return app.LLMGateway(
+        api_key="test",
+        base_url=f"http://127.0.0.1:{server.server_port}/v1",
+        timeout=3,
+        max_retries=2,
+        max_concurrency=2
+    )
+
+
+def test_complete_retries_server_errors(server, gateway, monkeypatch):
+    monkeypatch.setattr(gateway, "_backoff", lambda attempt, error: 0.01)
+    server.script += [unavailable, unavailable, answer]
+    assert gateway.complete([{"role": "user", "content": "hi"}]) == "ok"
+    assert len(server.requests) == 3
+
+
+def test_complete_gives_up_after_max_retries(server, gateway, monkeypatch):
+    import openai
+
+    monkeypatch.setattr(gateway, "_backoff", lambda attempt, error: 0.01)
+    server.script += [unavailable, unavailable, unavailable]
+    with pytest.raises(openai.APIStatusError):
+        gateway.complete([{"role": "user", "content": "hi"}])
+    assert len(server.requests) == 3
+
+
+def test_closing_stream_cancels_request(server, gateway):
+    disconnected = threading.Event()
+    sent = []
+
+    def slow_stream(handler, body):
+        assert body["stream"] is True
+        handler.start_stream()
+        try:
+            for i in range(200):
+                handler.send_chunk(str(i))
+                sent.append(i)
+                time.sleep(0.02)
+        except OSError:
+            disconnected.set()
+
+    server.script.append(slow_stream)
+    response = gateway.stream([{"role": "user", "content": "hi"}])
+    assert next(response) == "0"
+    response.close()
+    assert disconnected.wait(3)
+    assert len(sent) < 200
+
+
+def test_stream_times_out_when_loop_is_gone(app, monkeypatch):
+    from concurrent.futures import Future
+
+    gateway = app.LLMGateway(api_key="test", base_url="http://127.0.0.1:9/v1", timeout=0.2, max_retries=0, max_concurrency=1)
+
+    # 模拟事件循环线程已经退出：提交的协程永远不会执行
+    def never_run(coro, loop):
+        coro.close()
+        return Future()
+
+    monkeypatch.setattr(app.asyncio, "run_coroutine_threadsafe", never_run)
+    started = time.monotonic()
+    with pytest.raises(TimeoutError):
+        gateway.stream([{"role": "user", "content": "hi"}])
+    with pytest.raises(TimeoutError):
+        gateway.complete([{"role": "user", "content": "hi"}])
+    assert time.monotonic() - started < 5
@@ -0,0 +1,32 @@
+def test_question_schema_follows_required_fields(app):
+    registry = app.get_prompt_registry()
+    for mode, fields in app.QUESTION_REQUIRED_FIELDS.items():
+        assert set(registry.get("question", mode).schema) == set(fields)
+
+
+def test_question_without_phrases_is_rejected(app):
+    schema = app.get_prompt_registry().get("question", "Phrase Practice").schema
+    assert "缺少字段 phrases" in app.validate_json({"requirement": "造句"}, schema)
+    assert "缺少字段 phrases" in app.validate_json({"phrases": []}, schema)
+    assert not app.is_valid_question("Phrase Practice", {"phrases": []})
+    assert app.is_valid_question("Phrase Practice", {"phrases": ["as a result"]})
+
+
+def test_evaluation_only_checks_fields_the_page_reads(app):
+    reply = '{"summary": "不错", "details": [], "high_score_expression": ["a", "b"], "reference_sentence": null}'
+    assert app.parse_llm_json(reply, app.EVALUATION_SCHEMA, allow_llm_fix=False)["high_score_expression"] == ["a", "b"]
+    assert app.validate_json({"details": "x"}, app.EVALUATION_SCHEMA) == ["缺少字段 summary", "字段 details 类型应为 list"]
+
+
+def test_repair_json_keeps_curly_quotes_inside_strings(app):
+    import json
+
+    assert json.loads(app.repair_json('{"a": "用 “however”, 而不是 but", "b": "x",}')) == {"a": "用 “however”, 而不是 but", "b": "x"}
+    assert json.loads(app.repair_json('{"a": "说“好”"}')) == {"a": "说“好”"}
+
+
+def test_repair_json_converts_curly_delimiters(app):
+    import json
+
+    assert json.loads(app.repair_json('{“a”: “用法”, “b”: [“x”, “y”]}')) == {"a": "用法", "b": ["x", "y"]}
+    assert json.loads(app.repair_json('{"summary": "好", "details": [{"issue": "a')) == {"summary": "好", "details": [{"issue": "a"}]}
@@ -0,0 +1,57 @@
+def levels(issues):
+    return [issue["level"] for issue in issues]
+
+
+def test_empty_or_non_english_answers_are_blocked(app):
+    assert levels(app.precheck_answer("Translation", {}, "   ")) == ["error"]
+    assert levels(app.precheck_answer("Translation", {}, "我爱你")) == ["error"]
+
+
+def test_copying_the_original_sentence_is_blocked(app):
+    question = {"original_sentence": "The weather is nice today, so we decide to go hiking in the mountains together."}
+    issues = app.precheck_answer("Paraphrasing", question, "the weather is NICE today so we decide to go hiking in the mountains together")
+    assert "error" in levels(issues)
+
+    question = {"question": "He go to school by bus every day and he always arrive late for the first class."}
+    issues = app.precheck_answer("Sentence Correction", question, question["question"])
+    assert any("病句" in issue["message"] for issue in issues)
+
+
+def test_untranslated_chinese_is_a_warning(app):
+    issues = app.precheck_answer("Translation", {}, "I really like eating 饺子 together with my whole family during the Spring Festival every single year.")
+    assert levels(issues) == ["warning"]
+    assert "饺子" in issues[0]["message"]
+
+
+def test_required_phrases_allow_inflections(app):
+    question = {"phrases": ["pay attention to sth.", "be fond of"]}
+    answer = "She paid close attention to the details because she was always fond of careful work."
+    assert app.precheck_answer("Phrase Practice", question, answer) == []
+
+    issues = app.precheck_answer("Phrase Practice", question, "She looked at the details because she always liked careful work.")
+    assert [issue["message"] for issue in issues] == [
+        "没有找到要求的短语「pay attention to sth.」（如果用了不规则变形可以忽略）",
+        "没有找到要求的短语「be fond of」（如果用了不规则变形可以忽略）"
+    ]
+
+
+def test_structure_fragments_must_appear_in_order(app):
+    question = {"structure": "Not only...but also..."}
+    answer = "Not only does reading improve your vocabulary, but it also helps you write better essays in the exam."
+    assert app.precheck_answer("Sentence Structure", question, answer) == []
+
+
+def test_answer_length_outside_the_prompt_range_is_a_warning(app):
+    low, high = app.ANSWER_LENGTH_BOUNDS["Translation"]
+    assert levels(app.precheck_answer("Translation", {}, "I love you.")) == ["warning"]
+    long_answer = " ".join(["word"] * (high * 2 + 1))
+    assert "明显超出" in app.precheck_answer("Translation", {}, long_answer)[0]["message"]
+
+
+def test_answer_over_the_prompt_token_limit_is_blocked(app, monkeypatch):
+    template_tokens = app.get_prompt_registry().tokens("evaluation", "Translation")
+    monkeypatch.setattr(app, "get_setting", lambda name, default=None: template_tokens + 50 if name == "EVAL_PROMPT_TOKEN_LIMIT" else default)
+    question = {"chinese_sentence": "我爱你"}
+    assert "error" not in levels(app.precheck_answer("Translation", question, "I love you " * 10))
+    issues = app.precheck_answer("Translation", question, "I love you " * 20)
+    assert any(issue["level"] == "error" and "tokens" in issue["message"] for issue in issues)
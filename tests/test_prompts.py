@@ -0,0 +1,30 @@
+import hashlib
+
+import prompts
+
+
+def test_template_precomputes_tokens_and_version():
+    template = prompts.PromptTemplate("evaluation", "Translation", "原句：{original_sentence}\nanswer: {user_answer}", {}, "只返回 JSON")
+
+    system = f"{prompts.PROMPT_SYSTEM_PREFIX}\n\n只返回 JSON"
+    assert template.tokens == prompts.estimate_tokens(system) + prompts.estimate_tokens("原句：\nanswer: ") + 8
+    digest = hashlib.sha256(f"{system}\n原句：{{original_sentence}}\nanswer: {{user_answer}}".encode("utf-8")).hexdigest()[:12]
+    assert template.version == f"evaluation/Translation@{digest}"
+
+    # 填入的字段不计入固定部分
+    messages = template.messages({"original_sentence": "我爱你", "user_answer": "I love you."})
+    assert messages == [
+        {"role": "system", "content": system},
+        {"role": "user", "content": "原句：我爱你\nanswer: I love you."}
+    ]
+
+
+def test_registry_exposes_token_counts(app):
+    registry = app.get_prompt_registry()
+    for kind in ("question", "evaluation"):
+        for mode in app.WRITING_MODES.values():
+            assert registry.tokens(kind, mode) == registry.get(kind, mode).tokens > 0
+    # 批改的固定说明在系统消息里，每种题型的开头都不随答案变化
+    first = registry.get("evaluation", "Paraphrasing").messages(app.prompt_fields({"original_sentence": "a"}, "b"))
+    second = registry.get("evaluation", "Paraphrasing").messages(app.prompt_fields({"original_sentence": "c"}, "d"))
+    assert first[0] == second[0] and first[1] != second[1]
@@ -0,0 +1,108 @@
+import time
+
+
+class NoHintProfile:
+    def prompt_hint(self, mode):
+        return ""
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "等待超时"
+        time.sleep(0.01)
+
+
+def test_fingerprint_only_uses_key_fields(app):
+    base = app.question_fingerprint("Translation", {"chinese_sentence": "我爱你", "hint": "注意时态"})
+    assert app.question_fingerprint("Translation", {"chinese_sentence": " 我爱你 ", "hint": "换个提示"}) == base
+    assert app.question_fingerprint("Translation", {"chinese_sentence": "你好", "hint": "注意时态"}) != base
+    # 关键字段相同但题型不同，不算同一道题
+    assert app.question_fingerprint("Paraphrasing", {"original_sentence": "I love you."}) != \
+        app.question_fingerprint("Sentence Variety", {"original_sentence": "I love you.", "target_type": ""})
+
+
+def test_pool_skips_duplicates_and_remembers_popped_questions(app, tmp_path, monkeypatch):
+    generated = {"Translation": [
+        {"chinese_sentence": "我爱你", "hint": "a"},
+        {"chinese_sentence": "我爱你", "hint": "只是提示不同"},
+        {"chinese_sentence": "你好", "hint": "c"}
+    ]}
+    monkeypatch.setattr(app, "request_question", lambda mode, hint="": (generated.get(mode) or [{}]).pop(0))
+    monkeypatch.setattr(app, "get_today_mode", lambda: "Translation")
+    path = str(tmp_path / "pool.json")
+    pool = app.QuestionPool(2, 1, path, NoHintProfile())
+
+    wait_until(lambda: len(pool._queues["Translation"]) == 2)
+    assert [q["chinese_sentence"] for q in pool._queues["Translation"]] == ["我爱你", "你好"]
+    assert pool.pop("Translation")["chinese_sentence"] == "我爱你"
+
+    # 重启后题库和最近出过的题目从本地文件恢复
+    reloaded = app.QuestionPool.__new__(app.QuestionPool)
+    reloaded.size, reloaded.path = 2, path
+    reloaded._queues = {mode: [] for mode in app.WRITING_MODES.values()}
+    reloaded._recent = []
+    reloaded._load()
+    assert [q["chinese_sentence"] for q in reloaded._queues["Translation"]] == ["你好"]
+    assert reloaded._recent == [app.question_fingerprint("Translation", {"chinese_sentence": "我爱你"})]
+
+
+def test_pool_fills_other_modes_only_on_demand(app, tmp_path, monkeypatch):
+    requested = []
+
+    def fake_request(mode, hint=""):
+        requested.append(mode)
+        return {"chinese_sentence": f"句子{len(requested)}", "original_sentence": f"Sentence {len(requested)}."}
+
+    monkeypatch.setattr(app, "request_question", fake_request)
+    monkeypatch.setattr(app, "get_today_mode", lambda: "Translation")
+    pool = app.QuestionPool(2, 1, str(tmp_path / "pool.json"), NoHintProfile())
+
+    wait_until(lambda: len(pool._queues["Translation"]) == 2)
+    # 启动时只补今天的题型
+    assert set(requested) == {"Translation"}
+
+    # 其他题型第一次取题时题库是空的，之后开始补
+    assert pool.pop("Paraphrasing") is None
+    wait_until(lambda: len(pool._queues["Paraphrasing"]) == 2)
+    assert set(requested) == {"Translation", "Paraphrasing"}
+
+
+def test_new_question_is_requested_while_the_profile_loads(app, monkeypatch):
+    import threading
+
+    requested = threading.Event()
+    overlapped = []
+
+    class SlowProfile:
+        loaded = False
+
+        def ensure_loaded(self):
+            # 出题请求要在画像建立期间发出，而不是排在它后面
+            overlapped.append(requested.wait(5))
+            self.loaded = True
+
+    def fake_request(mode, hint=""):
+        assert hint == ""
+        requested.set()
+        return {"chinese_sentence": "你好"}
+
+    monkeypatch.setattr(app, "get_question_pool", lambda: None)
+    monkeypatch.setattr(app, "get_weakness_profile", lambda: SlowProfile())
+    monkeypatch.setattr(app, "request_question", fake_request)
+    assert app.prepare_new_question("Translation") == {"chinese_sentence": "你好"}
+    assert overlapped == [True]
+
+
+def test_pool_logs_generation_failures(app, tmp_path, monkeypatch, caplog):
+    def broken_request(mode, hint=""):
+        raise ValueError("invalid api key")
+
+    monkeypatch.setattr(app, "request_question", broken_request)
+    monkeypatch.setattr(app, "get_today_mode", lambda: "Translation")
+    with caplog.at_level("WARNING", logger="cet4_writing_tutor"):
+        app.QuestionPool(2, 1, str(tmp_path / "pool.json"), NoHintProfile())
+        wait_until(lambda: any(r.exc_info for r in caplog.records))
+    record = next(r for r in caplog.records if r.exc_info)
+    assert "Translation" in record.getMessage()
+    assert "invalid api key" in str(record.exc_info[1])
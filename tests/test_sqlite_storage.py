@@ -0,0 +1,215 @@
+from datetime import date, datetime, timedelta
+
+import pytest
+
+
+def add_practice(storage, count, mode="Translation", start=datetime(2026, 10, 1, 8)):
+    rows = [
+        {
+            "record_id": f"r{i:03d}",
+            "mode": mode if i % 2 == 0 else "Paraphrasing",
+            "question": {"chinese_sentence": f"句子{i}"},
+            "user_answer": f"answer {i}",
+            "evaluation": {"summary": f"总结{i}", "details": []},
+            "timestamp": (start + timedelta(days=i // 2)).isoformat(),
+            # created_at 固定成同一时刻，分页只能靠 record_id 区分
+            "created_at": "2026-10-01T08:00:00.000"
+        }
+        for i in range(count)
+    ]
+    storage.insert("practice_history", rows)
+    return rows
+
+
+def test_insert_decodes_json_and_skips_conflicts(storage):
+    rows = add_practice(storage, 3)
+    record = storage.get_practice("r001", "*")
+    assert record["question"] == {"chinese_sentence": "句子1"}
+    assert storage.get_practice("r002", "summary:evaluation->>summary") == {"summary": "总结2"}
+
+    # 写后队列重试同一批时按唯一键跳过已写入的行
+    assert storage.insert("practice_history", rows, on_conflict="record_id") == []
+    assert len(storage.practice_page("record_id", None, 10, None)) == 3
+
+
+def test_practice_page_keyset_paging(storage):
+    add_practice(storage, 25)
+    seen, cursor = [], None
+    while True:
+        page = storage.practice_page("record_id,created_at", cursor, 10, None)
+        if not page:
+            break
+        seen.extend(row["record_id"] for row in page)
+        cursor = (page[-1]["created_at"], page[-1]["record_id"])
+    assert seen == [f"r{i:03d}" for i in range(24, -1, -1)]
+
+    translation = storage.practice_page("record_id,mode", None, 50, "Translation")
+    assert len(translation) == 13
+    assert {row["mode"] for row in translation} == {"Translation"}
+
+
+def test_history_pages_cross_tied_timestamps_without_gaps(app, storage, monkeypatch):
+    # 前 9 条 created_at 相同，后面几页的分界都落在相同的 created_at 上
+    storage.insert("practice_history", [
+        {
+            "record_id": f"r{i:03d}",
+            "mode": "Translation" if i % 3 else "Paraphrasing",
+            "created_at": "2026-10-01T08:00:00.000" if i < 9 else f"2026-10-01T09:{i:02d}:00.000"
+        }
+        for i in range(14)
+    ])
+    monkeypatch.setattr(app, "get_data_cache", lambda: app.DataCache(ttl=60))
+
+    def walk(mode, size=4):
+        # 和历史记录页一样多取一条判断有没有下一页，游标取本页最后一条
+        seen, cursor, pages = [], None, 0
+        while True:
+            records = app.load_history_page(cursor, size + 1, mode)
+            pages += 1
+            seen.extend(r.record_id for r in records[:size])
+            if len(records) <= size:
+                return seen, pages
+            cursor = (records[size - 1].created_at, records[size - 1].record_id)
+
+    seen, pages = walk(None)
+    assert pages == 4
+    assert seen == [f"r{i:03d}" for i in range(13, -1, -1)]
+
+    # 9 条正好 3 页，第二、三页的分界落在相同的 created_at 上
+    seen, pages = walk("Translation", size=3)
+    assert pages == 3
+    assert seen == [f"r{i:03d}" for i in range(13, -1, -1) if i % 3]
+
+
+def test_practice_stats(storage):
+    add_practice(storage, 6, start=datetime(2026, 10, 14, 8))
+    storage.insert("weakness_points", [
+        {"record_id": "r000", "type": "语法", "issue": "a", "correction": "b", "mode": "Translation"},
+        {"record_id": "r001", "type": "语法", "issue": "c", "correction": "d", "mode": "Paraphrasing"},
+        {"record_id": "r001", "type": "词汇", "issue": "e", "correction": "f", "mode": "Paraphrasing"}
+    ])
+    stats = storage.practice_stats(date(2026, 10, 16))
+    assert stats["total_practices"] == 6
+    assert stats["practice_days"] == 3
+    assert stats["streak"] == 3
+    assert stats["weakness_total"] == 3
+    assert stats["weakness_by_type"] == {"语法": 2, "词汇": 1}
+    assert stats["mode_counts"] == {"Translation": 3, "Paraphrasing": 3}
+
+
+def test_replace_weakness_for_record(storage):
+    storage.insert("weakness_points", [
+        {"record_id": "r1", "type": "语法", "issue": "old1", "correction": "x", "mode": "Translation"},
+        {"record_id": "r1", "type": "语法", "issue": "old2", "correction": "y", "mode": "Translation"},
+        {"record_id": "r2", "type": "词汇", "issue": "keep", "correction": "z", "mode": "Translation"}
+    ])
+    storage.replace_weakness_for_record("r1", [
+        {"record_id": "r1", "type": "词汇", "issue": "new", "correction": "w", "mode": "Translation"}
+    ])
+    assert [row["issue"] for row in storage.weakness_for_record("r1", "issue")] == ["new"]
+    assert [row["issue"] for row in storage.weakness_for_record("r2", "issue")] == ["keep"]
+
+    rows, total = storage.weakness_page("issue", ["词汇"], "Translation", 0, 10)
+    assert total == 2
+    assert sorted(row["issue"] for row in rows) == ["keep", "new"]
+
+
+def add_conversation(storage, conv_id, count):
+    storage.insert("ai_conversations", [{"id": conv_id, "title": "测试", "created_at": datetime.now().isoformat()}])
+    storage.insert("ai_messages", [
+        {"conversation_id": conv_id, "role": "user", "content": str(i), "timestamp": datetime.now().isoformat()}
+        for i in range(count)
+    ])
+
+
+def test_conversation_count_respects_before_id(storage):
+    add_conversation(storage, "c1", 50)
+    rows, total = storage.conversation_messages("c1", None, 20)
+    assert total == 50
+    rows, total = storage.conversation_messages("c1", rows[-1]["id"], 20)
+    assert total == 30
+    assert [row["content"] for row in rows] == [str(i) for i in range(29, 9, -1)]
+
+
+def test_load_older_messages_pages_to_the_start(app, storage):
+    add_conversation(storage, "c1", 50)
+    conv = {"id": "c1", "messages": None}
+    app.load_older_messages(conv)
+    assert conv["message_offset"] == 30 and conv["has_more"]
+
+    pages = 1
+    while conv["has_more"] and pages < 10:
+        app.load_older_messages(conv)
+        pages += 1
+    assert pages == 3
+    assert conv["message_offset"] == 0
+    assert [m["content"] for m in conv["messages"]] == [str(i) for i in range(50)]
+
+
+def test_regrade_replaces_completion_tokens(app, storage, tmp_path, monkeypatch):
+    storage.insert("practice_history", [{"record_id": "r1", "mode": "Paraphrasing", "completion_tokens": 900}])
+    queue = app.WriteBehindQueue(str(tmp_path / "queue.jsonl"), app.DataCache(ttl=60), app.WeaknessProfile(), flush_interval=0.01)
+    monkeypatch.setattr(app, "get_write_queue", lambda: queue)
+
+    app.save_practice({"mode": "Paraphrasing", "evaluation": {"summary": "新"}, "completion_tokens": 420}, update_record_id="r1")
+    assert queue.flush(5)
+    assert storage.get_practice("r1", "evaluation")["evaluation"] == {"summary": "新"}
+    assert storage.recent_completion_tokens(1) == [{"mode": "Paraphrasing", "completion_tokens": 420}]
+
+
+def test_history_page_summary_needs_no_extra_fetch(app, storage, monkeypatch):
+    storage.insert("practice_history", [
+        {"record_id": "r1", "mode": "Translation", "evaluation": {"summary": "不错"}},
+        {"record_id": "r2", "mode": "Translation", "evaluation": {"score": 6}}
+    ])
+    monkeypatch.setattr(app, "_load_practice_heavy_fields", lambda record_id: pytest.fail("summary 触发了整行查询"))
+    rows = storage.practice_page(app.HISTORY_SUMMARY_COLUMNS, None, 10, None)
+    assert sorted(app.PracticeRecord(row).summary for row in rows) == ["", "不错"]
+
+
+def test_load_older_messages_skips_unsaved_messages(app, storage):
+    add_conversation(storage, "c1", 30)
+    conv = {"id": "c1", "messages": None}
+    app.load_older_messages(conv)
+    # 保存失败的消息 id 为 None，排在最前面时也不能拿它当游标
+    conv["messages"].insert(0, {"id": None, "role": "user", "content": "unsaved", "timestamp": ""})
+
+    app.load_older_messages(conv)
+    contents = [m["content"] for m in conv["messages"]]
+    assert contents[:10] == [str(i) for i in range(10)]
+    assert len(contents) == len(set(contents)) == 31
+    assert not conv["has_more"]
+
+
+def test_new_record_ids_are_unique(app):
+    assert len({app.new_record_id() for _ in range(1000)}) == 1000
+
+
+def test_history_for_date_with_all_columns_needs_no_extra_fetch(app, storage, tmp_path, monkeypatch):
+    add_practice(storage, 4)
+    queue = app.WriteBehindQueue(str(tmp_path / "queue.jsonl"), app.DataCache(ttl=60), app.WeaknessProfile(), flush_interval=0.01)
+    monkeypatch.setattr(app, "get_write_queue", lambda: queue)
+    monkeypatch.setattr(app, "_load_practice_heavy_fields", lambda record_id: pytest.fail("逐条补取了题目和批改"))
+
+    records = app.load_history_for_date(date(2026, 10, 2), columns="*")
+    assert [r.question["chinese_sentence"] for r in records] == ["句子2", "句子3"]
+    assert [r.evaluation["summary"] for r in records] == ["总结2", "总结3"]
+
+
+def test_conversation_list_pages_past_the_first_page(app, storage, monkeypatch):
+    # 一半对话的 created_at 相同，分页只能靠 id 区分
+    storage.insert("ai_conversations", [
+        {"id": f"c{i:03d}", "title": str(i), "created_at": "2026-10-01T08:00:00" if i % 2 else f"2026-10-01T09:{i:02d}:00"}
+        for i in range(7)
+    ])
+    monkeypatch.setattr(app, "CHAT_CONVERSATION_PAGE_SIZE", 3)
+    monkeypatch.setattr(app.st, "session_state", type("State", (dict,), {"__getattr__": dict.__getitem__, "__setattr__": dict.__setitem__})())
+    app.st.session_state.ai_conversations = {}
+
+    pages = 0
+    while pages == 0 or app.st.session_state.conversations_has_more:
+        app.load_more_conversations()
+        pages += 1
+        assert pages < 10
+    assert pages == 3
+    assert list(app.st.session_state.ai_conversations) == ["c006", "c004", "c002", "c000", "c005", "c003", "c001"]
@@ -0,0 +1,216 @@
+import re
+
+import pytest
+
+
+class FakeQuery:
+    """记录调用的 postgrest 查询替身，execute 时返回 data / count，或抛出 error"""
+
+    def __init__(self, calls, name, data=None, count=None, error=None):
+        self.calls = calls
+        self.name = name
+        self.data = data
+        self.count = count
+        self.error = error
+
+    def __getattr__(self, attr):
+        def method(*args, **kwargs):
+            self.calls.append((self.name, attr))
+            return self
+        return method
+
+    @property
+    def not_(self):
+        return self
+
+    def execute(self):
+        if self.error is not None:
+            raise self.error
+        return type("Response", (), {"data": self.data, "count": self.count})()
+
+
+@pytest.fixture
+def supabase(app):
+    def make(rpc_error=None, rpc_data=None, table_data=None):
+        calls = []
+
+        class Client:
+            def rpc(self, name, params):
+                calls.append((name, "rpc"))
+                return FakeQuery(calls, name, data=rpc_data, error=rpc_error)
+
+            def table(self, name):
+                return FakeQuery(calls, name, data=table_data or [], count=0)
+
+        backend = app.SupabaseStorage.__new__(app.SupabaseStorage)
+        backend.client = Client()
+        return backend, calls
+    return make
+
+
+def api_error(code):
+    from postgrest.exceptions import APIError
+    return APIError({"code": code, "message": code})
+
+
+def test_replace_weakness_falls_back_only_when_function_is_missing(supabase):
+    backend, calls = supabase(rpc_error=api_error("PGRST202"))
+    backend.replace_weakness_for_record("r1", [{"record_id": "r1", "issue": "a"}])
+    assert ("weakness_points", "delete") in calls
+    assert ("weakness_points", "insert") in calls
+
+    backend, calls = supabase(rpc_error=api_error("40001"))
+    with pytest.raises(Exception):
+        backend.replace_weakness_for_record("r1", [{"record_id": "r1", "issue": "a"}])
+    assert calls == [("replace_weakness_points", "rpc")]
+
+
+def test_practice_stats_falls_back_only_when_function_is_missing(supabase):
+    from datetime import date
+
+    backend, calls = supabase(rpc_error=api_error("PGRST202"))
+    stats = backend.practice_stats(date(2024, 1, 2))
+    assert stats["total_practices"] == 0
+    assert ("practice_history", "select") in calls
+
+    backend, calls = supabase(rpc_error=api_error("57014"))
+    with pytest.raises(Exception):
+        backend.practice_stats(date(2024, 1, 2))
+    assert calls == [("get_practice_stats", "rpc")]
+
+
+def test_weakness_groups_fall_back_only_when_function_is_missing(supabase):
+    groups = [{"type": "语法", "mode": "Translation", "signature": "a→an", "count": 3}]
+    backend, calls = supabase(rpc_data=groups)
+    assert backend.weakness_groups() == groups
+    assert calls == [("get_weakness_groups", "rpc")]
+
+    backend, calls = supabase(rpc_error=api_error("PGRST202"), table_data=[{"type": "语法", "issue": "a"}])
+    assert backend.weakness_groups() == [{"type": "语法", "issue": "a"}]
+    assert ("weakness_points", "select") in calls
+
+    backend, calls = supabase(rpc_error=api_error("57014"))
+    with pytest.raises(Exception):
+        backend.weakness_groups()
+    assert calls == [("get_weakness_groups", "rpc")]
+
+
+class PagingQuery:
+    """按 practice_page 用到的 eq / or_ / order / limit 在内存里过滤 practice_history 的替身"""
+
+    KEYSET = re.compile(r'^created_at\.lt\."(.+)",and\(created_at\.eq\."(.+)",record_id\.lt\."(.+)"\)$')
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.filters = []
+        self.count = None
+
+    def select(self, columns):
+        return self
+
+    def order(self, column, desc=False):
+        # 先 created_at 后 record_id，稳定排序要倒着应用
+        self.filters.append(("order", column, desc))
+        return self
+
+    def limit(self, n):
+        self.count = n
+        return self
+
+    def eq(self, column, value):
+        self.filters.append(("where", lambda row: row[column] == value))
+        return self
+
+    def or_(self, expression):
+        match = self.KEYSET.match(expression)
+        assert match, expression
+        lt, eq, record_id = match.groups()
+        assert lt == eq
+        self.filters.append(("where", lambda row: row["created_at"] < lt or (row["created_at"] == eq and row["record_id"] < record_id)))
+        return self
+
+    def execute(self):
+        rows = [row for row in self.rows if all(f[1](row) for f in self.filters if f[0] == "where")]
+        for _, column, desc in reversed([f for f in self.filters if f[0] == "order"]):
+            rows.sort(key=lambda row: row[column], reverse=desc)
+        return type("Response", (), {"data": rows[:self.count]})()
+
+
+def test_practice_page_walks_tied_timestamps_without_gaps(app):
+    rows = [
+        {
+            "record_id": f"r{i:03d}",
+            "mode": "Translation",
+            # 带时区和小数秒的时间戳，和 PostgREST 返回的一样
+            "created_at": "2026-10-01T08:00:00.123+00:00" if i < 7 else f"2026-10-01T09:{i:02d}:00+00:00"
+        }
+        for i in range(12)
+    ]
+    backend = app.SupabaseStorage.__new__(app.SupabaseStorage)
+    backend.client = type("Client", (), {"table": lambda self, name: PagingQuery(rows)})()
+
+    seen, cursor, pages = [], None, 0
+    while True:
+        page = backend.practice_page("record_id,created_at", cursor, 5, None)
+        if not page:
+            break
+        pages += 1
+        seen.extend(row["record_id"] for row in page)
+        cursor = (page[-1]["created_at"], page[-1]["record_id"])
+    assert pages == 3
+    assert seen == [f"r{i:03d}" for i in range(11, -1, -1)]
+
+
+class FailingTable:
+    """依次抛出 errors 里的错误，之后写入成功；记下每次写入用的方法、字段和 on_conflict"""
+
+    def __init__(self, errors):
+        self.errors = list(errors)
+        self.calls = []
+
+    def _write(self, kind, rows, on_conflict=None):
+        self.calls.append((kind, sorted(rows[0]), on_conflict))
+        error = self.errors.pop(0) if self.errors else None
+        return FakeQuery([], kind, data=rows, error=error)
+
+    def upsert(self, rows, on_conflict=None, **kwargs):
+        return self._write("upsert", rows, on_conflict)
+
+    def insert(self, rows):
+        return self._write("insert", rows)
+
+
+def failing_backend(app, table):
+    backend = app.SupabaseStorage.__new__(app.SupabaseStorage)
+    backend.client = type("Client", (), {"table": lambda self, name: table})()
+    return backend
+
+
+def test_insert_drops_only_columns_the_database_reports_missing(app):
+    from postgrest.exceptions import APIError
+
+    table = FailingTable([
+        APIError({"code": "PGRST204", "message": "Could not find the 'signature' column of 'weakness_points' in the schema cache"}),
+        APIError({"code": "42703", "message": 'column "client_id" of relation "weakness_points" does not exist'})
+    ])
+    row = {"client_id": "c1", "issue": "a", "signature": "a"}
+    failing_backend(app, table).insert("weakness_points", [row], on_conflict="client_id")
+    assert table.calls == [
+        ("upsert", ["client_id", "issue", "signature"], "client_id"),
+        ("upsert", ["client_id", "issue"], "client_id"),
+        ("insert", ["issue"], None)
+    ]
+
+
+def test_insert_reraises_other_errors_that_mention_a_column(app):
+    from postgrest.exceptions import APIError
+
+    # 约束冲突的详情里带着 client_id，不能当作字段不存在去掉唯一键重写
+    table = FailingTable([APIError({
+        "code": "23505",
+        "message": 'duplicate key value violates unique constraint "weakness_points_client_id_idx"',
+        "details": "Key (client_id)=(c1) already exists."
+    })])
+    with pytest.raises(APIError):
+        failing_backend(app, table).insert("weakness_points", [{"client_id": "c1", "issue": "a"}], on_conflict="client_id")
+    assert table.calls == [("upsert", ["client_id", "issue"], "client_id")]
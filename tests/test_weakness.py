@@ -0,0 +1,133 @@
+def test_backfill_only_touches_legacy_rows(app, storage):
+    comment = "时态错误，应该改为 'went'"
+    legacy = app.COMMENT_CLASSIFIER.classify(comment)
+    storage.insert("weakness_points", [
+        # 旧格式：issue 是中文批改意见，correction 是从意见里提取的
+        {"record_id": "r1", "type": "其他", "issue": comment, "correction": legacy["correction"], "mode": "Translation"},
+        {"record_id": "r1", "type": "其他", "issue": "这里用词不当", "correction": "", "mode": "Translation"},
+        # 新格式：原句里夹着没翻译的中文，类型是 AI 给的
+        {"record_id": "r2", "type": "词汇", "issue": "I like 饺子 very much.", "correction": "I like dumplings very much.", "mode": "Translation"}
+    ])
+
+    app.backfill_weakness_types(batch_size=2)
+
+    types = {row["issue"]: row["type"] for row in storage.list_weakness("issue,type")}
+    assert types[comment] == legacy["type"] != "其他"
+    assert types["这里用词不当"] == app.COMMENT_CLASSIFIER.classify("这里用词不当")["type"]
+    assert types["I like 饺子 very much."] == "词汇"
+
+
+def test_backfill_command_line(app, storage, capsys):
+    import weakness_classifier
+
+    storage.insert("weakness_points", [
+        {"record_id": "r1", "type": "其他", "issue": "时态错误，应该改为 'went'", "correction": "", "mode": "Translation"}
+    ])
+    weakness_classifier.main(["backfill", "--batch-size", "10"])
+
+    assert "已更新 1 条" in capsys.readouterr().out
+    assert storage.list_weakness("type") == [{"type": "注意"}]
+
+
+def test_weakness_categories(app):
+    assert app.weakness_categories("这里的从句用词不对") == {"从句", "用词搭配"}
+    assert app.weakness_categories("Spelling 和 Collocation") == {"拼写", "用词搭配"}
+
+
+def test_profile_applies_changes_made_while_loading(app, storage, monkeypatch):
+    import threading
+
+    storage.insert("weakness_points", [{"record_id": "r1", "type": "语法", "issue": "a", "correction": "b", "mode": "Translation"}])
+    profile = app.WeaknessProfile()
+    started, release = threading.Event(), threading.Event()
+    weakness_groups = storage.weakness_groups
+
+    def slow_weakness_groups():
+        rows = weakness_groups()
+        started.set()
+        release.wait(5)
+        return rows
+
+    monkeypatch.setattr(storage, "weakness_groups", slow_weakness_groups)
+    loader = threading.Thread(target=profile.ensure_loaded)
+    loader.start()
+    assert started.wait(5)
+    # 读数据库期间锁是空闲的，增量更新不会被挡住
+    profile.add([{"type": "词汇", "issue": "c", "correction": "d", "mode": "Translation"}])
+    release.set()
+    loader.join(5)
+
+    assert profile.loaded
+    assert profile.by_type == {"语法": 1, "词汇": 1}
+
+
+def test_same_error_in_different_sentences_shares_a_signature(app):
+    first = app.weakness_signature("I have a apple.", "I have an apple.")
+    assert first == "a→an"
+    assert app.weakness_signature("She ate a orange.", "She ate an orange.") == first
+    # 旧格式的中文批改意见取规范化后的原文
+    assert app.weakness_signature("冠词用错了！", "") == "冠词用错了"
+
+
+def test_profile_clusters_repeated_weaknesses(app, storage):
+    points = [
+        {"type": "语法", "issue": "I have a apple.", "correction": "I have an apple.", "mode": "Translation", "timestamp": "2026-10-01"},
+        {"type": "语法", "issue": "She ate a orange.", "correction": "She ate an orange.", "mode": "Paraphrasing", "timestamp": "2026-10-03"},
+        {"type": "语法", "issue": "He go home.", "correction": "He goes home.", "mode": "Translation", "timestamp": "2026-10-02"},
+        # 类型不同的同一个签名不会并进同一簇
+        {"type": "词汇", "issue": "I have a apple.", "correction": "I have an apple.", "mode": "Translation", "timestamp": "2026-10-01"}
+    ]
+    storage.insert("weakness_points", [dict(p, record_id="r1") for p in points])
+    profile = app.WeaknessProfile()
+
+    top = profile.top_clusters(types=["语法"])
+    assert [(c.signature, c.count) for c in top] == [("a→an", 2), ("go→goes", 1)]
+    assert top[0].latest == "2026-10-03"
+    assert top[0].correction == "She ate an orange."
+    assert [c.signature for c in profile.top_clusters(types=["语法"], mode="Paraphrasing")] == ["a→an"]
+
+    profile.remove(points[:2])
+    assert [c.signature for c in profile.top_clusters(types=["语法"])] == ["go→goes"]
+
+
+def test_similar_signatures_join_the_same_cluster(app, storage):
+    profile = app.WeaknessProfile(cluster_threshold=0.5)
+    profile.ensure_loaded()
+    profile.add([
+        {"type": "其他", "issue": "这里的时态用错了，应该用过去时", "correction": "", "mode": "Translation"},
+        {"type": "其他", "issue": "这里的时态用错了，应该用过去式", "correction": "", "mode": "Translation"},
+        {"type": "其他", "issue": "拼写错误", "correction": "", "mode": "Translation"}
+    ])
+    assert sorted(c.count for c in profile.top_clusters()) == [1, 2]
+
+
+def test_profile_loads_aggregated_groups(app, storage):
+    points = [
+        {"type": "语法", "issue": "I have a apple.", "correction": "I have an apple.", "mode": "Translation"},
+        {"type": "语法", "issue": "She ate a orange.", "correction": "She ate an orange.", "mode": "Translation"},
+        {"type": "语法", "issue": "It is a egg.", "correction": "It is an egg.", "mode": "Paraphrasing"}
+    ]
+    storage.insert("weakness_points", [app._weakness_row(p, "r1", f"2026-10-0{i + 1}") for i, p in enumerate(points)])
+    # 没有签名的旧数据按原文分组
+    storage.insert("weakness_points", [
+        {"record_id": "r2", "type": "其他", "issue": "时态错误", "correction": "", "mode": "Translation", "timestamp": "2026-09-01"}
+        for _ in range(2)
+    ])
+
+    groups = storage.weakness_groups()
+    assert [(g["type"], g["mode"], g["signature"], g["count"]) for g in groups] == [
+        ("语法", "Translation", "a→an", 2),
+        ("语法", "Paraphrasing", "a→an", 1),
+        ("其他", "Translation", None, 2)
+    ]
+    assert groups[0]["issue"] == "She ate a orange."
+    assert groups[0]["timestamp"] == "2026-10-02"
+
+    profile = app.WeaknessProfile()
+    profile.ensure_loaded()
+    assert profile.by_type == {"语法": 3, "其他": 2}
+    assert profile.by_mode == {"Translation": 4, "Paraphrasing": 1}
+    assert profile.categories["时态"] == 2
+    top = profile.top_clusters()
+    assert [(c.signature, c.count) for c in top] == [("a→an", 3), ("时态错误", 2)]
+    assert top[0].modes == {"Translation": 2, "Paraphrasing": 1}
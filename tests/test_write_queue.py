@@ -0,0 +1,81 @@
+import sqlite3
+
+import pytest
+
+
+@pytest.fixture
+def queue_factory(app, tmp_path):
+    def make(**kwargs):
+        return app.WriteBehindQueue(str(tmp_path / "queue.jsonl"), app.DataCache(ttl=60), app.WeaknessProfile(), flush_interval=0.01, **kwargs)
+    return make
+
+
+def test_rejected_batch_is_reported_and_can_be_retried(app, storage, queue_factory, monkeypatch):
+    insert = storage.insert
+    rejecting = [True]
+
+    def flaky_insert(table, rows, on_conflict=None):
+        if rejecting[0]:
+            raise sqlite3.IntegrityError("rejected")
+        return insert(table, rows, on_conflict)
+
+    monkeypatch.setattr(storage, "insert", flaky_insert)
+    queue = queue_factory(max_attempts=1)
+    queue.enqueue("practice_history", [{"record_id": "r1", "mode": "Translation"}])
+    assert queue.flush(5)
+    assert queue.failed_count == 1
+    assert "rejected" in queue.last_error
+    assert storage.get_practice("r1", "record_id") is None
+
+    rejecting[0] = False
+    assert queue.retry_failed() == 1
+    assert queue.flush(5)
+    assert queue.failed_count == 0 and queue.last_error is None
+    assert storage.get_practice("r1", "record_id") == {"record_id": "r1"}
+
+
+def test_supabase_insert_falls_back_without_unique_index(app):
+    from postgrest.exceptions import APIError
+
+    calls = []
+
+    class Query:
+        def __init__(self, kind):
+            self.kind = kind
+
+        def execute(self):
+            if self.kind == "upsert":
+                raise APIError({"code": "42P10", "message": "there is no unique or exclusion constraint matching the ON CONFLICT specification"})
+            return type("Response", (), {"data": [{"record_id": "r1"}]})()
+
+    class Table:
+        def upsert(self, rows, **kwargs):
+            calls.append("upsert")
+            return Query("upsert")
+
+        def insert(self, rows):
+            calls.append("insert")
+            return Query("insert")
+
+    backend = app.SupabaseStorage.__new__(app.SupabaseStorage)
+    backend.client = type("Client", (), {"table": lambda self, name: Table()})()
+    assert backend.insert("practice_history", [{"record_id": "r1"}], on_conflict="record_id") == [{"record_id": "r1"}]
+    assert calls == ["upsert", "insert"]
+
+
+def test_profile_counts_weakness_only_after_it_is_written(app, storage, queue_factory, monkeypatch):
+    monkeypatch.setattr(storage, "insert", lambda *args, **kwargs: (_ for _ in ()).throw(sqlite3.IntegrityError("rejected")))
+    queue = queue_factory(max_attempts=1)
+    queue.profile.ensure_loaded()
+    monkeypatch.setattr(app, "get_write_queue", lambda: queue)
+
+    app.save_weakness_points([{"type": "语法", "issue": "a", "correction": "b", "mode": "Translation"}], record_id="r1")
+    assert queue.flush(5)
+    assert queue.failed_count == 1
+    assert sum(queue.profile.by_type.values()) == 0
+
+    monkeypatch.undo()
+    monkeypatch.setattr(app, "get_storage", lambda: storage)
+    queue.retry_failed()
+    assert queue.flush(5)
+    assert queue.profile.by_type == {"语法": 1}
@@ -0,0 +1,134 @@
+# 旧格式薄弱点的关键词分类器和重新归类脚本。只依赖标准库，app.py 用它归类旧版批改意见；
+# 重新归类也可以不开页面直接运行：python -m weakness_classifier backfill
+import argparse
+import re
+from typing import Dict, List, Optional
+
+# 旧格式批改意见（只有一段 comment）的关键词分类器：所有关键词编译进一个正则，一次扫描得到类型和修改建议
+class KeywordClassifier:
+    """type_rules 按优先级排列，命中任一关键词即归为该类型；suggestion_keywords 按优先级排列，
+    修改建议取优先级最高的关键词第一次出现处到结尾的文字，都没有时退回到引号里的内容"""
+
+    _QUOTED = re.compile(r"'([^']+)'")
+
+    def __init__(self, type_rules: List[tuple], suggestion_keywords: List[str], default_type: str = "其他"):
+        self.type_order = [type_name for type_name, _ in type_rules]
+        self.default_type = default_type
+        keyword_types: Dict[str, set] = {}
+        for type_name, keywords in type_rules:
+            for keyword in keywords:
+                keyword_types.setdefault(keyword, set()).add(type_name)
+        suggestion_rank = {}
+        for rank, keyword in enumerate(suggestion_keywords):
+            suggestion_rank.setdefault(keyword, rank)
+
+        keywords = sorted(set(keyword_types) | set(suggestion_rank), key=len, reverse=True)
+        # 同一位置只会报告最长的关键词，它的前缀关键词的类型和建议优先级要合并进来
+        self._types: Dict[str, set] = {}
+        self._rank: Dict[str, Optional[int]] = {}
+        for keyword in keywords:
+            prefixes = [k for k in keywords if keyword.startswith(k)]
+            self._types[keyword] = set().union(*(keyword_types.get(k, set()) for k in prefixes))
+            ranks = [suggestion_rank[k] for k in prefixes if k in suggestion_rank]
+            self._rank[keyword] = min(ranks) if ranks else None
+        # 零宽前瞻让每个位置都参与匹配，重叠的关键词不会被吞掉
+        self._pattern = re.compile("(?=(" + "|".join(re.escape(k) for k in keywords) + "))")
+
+    def classify(self, comment: str) -> Dict:
+        found_types = set()
+        best = None
+        for match in self._pattern.finditer(comment):
+            keyword = match.group(1)
+            found_types |= self._types[keyword]
+            rank = self._rank[keyword]
+            if rank is not None and (best is None or (rank, match.start()) < best):
+                best = (rank, match.start())
+
+        type_name = next((t for t in self.type_order if t in found_types), self.default_type)
+        if best is not None:
+            correction = comment[best[1]:].strip()
+        else:
+            quoted = self._QUOTED.findall(comment)
+            if len(quoted) >= 2:
+                correction = f"改为 '{quoted[1]}'"
+            elif len(quoted) == 1:
+                correction = f"参考：'{quoted[0]}'"
+            else:
+                correction = ""
+        return {"type": type_name, "correction": correction}
+
+    def classify_many(self, comments: List[str]) -> List[Dict]:
+        return [self.classify(comment) for comment in comments]
+
+COMMENT_CLASSIFIER = KeywordClassifier(
+    type_rules=[
+        # 语法错误相关关键词 -> 归类到"注意"
+        ("注意", [
+            "语法", "拼写", "时态", "主谓一致", "冠词", "介词", "动词", "名词",
+            "形容词", "副词", "错误", "应为", "应该是", "注意", "拼写错误",
+            "语法错误", "时态错误", "主谓不一致"
+        ]),
+        # 表达相关关键词 -> 归类到"建议"
+        ("建议", [
+            "建议", "更好的表达", "可以改为", "表达", "流畅", "优美",
+            "更符合", "习惯", "地道", "高级", "改写"
+        ])
+    ],
+    suggestion_keywords=["建议", "改为", "应该是", "可以改为", "更好的表达", "注意", "应为"]
+)
+
+# 旧格式薄弱点的标记：correction 为空，或者正好是从 issue（批改意见）里提取出的修改建议。
+# 新格式的 issue 是学生原句、correction 是 AI 给的改正句，即使含中文也不会满足这个条件
+def is_legacy_weakness(row: Dict, result: Optional[Dict] = None) -> bool:
+    correction = row.get("correction") or ""
+    if not correction:
+        return True
+    result = result or COMMENT_CLASSIFIER.classify(row.get("issue") or "")
+    return result["correction"] == correction
+
+# 用当前分类器重新归类已有的旧格式薄弱点，按 id 分批流式读取，
+# 同一类型的行用一条更新语句，返回被改动的行数。storage 是 app.py 里的存储后端
+def backfill_weakness_types(storage, batch_size: int = 500) -> int:
+    # 分批读取和按行更新都靠 id，表里没有这个字段时直接报错
+    sample = storage.scan_weakness("*", None, 1)
+    if sample and "id" not in sample[0]:
+        raise ValueError("weakness_points 表没有 id 字段，无法重新归类")
+
+    changed = 0
+    last_id = None
+    while True:
+        rows = storage.scan_weakness("id,type,issue,correction", last_id, batch_size)
+        if not rows:
+            break
+        last_id = rows[-1]["id"]
+
+        results = COMMENT_CLASSIFIER.classify_many([row.get("issue") or "" for row in rows])
+        updates: Dict[str, List] = {}
+        for row, result in zip(rows, results):
+            if is_legacy_weakness(row, result) and (row.get("type") or "其他") != result["type"]:
+                updates.setdefault(result["type"], []).append(row["id"])
+        for type_name, ids in updates.items():
+            storage.set_weakness_type(ids, type_name)
+            changed += len(ids)
+
+        if len(rows) < batch_size:
+            break
+    return changed
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(prog="python -m weakness_classifier", description="薄弱点数据维护")
+    commands = parser.add_subparsers(dest="command", required=True)
+    backfill = commands.add_parser("backfill", help="用当前关键词规则重新归类旧版批改意见生成的薄弱点")
+    backfill.add_argument("--batch-size", type=int, default=500, help="每批读取的行数")
+    args = parser.parse_args(argv)
+
+    # 存储后端和页面用同一套配置（.env / 环境变量）；app 导入较慢，运行时才导入
+    from app import get_storage
+
+    changed = backfill_weakness_types(get_storage(), args.batch_size)
+    print(f"已更新 {changed} 条薄弱点的类型")
+    if changed:
+        print("正在运行的页面需要重启后才会按新类型统计")
+
+if __name__ == "__main__":
+    main()